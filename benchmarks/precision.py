@@ -0,0 +1,94 @@
+"""Benchmark of the single precision mode against double precision.
+
+Runs the phase cycled spin echo in both precisions and reports the run time, the peak memory of the propagation and the largest deviation of single from double precision, relative to the signal maximum.
+The memory is taken from a second, profiled run, because tracing the allocations slows down the simulation.
+The shaped pulse variant runs on the general step by step path, the rectangular one on the fast path.
+
+Run with:
+    python benchmarks/precision.py
+"""
+
+import logging
+import time
+
+import numpy as np
+
+from quackseq.functions import GaussianFunction
+from quackseq.sequences.SEPC import create_SEPC
+from quackseq_simulator.simulator import Simulator
+
+CASES = (
+    (8192, 1000),
+    (32768, 1000),
+    (8192, 10000),
+)
+
+
+def create_shaped_SEPC():
+    """Creates the phase cycled spin echo with a gaussian pi pulse."""
+    sequence = create_SEPC()
+    pi_pulse = sequence.get_event_by_name("pi")
+    sequence.set_tx_shape(pi_pulse, GaussianFunction())
+    return sequence
+
+
+def run(create, number_points: int, number_isochromats: int, precision: str) -> tuple:
+    """Runs one simulation and a profiled one.
+
+    Args:
+        create (callable): Creates the pulse sequence.
+        number_points (int): The number of simulation points.
+        number_isochromats (int): The number of isochromats.
+        precision (str): The precision setting.
+
+    Returns:
+        tuple: The measurement, the run time in seconds and the peak memory of the propagation in bytes.
+    """
+    for profile in (False, True):
+        simulator = Simulator(profile=profile)
+        simulator.settings.noise = 0
+        simulator.settings.number_points = number_points
+        simulator.settings.number_isochromats = number_isochromats
+        simulator.settings.precision = precision
+
+        np.random.seed(0)
+        start = time.perf_counter()
+        result = simulator.run_sequence(create())
+        wall_time = time.perf_counter() - start
+
+        if profile:
+            memory = simulator.last_run_stats.summary()["propagation"]["allocated_bytes"]
+        else:
+            measurement, run_time = result, wall_time
+
+    return measurement, run_time, memory
+
+
+def main():
+    """Runs the benchmark and prints the comparison."""
+    logging.basicConfig(level=logging.WARNING)
+
+    print(
+        f"{'sequence':>12} {'points':>6} {'isochromats':>11} | "
+        f"{'double':>8} {'single':>8} | {'double MB':>9} {'single MB':>9} | {'error':>8}"
+    )
+    for name, create in (("rect SEPC", create_SEPC), ("shaped SEPC", create_shaped_SEPC)):
+        for number_points, number_isochromats in CASES:
+            double, double_time, double_memory = run(
+                create, number_points, number_isochromats, "double"
+            )
+            single, single_time, single_memory = run(
+                create, number_points, number_isochromats, "single"
+            )
+
+            error = np.max(np.abs(single.tdy - double.tdy)) / np.max(np.abs(double.tdy))
+
+            print(
+                f"{name:>12} {number_points:>6} {number_isochromats:>11} | "
+                f"{double_time:>7.2f}s {single_time:>7.2f}s | "
+                f"{double_memory / 1e6:>9.1f} {single_memory / 1e6:>9.1f} | {error:>8.1e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Benchmark suite for the hot paths of the simulator.
+
+Times the translation of the pulse sequence, the construction and the propagation of the Bloch simulation of one phase cycle and the whole Simulator.run_sequence for the sequences shipped with quackseq (FID, SE, SEPC and COMPFID).
+Every stage is timed while number_points, number_isochromats and the number of phase cycles are scanned one at a time around the default settings.
+
+The results are stored as JSON together with the versions of the packages, so runs of different versions can be compared.
+
+Run with:
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --quick --compare results.json
+"""
+
+import argparse
+import json
+import logging
+import platform
+import timeit
+from datetime import datetime
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+
+from quackseq.functions import RectFunction
+from quackseq.pulsesequence import QuackSequence
+from quackseq.sequences.FID import create_FID
+from quackseq.sequences.SE import create_SE
+from quackseq.sequences.SEPC import create_SEPC
+from quackseq.sequences.COMPFID import create_COMPFID
+from quackseq_simulator.simulator import Simulator
+
+SEQUENCES = {
+    "FID": create_FID,
+    "SE": create_SE,
+    "SEPC": create_SEPC,
+    "COMPFID": create_COMPFID,
+}
+
+SCANS = {
+    "number_points": (2048, 8192, 32768),
+    "number_isochromats": (100, 1000, 10000),
+    "phase_cycles": (1, 2, 4, 8),
+}
+
+QUICK_SCANS = {
+    "number_points": (1024, 4096),
+    "number_isochromats": (100, 500),
+    "phase_cycles": (1, 4),
+}
+
+PACKAGES = ("quackseq-simulator", "quackseq", "nqr-blochsimulator", "numpy")
+
+
+def create_phase_cycled_FID(n_phase_cycles: int) -> QuackSequence:
+    """Creates a FID with a phase cycled pulse.
+
+    Args:
+        n_phase_cycles (int): The number of phase cycles.
+
+    Returns:
+        QuackSequence: The phase cycled FID.
+    """
+    sequence = QuackSequence(f"FID {n_phase_cycles} phase cycles")
+    sequence.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+    sequence.set_tx_n_phase_cycles("tx", n_phase_cycles)
+    sequence.add_blank_event("blank", "5u")
+    sequence.add_readout_event("rx", "100u")
+    sequence.set_rx_phase("rx", list(np.arange(n_phase_cycles) * 360 / n_phase_cycles))
+    return sequence
+
+
+def time_stages(simulator: Simulator, sequence: QuackSequence, repeat: int) -> dict:
+    """Times the stages of the simulation of a pulse sequence.
+
+    Args:
+        simulator (Simulator): The simulator with the settings of the run.
+        sequence (QuackSequence): The pulse sequence.
+        repeat (int): The number of repetitions, the fastest one is kept.
+
+    Returns:
+        dict: The time of every stage in seconds.
+    """
+    controller = simulator.controller
+    sequence.phase_table.generate_phase_array()
+    dwell_time = controller.calculate_dwelltime(sequence)
+    sample, _ = controller.get_sample_setup()
+
+    def best(function, setup="pass") -> float:
+        return min(timeit.repeat(function, setup=setup, number=1, repeat=repeat))
+
+    def clear_caches() -> None:
+        # Otherwise every repetition after the first one only looks up the cached signals
+        controller.signal_cache.clear()
+        controller.propagator_cache.clear()
+        controller.checkpoint_cache.clear()
+
+    pulse_array = controller.translate_pulse_sequence(sequence, dwell_time, 0)
+    simulation = controller.get_simulation(sample, pulse_array)
+
+    return {
+        "translate_pulse_sequence": best(
+            lambda: controller.translate_pulse_sequence(sequence, dwell_time, 0)
+        ),
+        "get_simulation": best(lambda: controller.get_simulation(sample, pulse_array)),
+        "simulate": best(simulation.simulate),
+        "run_sequence": best(
+            lambda: simulator.run_sequence(sequence), setup=clear_caches
+        ),
+    }
+
+
+def run_suite(scans: dict, repeat: int) -> list:
+    """Runs the benchmarks of all scans.
+
+    Args:
+        scans (dict): The scanned values of number_points, number_isochromats and phase_cycles.
+        repeat (int): The number of repetitions of every measurement.
+
+    Returns:
+        list: One entry per benchmark with the sequence, the settings and the times of the stages.
+    """
+    cases = list()
+    for name, create in SEQUENCES.items():
+        for setting in ("number_points", "number_isochromats"):
+            for value in scans[setting]:
+                cases.append((name, create, {setting: value}))
+
+    for n_phase_cycles in scans["phase_cycles"]:
+        cases.append(
+            (
+                "FID phase cycled",
+                lambda n=n_phase_cycles: create_phase_cycled_FID(n),
+                {"phase_cycles": n_phase_cycles},
+            )
+        )
+
+    results = list()
+    for name, create, parameters in cases:
+        simulator = Simulator()
+        for setting, value in parameters.items():
+            if setting in simulator.settings:
+                simulator.settings[setting].value = value
+
+        np.random.seed(0)
+        times = time_stages(simulator, create(), repeat)
+
+        result = {
+            "sequence": name,
+            "number_points": int(simulator.settings.number_points),
+            "number_isochromats": int(simulator.settings.number_isochromats),
+            "phase_cycles": parameters.get("phase_cycles"),
+            "times": times,
+        }
+        results.append(result)
+        print(format_result(result))
+
+    return results
+
+
+def format_result(result: dict, reference: dict = None) -> str:
+    """Formats one benchmark result as a line of text.
+
+    Args:
+        result (dict): The benchmark result.
+        reference (dict, optional): The result of the same benchmark of an earlier run.
+
+    Returns:
+        str: The formatted result.
+    """
+    line = (
+        f"{result['sequence']:>16} {result['number_points']:>6} points "
+        f"{result['number_isochromats']:>6} isochromats"
+    )
+    if result["phase_cycles"] is not None:
+        line += f" {result['phase_cycles']:>2} cycles"
+    for stage, seconds in result["times"].items():
+        line += f" | {stage} {seconds * 1e3:9.2f} ms"
+        if reference is not None and stage in reference["times"]:
+            line += f" ({seconds / reference['times'][stage]:5.2f}x)"
+    return line
+
+
+def case_key(result: dict) -> tuple:
+    """Returns the key that identifies a benchmark across runs."""
+    return (
+        result["sequence"],
+        result["number_points"],
+        result["number_isochromats"],
+        result["phase_cycles"],
+    )
+
+
+def get_versions() -> dict:
+    """Returns the versions of the benchmarked packages."""
+    versions = {"python": platform.python_version()}
+    for package in PACKAGES:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def main():
+    """Runs the benchmark suite and stores the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per benchmark")
+    parser.add_argument("--quick", action="store_true", help="scan smaller problems")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run_suite(QUICK_SCANS if args.quick else SCANS, args.repeat)
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "versions": get_versions(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            reference = json.load(file)
+        print(f"Compared with {args.compare} ({reference['versions']})")
+        references = {case_key(result): result for result in reference["results"]}
+        for result in results:
+            print(format_result(result, references.get(case_key(result))))
+
+
+if __name__ == "__main__":
+    main()
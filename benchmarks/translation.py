@@ -0,0 +1,85 @@
+"""Micro-benchmark for the translation of pulse sequences to pulse arrays.
+
+Times SimulatorController.translate_pulse_sequence for trains of shaped pulses and reports the cost per event.
+The translation is split into building the phase independent pulse plan, which happens once per run, and filling the phases of a phase cycle, which happens once per cycle.
+
+Run with:
+    python benchmarks/translation.py
+"""
+
+import logging
+import timeit
+
+from quackseq.pulsesequence import QuackSequence
+from quackseq.functions import GaussianFunction
+from quackseq_simulator.simulator import Simulator
+
+REPEAT = 5
+
+
+def create_pulse_train(n_pulses: int) -> QuackSequence:
+    """Creates a train of gaussian pulses with a blank after every pulse.
+
+    Args:
+        n_pulses (int): The number of pulses.
+
+    Returns:
+        QuackSequence: The pulse train.
+    """
+    sequence = QuackSequence(f"pulse train {n_pulses}")
+    for pulse in range(n_pulses):
+        sequence.add_pulse_event(f"tx{pulse}", "10u", 100, 0, GaussianFunction())
+        sequence.add_blank_event(f"blank{pulse}", "10u")
+    sequence.add_readout_event("rx", "100u")
+    return sequence
+
+
+def main():
+    """Runs the benchmark and prints the translation cost per event."""
+    logging.basicConfig(level=logging.WARNING)
+
+    simulator = Simulator()
+    controller = simulator.controller
+
+    print(f"{'pulses':>6} {'points':>7} {'translate/event':>16} {'plan/event':>11} {'phases/event':>13}")
+    for n_pulses in (1, 8, 32):
+        sequence = create_pulse_train(n_pulses)
+        sequence.phase_table.generate_phase_array()
+        n_events = len(sequence.events)
+        phases = sequence.phase_table.phase_array[0]
+
+        for n_points in (8192, 32768, 131072):
+            simulator.settings.number_points = n_points
+            dwell_time = controller.calculate_dwelltime(sequence)
+
+            translate = min(
+                timeit.repeat(
+                    lambda: controller.translate_pulse_sequence(sequence, dwell_time, 0),
+                    number=1,
+                    repeat=REPEAT,
+                )
+            )
+            plan = min(
+                timeit.repeat(
+                    lambda: controller.get_pulse_plan(sequence, dwell_time),
+                    number=1,
+                    repeat=REPEAT,
+                )
+            )
+            pulse_plan = controller.get_pulse_plan(sequence, dwell_time)
+            fill = min(
+                timeit.repeat(
+                    lambda: pulse_plan.get_pulse_array(phases), number=1, repeat=REPEAT
+                )
+            )
+
+            print(
+                f"{n_pulses:>6} {n_points:>7} "
+                f"{translate / n_events * 1e6:>13.1f} µs "
+                f"{plan / n_events * 1e6:>8.1f} µs "
+                f"{fill / n_events * 1e6:>10.1f} µs"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Simulation of a batch of pulse sequences with the same settings."""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .simulator_controller import simulate_cycle
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResult:
+    """The results of a batch of pulse sequences.
+
+    Args:
+        measurements (list): The measurement of every pulse sequence in the order of the batch, None for pulse sequences that could not be simulated.
+        errors (dict): The error message of every pulse sequence that could not be simulated, keyed by its index in the batch.
+
+    Attributes:
+        measurements (list): The measurement of every pulse sequence.
+        errors (dict): The error message of every pulse sequence that could not be simulated.
+    """
+
+    def __init__(self, measurements: list, errors: dict) -> None:
+        """Initializes the BatchResult."""
+        self.measurements = measurements
+        self.errors = errors
+
+    @property
+    def ok(self) -> bool:
+        """True if all pulse sequences were simulated."""
+        return not self.errors
+
+    def __getitem__(self, index: int):
+        """Returns the measurement of a pulse sequence."""
+        return self.measurements[index]
+
+    def __iter__(self):
+        """Iterates over the measurements in the order of the batch."""
+        return iter(self.measurements)
+
+    def __len__(self) -> int:
+        """Returns the number of pulse sequences of the batch."""
+        return len(self.measurements)
+
+
+def run_batch(simulator, sequences: list, workers: int = None) -> BatchResult:
+    """Simulates several pulse sequences with the settings of the simulator.
+
+    All pulse sequences are translated up front with one sample and isochromat distribution.
+    The phase cycles of all pulse sequences that are not in the signal cache of the simulator are then simulated as one pool of jobs, the longest jobs first, so the workers stay busy until the end of the batch.
+    Phase cycles that several pulse sequences have in common are only simulated once.
+    A pulse sequence that can not be simulated does not stop the others, its error is reported in the result.
+
+    Args:
+        simulator (Simulator): The simulator with the settings of the batch.
+        sequences (list): The pulse sequences.
+        workers (int, optional): The number of worker processes, the workers setting of the simulator by default. With one worker the phase cycles are simulated in this process.
+
+    Returns:
+        BatchResult: The measurements in the order of the pulse sequences and the errors.
+    """
+    controller = simulator.controller
+    if workers is None:
+        workers = int(simulator.settings.workers)
+
+    stats = controller.start_run_stats()
+    try:
+        # Every pulse sequence is translated once, the sample and the isochromats are shared by all of them
+        prepared = dict()
+        errors = dict()
+        for index, sequence in enumerate(sequences):
+            try:
+                prepared[index] = controller.prepare_simulation(sequence, stats)
+            except ValueError as e:
+                logger.warning(f"Sequence {index} of the batch: {e}")
+                errors[index] = str(e)
+
+        # The jobs are the unique phase cycles that are not cached
+        signals = dict()
+        jobs = dict()
+        users = dict()
+        for index, (sample, xdis, pulse_plan) in prepared.items():
+            phase_table = np.asarray(sequences[index].phase_table.phase_array, dtype=float)
+            keys = controller.get_signal_keys(xdis, pulse_plan, phase_table)
+            for key, phases in zip(keys, phase_table):
+                users.setdefault(key, set()).add(index)
+                if key in signals or key in jobs:
+                    continue
+                signal = controller.signal_cache.lookup(key)
+                if signal is None:
+                    jobs[key] = (sample, xdis, pulse_plan, phases)
+                else:
+                    signals[key] = signal
+
+        logger.debug(
+            f"Simulating {len(jobs)} phase cycles of {len(prepared)} sequences on {min(workers, max(len(jobs), 1))} workers"
+        )
+
+        # The run time of a job grows with its number of simulation points
+        order = sorted(jobs, key=lambda key: jobs[key][2].n_points, reverse=True)
+        failures = dict()
+        with stats.stage("propagation"):
+            if workers <= 1 or len(jobs) <= 1:
+                for key in order:
+                    try:
+                        simulation = controller.get_cycle_simulation(*jobs[key])
+                        simulation.propagator_cache = controller.get_propagator_cache()
+                        simulation.checkpoint_cache = controller.get_checkpoint_cache()
+                        signals[key] = simulate_cycle(simulation)
+                    except Exception as e:
+                        failures[key] = e
+            else:
+                with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+                    futures = dict()
+                    for key in order:
+                        try:
+                            simulation = controller.get_cycle_simulation(*jobs[key])
+                        except Exception as e:
+                            failures[key] = e
+                            continue
+                        futures[key] = executor.submit(simulate_cycle, simulation)
+                    for key, future in futures.items():
+                        try:
+                            signals[key] = future.result()
+                        except Exception as e:
+                            failures[key] = e
+
+        for key in order:
+            if key in signals:
+                controller.signal_cache.put(key, signals[key])
+        for key, error in failures.items():
+            for index in users[key]:
+                logger.warning(f"Sequence {index} of the batch: {error}")
+                errors.setdefault(index, f"Simulation failed: {error}")
+
+        measurements = [None] * len(sequences)
+        for index, sequence in enumerate(sequences):
+            if index in errors:
+                continue
+            try:
+                tdx, weights, readouts = controller.get_readouts(
+                    sequence, stats, prepared[index], signals
+                )
+                tdy = controller.allocate_datasets(sequence, tdx, weights)
+                for cycle, readout in enumerate(readouts):
+                    tdy[:, cycle] = readout
+                measurements[index] = controller.create_measurement(
+                    sequence, tdx, tdy, weights, stats
+                )
+            except Exception as e:
+                logger.warning(f"Sequence {index} of the batch: {e}")
+                errors[index] = f"Assembly failed: {e}"
+    finally:
+        stats.stop()
+
+    return BatchResult(measurements, dict(sorted(errors.items())))
@@ -0,0 +1,830 @@
+"""Vectorized Bloch simulation of the phase cycles of a pulse sequence."""
+
+import hashlib
+import logging
+from contextlib import contextmanager
+import numpy as np
+
+from nqr_blochsimulator import Sample, Simulation
+
+from .cache import SetupCache
+from .samples import SampleDefinition
+
+logger = logging.getLogger(__name__)
+
+# The floating point types of the precision setting
+PRECISION_DTYPES = {"double": np.float64, "single": np.float32}
+
+# The permeability of free space in H/m
+VACUUM_PERMEABILITY = 4 * np.pi * 1e-7
+
+
+# The independent streams of random numbers that are derived from the seed of a run
+NOISE_STREAM = 0
+ISOCHROMAT_STREAM = 1
+
+
+def child_seed(seed_sequence: np.random.SeedSequence, *keys: int) -> np.random.SeedSequence:
+    """Returns the child of a seed sequence for the keys.
+
+    Unlike SeedSequence.spawn, the child does not depend on how many children were spawned before, so the same keys always give the same child in every process.
+
+    Args:
+        seed_sequence (np.random.SeedSequence): The parent seed sequence.
+        *keys (int): The keys that are appended to the spawn key of the parent, e.g. the stream and the phase cycle.
+
+    Returns:
+        np.random.SeedSequence: The child seed sequence.
+    """
+    return np.random.SeedSequence(
+        seed_sequence.entropy,
+        spawn_key=tuple(seed_sequence.spawn_key) + keys,
+        pool_size=seed_sequence.pool_size,
+    )
+
+
+def draw_noise(
+    noise: float, n_points: int, averages: int, seed_sequence: np.random.SeedSequence
+) -> np.ndarray:
+    """Draws the noise of a phase cycle summed over the averages.
+
+    The noise of the averages is independent and normal distributed, so its sum is normal distributed with a standard deviation that is sqrt(averages) times the one of a single average.
+    It is therefore drawn once instead of once per average, with the same distribution as Simulation.calculate_noise.
+
+    Args:
+        noise (float): The RMS noise of a single average in µV.
+        n_points (int): The number of points of the signal.
+        averages (int): The number of averages.
+        seed_sequence (np.random.SeedSequence): The seed sequence of the phase cycle.
+
+    Returns:
+        np.ndarray: The complex noise of the signal with shape (n_points,).
+    """
+    generator = np.random.default_rng(seed_sequence)
+    scale = noise * 1e-6 * np.sqrt(averages)
+    return scale * (
+        generator.standard_normal(n_points) + 1j * generator.standard_normal(n_points)
+    )
+
+
+def add_noise(
+    signal: np.ndarray,
+    noise: float,
+    averages: int,
+    gain: float,
+    conversion_factor: float,
+    seeds: list,
+) -> np.ndarray:
+    """Turns the noiseless signal of a single average into the signal of the receiver.
+
+    The signal scales with the number of averages and the noise with the square root of the averages. Both are amplified by the gain and converted into spectrometer units.
+
+    Args:
+        signal (np.ndarray): The noiseless signal of a single average in V with shape (n_cycles, n_points).
+        noise (float): The RMS noise of a single average in µV.
+        averages (int): The number of averages.
+        gain (float): The gain of the receiver.
+        conversion_factor (float): The conversion factor of the receiver in spectrometer units / V.
+        seeds (list): The seed sequence of every phase cycle.
+
+    Returns:
+        np.ndarray: The signal of the receiver with shape (n_cycles, n_points).
+    """
+    noise_data = np.zeros_like(signal)
+    if noise:
+        for cycle, seed in enumerate(seeds):
+            noise_data[cycle] = draw_noise(noise, signal.shape[1], averages, seed)
+
+    signal = (signal * averages * gain) + (noise_data * gain)
+    return signal * conversion_factor
+
+
+@contextmanager
+def random_state(seed: int):
+    """Seeds the global NumPy random state for the duration of the context.
+
+    The previous random state is restored afterwards.
+
+    Args:
+        seed (int): The seed of the random state. If None, the random state is not touched.
+    """
+    if seed is None:
+        yield
+        return
+
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def cis(angle: np.ndarray) -> np.ndarray:
+    """Returns exp(i angle) of a real array.
+
+    This is faster than np.exp of the imaginary array, in particular in single precision.
+
+    Args:
+        angle (np.ndarray): The angles in radians.
+
+    Returns:
+        np.ndarray: The complex phase factors in the complex type of the angles.
+    """
+    factors = np.empty(angle.shape, dtype=np.result_type(angle.dtype, np.complex64))
+    np.cos(angle, out=factors.real)
+    np.sin(angle, out=factors.imag)
+    return factors
+
+
+def calculate_xdis(sample: Sample, number_isochromats: int, gradient: float) -> np.ndarray:
+    """Draws the distribution of the isochromats.
+
+    This is the same Lorentzian distribution that Simulation.calc_xdis draws, but it can be calculated before the simulation is run.
+
+    Args:
+        sample (Sample): The sample of the simulation.
+        number_isochromats (int): The number of isochromats.
+        gradient (float): The gradient of the simulation in mT/m.
+
+    Returns:
+        np.ndarray: The x distribution of the isochromats with shape (1, number_isochromats).
+    """
+    # Df is the Full Width at Half Maximum (FWHM) of Lorentzian in Hz
+    Df = 1 / np.pi / sample.T2_star
+
+    uu = np.random.rand(number_isochromats, 1) - 0.5
+    foffr = Df / 2 * np.tan(np.pi * uu)
+
+    # The simulation works with gamma in MHz/T
+    gamma = sample.gamma * 1e-6
+    xdis = (foffr.T * 1e-6) / (gamma / 2 / np.pi) / (gradient * 1e-3)
+
+    return xdis
+
+
+def step_propagator(
+    b1: np.ndarray, K: np.ndarray, decay: np.ndarray, recovery: float
+) -> tuple:
+    """Calculates the affine map of one symmetric Strang splitting step.
+
+    A step rotates the isochromats by half a dwell time, relaxes them for a full dwell time and rotates them by another half dwell time.
+    This is combined to M' = A M + c.
+
+    Args:
+        b1 (np.ndarray): The pulse rotation of every phase cycle per half step with shape (n_cycles,).
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+
+    Returns:
+        tuple: A with shape (3, 3, n_cycles, n_isochromats) and c with shape (3, n_cycles, n_isochromats).
+    """
+    b1 = b1[:, np.newaxis]
+    phi = -np.sqrt(np.abs(b1) ** 2 + K**2)
+
+    cs = np.cos(phi)
+    si = np.sin(phi)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n1 = np.real(b1) / np.abs(phi)
+        n2 = np.imag(b1) / np.abs(phi)
+        n3 = K / np.abs(phi)
+    n1[np.isnan(n1)] = 1
+    n2[np.isnan(n2)] = 0
+    n3[np.isnan(n3)] = 0
+
+    rotation = np.array(
+        [
+            [
+                n1 * n1 * (1 - cs) + cs,
+                n1 * n2 * (1 - cs) - n3 * si,
+                n1 * n3 * (1 - cs) + n2 * si,
+            ],
+            [
+                n2 * n1 * (1 - cs) + n3 * si,
+                n2 * n2 * (1 - cs) + cs,
+                n2 * n3 * (1 - cs) - n1 * si,
+            ],
+            [
+                n3 * n1 * (1 - cs) - n2 * si,
+                n3 * n2 * (1 - cs) + n1 * si,
+                n3 * n3 * (1 - cs) + cs,
+            ],
+        ]
+    )
+
+    A = np.einsum(
+        "ikcx,kjcx->ijcx", rotation * decay[np.newaxis, :, np.newaxis, np.newaxis], rotation
+    )
+    c = rotation[:, 2] * recovery
+
+    return A, c
+
+
+def propagate(
+    b1: np.ndarray,
+    K: np.ndarray,
+    decay: np.ndarray,
+    recovery: float,
+) -> np.ndarray:
+    """Propagates the isochromats of all phase cycles through the pulse arrays.
+
+    This is the symmetric Strang splitting of Simulation.bloch_symmetric_strang_splitting with an additional phase cycle axis.
+    Only the sum of the transverse magnetization is kept for every step, the magnetization of the single isochromats is not stored.
+
+    Args:
+        b1 (np.ndarray): The pulse rotation per half step with shape (n_cycles, n_points).
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+
+    Returns:
+        np.ndarray: The sum of My + i Mx over the isochromats before every step with shape (n_cycles, n_points).
+    """
+    n_cycles, n_points = b1.shape
+
+    M = np.zeros((3, n_cycles, K.size), dtype=K.dtype)
+    M[2] = 1
+
+    signal = np.empty((n_cycles, n_points), dtype=b1.dtype)
+    step_through(M, b1, K, decay, recovery, signal)
+
+    return signal
+
+
+def step_through(
+    M: np.ndarray,
+    b1: np.ndarray,
+    K: np.ndarray,
+    decay: np.ndarray,
+    recovery: float,
+    signal: np.ndarray,
+) -> np.ndarray:
+    """Propagates the isochromats step by step.
+
+    Args:
+        M (np.ndarray): The magnetization at the first step with shape (3, n_cycles, n_isochromats).
+        b1 (np.ndarray): The pulse rotation per half step with shape (n_cycles, n_steps).
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+        signal (np.ndarray): The sum of My + i Mx before every step is written into this array with shape (n_cycles, n_steps).
+
+    Returns:
+        np.ndarray: The magnetization after the last step.
+    """
+    n_steps = b1.shape[1]
+
+    # The propagator only has to be calculated again when the pulse changes
+    changes = np.ones(n_steps, dtype=bool)
+    changes[1:] = np.any(b1[:, 1:] != b1[:, :-1], axis=0)
+
+    for n in range(n_steps):
+        transverse = M[:2].sum(axis=-1)
+        signal[:, n] = transverse[1] + 1j * transverse[0]
+
+        if changes[n]:
+            A, c = step_propagator(b1[:, n], K, decay, recovery)
+
+        M = np.einsum("ijcx,jcx->icx", A, M) + c
+
+    return M
+
+
+def precess_free(
+    M: np.ndarray,
+    n_steps: int,
+    K: np.ndarray,
+    decay: np.ndarray,
+    recovery: float,
+    signal: np.ndarray,
+    block_size: int = 256,
+) -> np.ndarray:
+    """Propagates the isochromats through steps without a pulse in closed form.
+
+    Without a pulse a step is a rotation around z by the off resonance of the isochromat and the relaxation, which commute.
+    The transverse magnetization of step n is therefore (E2 exp(-2iK))^n times the initial one and the z magnetization relaxes exponentially towards its fixed point.
+    The signal of the steps is calculated in blocks of steps as a matrix product with the phase factors of the block.
+
+    Args:
+        M (np.ndarray): The magnetization at the first step with shape (3, n_cycles, n_isochromats).
+        n_steps (int): The number of steps.
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+        signal (np.ndarray): The sum of My + i Mx before every step is written into this array with shape (n_cycles, n_steps). If None, only the magnetization after the last step is calculated.
+        block_size (int): The number of steps whose phase factors are kept in memory at once.
+
+    Returns:
+        np.ndarray: The magnetization after the last step.
+    """
+    E2, E1 = decay[0], decay[2]
+
+    if signal is not None:
+        # My + i Mx is i conj(Mx + i My), so its phase advances with exp(2iK)
+        transverse = M[0] - 1j * M[1]
+        steps = np.arange(min(block_size, n_steps), dtype=K.dtype)
+        phase_factors = cis(2 * np.outer(K, steps))
+        block_advance = cis(2 * K * len(steps))
+
+        for start in range(0, n_steps, len(steps)):
+            stop = min(start + len(steps), n_steps)
+            relaxation = E2 ** np.arange(start, stop, dtype=K.dtype)
+            # One product per phase cycle, so the rounding does not depend on the number of phase cycles
+            for cycle in range(len(transverse)):
+                signal[cycle, start:stop] = (
+                    1j * (transverse[cycle] @ phase_factors[:, : stop - start]) * relaxation
+                )
+            transverse = transverse * block_advance
+
+    # The magnetization after the last step is advanced from the first step in one go
+    transverse = (M[0] - 1j * M[1]) * cis(2 * K * n_steps) * E2**n_steps
+    fixed_point = recovery / (1 - E1)
+
+    M_end = np.empty_like(M)
+    M_end[0] = transverse.real
+    M_end[1] = -transverse.imag
+    M_end[2] = fixed_point + (M[2] - fixed_point) * E1**n_steps
+    return M_end
+
+
+class SegmentPropagator:
+    """The propagator of a rectangular pulse segment for every isochromat.
+
+    The propagator is calculated for a pulse with phase zero. A pulse with another phase rotates around an axis that is rotated around z, so its propagator is the same one in a frame rotated by the phase.
+
+    Args:
+        b1_magnitude (float): The magnitude of the pulse rotation per half step.
+        n_steps (int): The number of steps of the segment.
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+
+    Attributes:
+        transverse_powers (np.ndarray): The transverse rows of A^n for every step n with shape (n_steps, 2, 3, n_isochromats).
+        transverse_offsets (np.ndarray): The transverse magnetization the recovery adds until step n, summed over the isochromats with shape (n_steps, 2).
+        A (np.ndarray): The linear part of the map of the whole segment with shape (3, 3, n_isochromats).
+        c (np.ndarray): The offset of the map of the whole segment with shape (3, n_isochromats).
+    """
+
+    def __init__(
+        self,
+        b1_magnitude: float,
+        n_steps: int,
+        K: np.ndarray,
+        decay: np.ndarray,
+        recovery: float,
+    ) -> None:
+        """Initializes the SegmentPropagator."""
+        A, c = step_propagator(np.array([b1_magnitude]), K, decay, recovery)
+        A, c = A[:, :, 0], c[:, 0]
+
+        self.transverse_powers = np.empty((n_steps, 2, 3, K.size), dtype=K.dtype)
+        self.transverse_offsets = np.empty((n_steps, 2), dtype=K.dtype)
+
+        power = np.broadcast_to(np.eye(3, dtype=K.dtype)[:, :, np.newaxis], A.shape).copy()
+        offset = np.zeros_like(c)
+        for n in range(n_steps):
+            self.transverse_powers[n] = power[:2]
+            self.transverse_offsets[n] = offset[:2].sum(axis=-1)
+            power = np.einsum("ikx,kjx->ijx", A, power)
+            offset = np.einsum("ijx,jx->ix", A, offset) + c
+
+        self.A = power
+        self.c = offset
+
+    @property
+    def nbytes(self) -> int:
+        """The memory of the propagator in bytes."""
+        return (
+            self.transverse_powers.nbytes
+            + self.transverse_offsets.nbytes
+            + self.A.nbytes
+            + self.c.nbytes
+        )
+
+    def propagate(self, M: np.ndarray, phase: np.ndarray) -> tuple:
+        """Propagates the isochromats through the segment.
+
+        Args:
+            M (np.ndarray): The magnetization at the first step with shape (3, n_cycles, n_isochromats).
+            phase (np.ndarray): The phase of the pulse rotation of every phase cycle in radians with shape (n_cycles,).
+
+        Returns:
+            tuple: The magnetization after the last step and the sum of My + i Mx before every step with shape (n_cycles, n_steps).
+        """
+        # Rotate into the frame in which the pulse has phase zero
+        frame = np.exp(-1j * phase)[:, np.newaxis]
+        transverse = (M[0] + 1j * M[1]) * frame
+        M_frame = np.stack((transverse.real, transverse.imag, M[2]))
+
+        # One product per phase cycle, so the rounding does not depend on the number of phase cycles
+        signal_frame = np.empty((len(self.transverse_powers), len(phase), 2), dtype=M.dtype)
+        for cycle in range(len(phase)):
+            signal_frame[:, cycle] = np.einsum(
+                "nijx,jx->ni", self.transverse_powers, M_frame[:, cycle], optimize=True
+            )
+        signal_frame += self.transverse_offsets[:, np.newaxis, :]
+        signal = ((signal_frame[..., 1] + 1j * signal_frame[..., 0]) * frame.T).T
+
+        M_frame = np.einsum("ijx,jcx->icx", self.A, M_frame) + self.c[:, np.newaxis]
+
+        # Rotate back into the frame of the simulation
+        transverse = (M_frame[0] + 1j * M_frame[1]) / frame
+        return np.stack((transverse.real, transverse.imag, M_frame[2])), signal
+
+
+def get_checkpoint_keys(
+    b1: np.ndarray,
+    offsets: np.ndarray,
+    K: np.ndarray,
+    decay: np.ndarray,
+    recovery: float,
+    segment_steps: np.ndarray = None,
+) -> list:
+    """Returns the keys of the state of the isochromats at the end of every segment.
+
+    The state at the end of a segment only depends on the pulse rotation of the segments up to it, the off resonance of the isochromats and the relaxation.
+    The key of a segment is the digest of these, so pulse sequences that share the first events share the keys of these events, as long as the settings and the dwell time are the same.
+
+    Args:
+        b1 (np.ndarray): The pulse rotation per half step with shape (n_cycles, n_points).
+        offsets (np.ndarray): The index of the first point of every segment, followed by the total number of points.
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+        segment_steps (np.ndarray, optional): The number of steps every point of a segment spans. If None, every point is one step.
+
+    Returns:
+        list: The key of the state at the end of every segment.
+    """
+    digest = hashlib.sha1(K.tobytes())
+    digest.update(np.asarray(decay, dtype=np.float64).tobytes())
+    digest.update(np.float64(recovery).tobytes())
+    digest.update(f"{b1.dtype} {K.dtype} {b1.shape[0]}".encode())
+
+    keys = list()
+    for segment, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        steps = 1 if segment_steps is None else int(segment_steps[segment])
+        digest.update(np.array([stop - start, steps], dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(b1[:, start:stop]).tobytes())
+        keys.append(("checkpoint", digest.copy().hexdigest()))
+    return keys
+
+
+def propagate_segments(
+    b1: np.ndarray,
+    offsets: np.ndarray,
+    K: np.ndarray,
+    decay: np.ndarray,
+    recovery: float,
+    propagator_cache: SetupCache = None,
+    segment_steps: np.ndarray = None,
+    checkpoint_cache: SetupCache = None,
+) -> np.ndarray:
+    """Propagates the isochromats segment by segment.
+
+    This is the fast path for sequences of rectangular pulses and blanks. Rectangular pulse segments are propagated with a SegmentPropagator and segments without a pulse are propagated in closed form.
+    The propagators are keyed on the magnitude of the pulse, the number of steps, the off resonance of the isochromats and the relaxation, so phase cycles and repeated runs with the same cache share them.
+    Segments of shaped pulses are propagated step by step.
+
+    Args:
+        b1 (np.ndarray): The pulse rotation per half step with shape (n_cycles, n_points).
+        offsets (np.ndarray): The index of the first point of every segment, followed by the total number of points.
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+        propagator_cache (SetupCache, optional): The cache of the segment propagators. If None, the propagators are only shared within the call.
+        segment_steps (np.ndarray, optional): The number of steps every point of a segment spans. Only segments without a pulse can span more than one step. If None, every point is one step.
+        checkpoint_cache (SetupCache, optional): The cache of the state of the isochromats and the signal at the end of the segments. If given, the propagation resumes from the last segment whose state is cached and the state at the end of every following segment is cached.
+
+    Returns:
+        np.ndarray: The sum of My + i Mx over the isochromats before every point with shape (n_cycles, n_points).
+    """
+    n_cycles, n_points = b1.shape
+    if propagator_cache is None:
+        propagator_cache = SetupCache()
+
+    # The key of everything the propagators depend on besides the pulse
+    K_key = hashlib.sha1(K.tobytes()).hexdigest()
+    decay_key = (tuple(decay), float(recovery))
+
+    M = np.zeros((3, n_cycles, K.size), dtype=K.dtype)
+    M[2] = 1
+
+    signal = np.empty((n_cycles, n_points), dtype=b1.dtype)
+
+    # The segments up to the last checkpoint are not propagated again
+    first_segment = 0
+    checkpoint_keys = None
+    if checkpoint_cache is not None:
+        checkpoint_keys = get_checkpoint_keys(b1, offsets, K, decay, recovery, segment_steps)
+        for segment in reversed(range(len(checkpoint_keys))):
+            checkpoint = checkpoint_cache.lookup(checkpoint_keys[segment])
+            if checkpoint is not None:
+                M_checkpoint, signal_checkpoint = checkpoint
+                M = M_checkpoint.copy()
+                signal[:, : offsets[segment + 1]] = signal_checkpoint
+                first_segment = segment + 1
+                logger.debug(f"Resuming the propagation after segment {segment}")
+                break
+
+    for segment in range(first_segment, len(offsets) - 1):
+        M = propagate_segment(
+            M,
+            signal,
+            segment,
+            b1,
+            offsets,
+            K,
+            decay,
+            recovery,
+            propagator_cache,
+            K_key,
+            decay_key,
+            segment_steps,
+        )
+        if checkpoint_keys is not None:
+            checkpoint_cache.put(
+                checkpoint_keys[segment],
+                (M.copy(), signal[:, : offsets[segment + 1]].copy()),
+            )
+
+    return signal
+
+
+def propagate_segment(
+    M: np.ndarray,
+    signal: np.ndarray,
+    segment: int,
+    b1: np.ndarray,
+    offsets: np.ndarray,
+    K: np.ndarray,
+    decay: np.ndarray,
+    recovery: float,
+    propagator_cache: SetupCache,
+    K_key: str,
+    decay_key: tuple,
+    segment_steps: np.ndarray = None,
+) -> np.ndarray:
+    """Propagates the isochromats through one segment of propagate_segments.
+
+    Args:
+        M (np.ndarray): The magnetization at the beginning of the segment with shape (3, n_cycles, n_isochromats).
+        signal (np.ndarray): The signal of all points, the signal of the segment is written into it.
+        segment (int): The index of the segment.
+        b1 (np.ndarray): The pulse rotation per half step with shape (n_cycles, n_points).
+        offsets (np.ndarray): The index of the first point of every segment, followed by the total number of points.
+        K (np.ndarray): The off resonance rotation of every isochromat per half step with shape (n_isochromats,).
+        decay (np.ndarray): The relaxation factors of the x, y and z magnetization per step.
+        recovery (float): The recovery of the z magnetization per step.
+        propagator_cache (SetupCache): The cache of the segment propagators.
+        K_key (str): The digest of the off resonance of the isochromats.
+        decay_key (tuple): The relaxation of the isochromats.
+        segment_steps (np.ndarray, optional): The number of steps every point of a segment spans.
+
+    Returns:
+        np.ndarray: The magnetization at the end of the segment.
+    """
+    start, stop = offsets[segment], offsets[segment + 1]
+    if stop == start:
+        return M
+
+    segment_b1 = b1[:, start]
+    if not np.all(b1[:, start:stop] == segment_b1[:, np.newaxis]):
+        return step_through(M, b1[:, start:stop], K, decay, recovery, signal[:, start:stop])
+
+    if not np.any(segment_b1):
+        steps = 1 if segment_steps is None else int(segment_steps[segment])
+        if steps == 1:
+            return precess_free(M, stop - start, K, decay, recovery, signal[:, start:stop])
+
+        # Every point spans several steps, only the signal at its beginning is kept
+        for n in range(start, stop):
+            transverse = M[:2].sum(axis=-1)
+            signal[:, n] = transverse[1] + 1j * transverse[0]
+            M = precess_free(M, steps, K, decay, recovery, None)
+        return M
+
+    # The phase cycles only differ in the phase of the pulse, they share the propagator
+    magnitudes = np.abs(segment_b1)
+    for magnitude in np.unique(magnitudes):
+        cycles = magnitudes == magnitude
+        key = ("segment", float(magnitude), int(stop - start), K_key, decay_key)
+        propagator = propagator_cache.get(
+            key,
+            lambda: SegmentPropagator(magnitude, stop - start, K, decay, recovery),
+        )
+        M[:, cycles], signal[cycles, start:stop] = propagator.propagate(
+            M[:, cycles], np.angle(segment_b1[cycles])
+        )
+
+    return M
+
+
+class BlochSimulation(Simulation):
+    """A Bloch simulation that can propagate several phase cycles at once.
+
+    It calculates the same signal as Simulation.simulate. The sample is not modified, the isochromat distribution can be precomputed and the magnetization of the single isochromats is not stored for every step.
+
+    Args:
+        xdis (np.ndarray, optional): The x distribution of the isochromats. If None, a new distribution is drawn when the simulation is run.
+        segment_offsets (np.ndarray, optional): The offsets of the segments the pulse array is constant in. If given, the simulation uses the fast path of propagate_segments.
+        propagator_cache (SetupCache, optional): The cache of the segment propagators of the fast path.
+        segment_steps (np.ndarray, optional): The number of dwell time steps every point of a segment spans, for adaptive time steps on the fast path.
+        checkpoint_cache (SetupCache, optional): The cache of the state of the isochromats at the end of the segments of the fast path, so simulations that share their first events resume from there.
+        dtype (np.dtype): The floating point type of the propagation and of the simulated signal. With np.float32 the signal is complex64.
+        memory_budget (float, optional): The memory the isochromats may use in bytes. If they need more, they are propagated in chunks. If None, all isochromats are propagated at once.
+        sample_definition (SampleDefinition, optional): The definition of the sample, the reference voltage is calculated from its magnetization and amplitude weight. If None, the reference voltage is calculated from the sample as in Simulation.
+    """
+
+    def __init__(
+        self,
+        *args,
+        xdis: np.ndarray = None,
+        segment_offsets: np.ndarray = None,
+        propagator_cache: SetupCache = None,
+        segment_steps: np.ndarray = None,
+        checkpoint_cache: SetupCache = None,
+        dtype: np.dtype = np.float64,
+        memory_budget: float = None,
+        sample_definition: SampleDefinition = None,
+        **kwargs,
+    ) -> None:
+        """Initializes the BlochSimulation."""
+        super().__init__(*args, **kwargs)
+        self.xdis = xdis
+        self.segment_offsets = segment_offsets
+        self.propagator_cache = propagator_cache
+        self.segment_steps = segment_steps
+        self.checkpoint_cache = checkpoint_cache
+        self.dtype = dtype
+        self.memory_budget = memory_budget
+        self.sample_definition = sample_definition
+
+    def calc_xdis(self) -> np.ndarray:
+        """Returns the x distribution of the isochromats."""
+        if self.xdis is None:
+            return calculate_xdis(self.sample, self.number_isochromats, self.gradient)
+
+        return self.xdis
+
+    def calculate_reference_voltage(self) -> float:
+        """Returns the reference voltage of the measurement setup for the sample at the temperature of the simulation.
+
+        The magnetization and the amplitude weight of a sample definition are only calculated once per definition.
+
+        Returns:
+            float: The reference voltage in V.
+        """
+        definition = self.sample_definition
+        if definition is None:
+            return super().calculate_reference_voltage()
+
+        coil_crossection = np.pi * (self.diameter_coil / 2) ** 2
+        reference_voltage = (
+            self.number_turns
+            * coil_crossection
+            * VACUUM_PERMEABILITY
+            * self.sample.resonant_frequency
+            * definition.magnetization(self.temperature)
+            * definition.amplitude_weight
+        )
+        # The noise is assumed to be dominated by everything after the resonator
+        return reference_voltage * np.sqrt(self.q_factor_receive)
+
+    def get_chunk_size(self, b1: np.ndarray, n_isochromats: int) -> int:
+        """Returns the number of isochromats that are propagated at once.
+
+        The memory per isochromat is estimated from the state and the temporary arrays of a step, the phase factors of the free precession and the propagators of the longest pulse segment.
+
+        Args:
+            b1 (np.ndarray): The pulse rotation per half step with shape (n_cycles, n_points).
+            n_isochromats (int): The number of isochromats.
+
+        Returns:
+            int: The number of isochromats of a chunk.
+        """
+        if self.memory_budget is None or n_isochromats == 0:
+            return max(n_isochromats, 1)
+
+        n_cycles = b1.shape[0]
+        max_pulse_steps = 0
+        if self.segment_offsets is not None:
+            for start, stop in zip(self.segment_offsets[:-1], self.segment_offsets[1:]):
+                if stop > start and np.any(b1[:, start:stop]):
+                    max_pulse_steps = max(max_pulse_steps, stop - start)
+
+        values_per_isochromat = 96 * n_cycles + 768 + max_pulse_steps * (6 + 2 * n_cycles)
+        bytes_per_isochromat = values_per_isochromat * np.dtype(self.dtype).itemsize
+
+        chunk_size = int(self.memory_budget // bytes_per_isochromat)
+        chunk_size = min(max(chunk_size, 1), n_isochromats)
+        if chunk_size < n_isochromats:
+            logger.debug(
+                f"Propagating {n_isochromats} isochromats in chunks of {chunk_size}"
+            )
+        return chunk_size
+
+    def simulate(self) -> np.ndarray:
+        """Simulates the pulse array of the simulation.
+
+        Returns:
+            np.ndarray: The simulated time domain signal.
+        """
+        return self.simulate_cycles(self.pulse.pulsephase[np.newaxis, :])[0]
+
+    def simulate_cycles(self, phase_arrays: np.ndarray, seeds: list = None) -> np.ndarray:
+        """Simulates several phase cycles that share the pulse amplitude of the pulse array.
+
+        Args:
+            phase_arrays (np.ndarray): The pulse phase of every phase cycle in radians with shape (n_cycles, n_points).
+            seeds (list, optional): The seed sequence of the noise of every phase cycle. If None, the seed sequences are drawn from the NumPy random state.
+
+        Returns:
+            np.ndarray: The simulated time domain signal of every phase cycle with shape (n_cycles, n_points).
+        """
+        signal = self.simulate_noiseless(phase_arrays)
+
+        if seeds is None:
+            seeds = [
+                np.random.SeedSequence(seed)
+                for seed in np.random.randint(0, 2**31 - 1, size=len(signal))
+            ]
+
+        return add_noise(
+            signal,
+            self.noise,
+            int(self.averages),
+            self.gain,
+            self.conversion_factor,
+            seeds,
+        )
+
+    def simulate_noiseless(self, phase_arrays: np.ndarray) -> np.ndarray:
+        """Simulates the noiseless signal of a single average for several phase cycles.
+
+        Args:
+            phase_arrays (np.ndarray): The pulse phase of every phase cycle in radians with shape (n_cycles, n_points).
+
+        Returns:
+            np.ndarray: The signal in V before the averages, the gain and the noise are applied with shape (n_cycles, n_points).
+        """
+        reference_voltage = self.calculate_reference_voltage()
+        B1 = self.calc_B1() * 1e3
+
+        # The simulation works with gamma in MHz/T and T1 and T2 in ms
+        gamma = self.sample.gamma * 1e-6
+        T1 = self.sample.T1 * 1e3
+        T2 = self.sample.T2 * 1e3
+        dt = self.pulse.dwell_time * 1e3
+
+        xdis = self.calc_xdis()
+
+        # Losses on the pulse
+        pulse_amplitude = self.pulse.pulseamplitude * (1 - 10 ** (-self.loss_TX / 20))
+        real_pulsepower = pulse_amplitude * np.cos(phase_arrays)
+        imag_pulsepower = pulse_amplitude * np.sin(phase_arrays)
+
+        gadt = gamma * dt / 2
+        b1 = gadt * (real_pulsepower - 1j * imag_pulsepower) * B1
+        K = gadt * np.ravel(xdis) * self.gradient * self.gradient
+
+        decay = np.array([np.exp(-1 / T2 * dt), np.exp(-1 / T2 * dt), np.exp(-1 / T1 * dt)])
+        recovery = self.initial_magnetization * (1 - np.exp(-1 / T1 * dt))
+
+        # The parameters are calculated in double precision and rounded once
+        real_dtype = np.dtype(self.dtype)
+        complex_dtype = np.result_type(real_dtype, np.complex64)
+        b1 = b1.astype(complex_dtype, copy=False)
+        K = K.astype(real_dtype, copy=False)
+        decay = decay.astype(real_dtype, copy=False)
+        recovery = real_dtype.type(recovery)
+
+        chunk_size = self.get_chunk_size(b1, K.size)
+        # The cached propagators of many chunks would not fit into the memory budget
+        propagator_cache = self.propagator_cache if chunk_size >= K.size else None
+        checkpoint_cache = self.checkpoint_cache if chunk_size >= K.size else None
+
+        # The isochromats are independent, so the signals of the chunks add up
+        Mtrans_sum = 0
+        for start in range(0, K.size, chunk_size):
+            K_chunk = K[start : start + chunk_size]
+            if self.segment_offsets is None:
+                Mtrans_sum = Mtrans_sum + propagate(b1, K_chunk, decay, recovery)
+            else:
+                Mtrans_sum = Mtrans_sum + propagate_segments(
+                    b1,
+                    self.segment_offsets,
+                    K_chunk,
+                    decay,
+                    recovery,
+                    propagator_cache,
+                    self.segment_steps,
+                    checkpoint_cache,
+                )
+        Mtrans_avg = Mtrans_sum / K.size
+
+        timedomain_signal = Mtrans_avg * reference_voltage
+        timedomain_signal = timedomain_signal * (1 - 10 ** (-self.loss_RX / 20))
+        return timedomain_signal.astype(complex_dtype, copy=False)
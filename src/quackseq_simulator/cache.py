@@ -0,0 +1,159 @@
+"""Caching of the phase independent parts of a simulation."""
+
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def settings_key(model, *categories: str) -> tuple:
+    """Returns a hashable key of the setting values of the model.
+
+    Args:
+        model (SimulatorModel): The model with the settings.
+        *categories (str): If given, only the settings of these categories are part of the key.
+
+    Returns:
+        tuple: The names and values of the settings.
+    """
+    return tuple(
+        (name, setting.value)
+        for name, setting in model.settings.items()
+        if not categories or setting.category in categories
+    )
+
+
+def entry_nbytes(entry) -> int:
+    """Returns the memory of a cache entry in bytes.
+
+    Arrays and objects with an nbytes attribute, e.g. the segment propagators, report their own size. The size of tuples and lists is the sum of their items, other entries are counted as zero bytes.
+
+    Args:
+        entry: The cache entry.
+
+    Returns:
+        int: The memory of the entry in bytes.
+    """
+    nbytes = getattr(entry, "nbytes", None)
+    if nbytes is not None:
+        return int(nbytes)
+    if isinstance(entry, (tuple, list)):
+        return sum(entry_nbytes(item) for item in entry)
+    return 0
+
+
+class SetupCache:
+    """A least recently used cache for the setup work of a simulation.
+
+    The controller stores everything in here that does not depend on the phase of the pulses, e.g. the sample, the dwell time and the isochromat distribution.
+    The keys contain the values of the settings the entry was calculated from, so an entry is not used anymore as soon as one of these settings changes.
+    The cache can be shared by the threads of concurrent runs. Two threads that miss the same key both create the entry and the last one is kept.
+    If the memory of the entries is limited, the least recently used entries are removed until the entries fit and entries that are larger than the limit are not kept at all.
+
+    Args:
+        max_entries (int, optional): The maximum number of entries that are kept. If None, the number of entries is not limited.
+        max_bytes (int, optional): The maximum memory of all entries in bytes. If None, the memory is not limited.
+    """
+
+    def __init__(self, max_entries: int = 64, max_bytes: int = None) -> None:
+        """Initializes the SetupCache."""
+        self.max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = dict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self) -> int:
+        """The maximum memory of all entries in bytes, None if the memory is not limited."""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes: int) -> None:
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def nbytes(self) -> int:
+        """The memory of all entries in bytes."""
+        return self._nbytes
+
+    def get(self, key, factory):
+        """Returns the entry for the key and creates it with the factory if it is not cached.
+
+        Args:
+            key: The hashable key of the entry.
+            factory (callable): Creates the entry if it is not cached.
+
+        Returns:
+            The cached entry.
+        """
+        entry = self.lookup(key)
+        if entry is not None:
+            return entry
+
+        logger.debug("Setup cache miss for %s", key[0])
+        entry = factory()
+        self.put(key, entry)
+        return entry
+
+    def lookup(self, key):
+        """Returns the entry for the key without creating it.
+
+        Args:
+            key: The hashable key of the entry.
+
+        Returns:
+            The cached entry or None if it is not cached.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, entry) -> None:
+        """Stores an entry, the least recently used entries are removed if the cache is full.
+
+        Args:
+            key: The hashable key of the entry.
+            entry: The entry, it is not stored if it is larger than the memory limit of the cache.
+        """
+        nbytes = entry_nbytes(entry)
+        with self._lock:
+            if self._max_bytes is not None and nbytes > self._max_bytes:
+                logger.debug(
+                    "Not caching %s, its %d bytes exceed the limit of the cache", key[0], nbytes
+                )
+                return
+
+            self._nbytes += nbytes - self._sizes.get(key, 0)
+            self._entries[key] = entry
+            self._sizes[key] = nbytes
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        """Removes the least recently used entries until the cache is within its limits, the lock must be held."""
+        while (
+            self.max_entries is not None and len(self._entries) > self.max_entries
+        ) or (
+            self._max_bytes is not None and self._nbytes > self._max_bytes
+        ):
+            key, _ = self._entries.popitem(last=False)
+            self._nbytes -= self._sizes.pop(key)
+
+    def clear(self) -> None:
+        """Removes all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+
+    def __len__(self) -> int:
+        """The number of cached entries."""
+        return len(self._entries)
@@ -0,0 +1,282 @@
+"""A pool of long-lived worker processes with warm simulators."""
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from quackseq.measurement import Measurement, MeasurementError
+from quackseq.pulsesequence import QuackSequence
+
+from .cache import settings_key
+
+logger = logging.getLogger(__name__)
+
+# The simulator of a worker process, it is created when the worker starts and kept for all jobs
+_worker_simulator = None
+_worker_settings = None
+_worker_barrier = None
+
+# The time the workers of a pool may take to start in seconds
+STARTUP_TIMEOUT = 300
+
+
+class SharedResult:
+    """The datasets of a measurement in a shared memory block and the metadata to restore the measurement.
+
+    Only the metadata is sent from the worker to the pool, the datasets are written into shared memory by the worker and read by the pool.
+
+    Args:
+        memory_name (str): The name of the shared memory block.
+        shape (tuple): The shape of the datasets.
+        dtype (str): The type of the datasets.
+        tdx (np.ndarray): The time axis in µs.
+        name (str): The name of the measurement.
+        target_frequency (float): The target frequency of the measurement.
+    """
+
+    def __init__(
+        self,
+        memory_name: str,
+        shape: tuple,
+        dtype: str,
+        tdx: np.ndarray,
+        name: str,
+        target_frequency: float,
+    ) -> None:
+        """Initializes the SharedResult."""
+        self.memory_name = memory_name
+        self.shape = shape
+        self.dtype = dtype
+        self.tdx = tdx
+        self.name = name
+        self.target_frequency = target_frequency
+
+    def to_measurement(self) -> Measurement:
+        """Copies the datasets out of the shared memory block, releases it and creates the measurement.
+
+        Returns:
+            Measurement: The measurement.
+        """
+        memory = shared_memory.SharedMemory(name=self.memory_name)
+        try:
+            tdy = np.ndarray(self.shape, dtype=self.dtype, buffer=memory.buf).copy()
+        finally:
+            memory.close()
+            memory.unlink()
+
+        return Measurement(self.name, self.tdx, tdy, self.target_frequency)
+
+
+def init_worker(settings: tuple, barrier) -> None:
+    """Imports the simulator and creates the simulator of a worker process.
+
+    Args:
+        settings (tuple): The names and values of the base settings of the pool.
+        barrier (multiprocessing.Barrier): The barrier the workers wait at when the pool starts.
+    """
+    global _worker_simulator, _worker_settings, _worker_barrier
+    from .simulator import Simulator
+
+    _worker_simulator = Simulator()
+    # The simulation modules are imported lazily, the worker imports them before its first job
+    _worker_simulator.warm_up()
+    _worker_settings = settings
+    _worker_barrier = barrier
+    logger.debug(f"Simulator pool worker {os.getpid()} started")
+
+
+def warm_up() -> int:
+    """Waits until all workers of the pool are started and initialized.
+
+    A worker that waits at the barrier does not take another task, so the pool has to start a new worker for every task of the warm up.
+
+    Returns:
+        int: The process id of the worker.
+    """
+    _worker_barrier.wait(STARTUP_TIMEOUT)
+    return os.getpid()
+
+
+def run_job(sequence: QuackSequence, settings: dict, averages: int):
+    """Simulates a pulse sequence in a worker process and writes the datasets into shared memory.
+
+    Args:
+        sequence (QuackSequence): The pulse sequence.
+        settings (dict): The settings that differ from the base settings of the pool.
+        averages (int): The number of averages.
+
+    Returns:
+        SharedResult: The result or a MeasurementError if the pulse sequence can not be simulated.
+    """
+    simulator = _worker_simulator
+    controller = simulator.controller
+
+    # The settings of the previous job are reset to the base settings
+    for name, value in _worker_settings:
+        simulator.settings[name].value = value
+    for name, value in settings.items():
+        simulator.settings[name].value = value
+    # The jobs are already distributed over the workers
+    simulator.settings.workers = 1
+    simulator.model.averages = averages
+
+    try:
+        tdx, weights, readouts = controller.get_readouts(sequence)
+    except ValueError as e:
+        logger.warning(str(e))
+        return MeasurementError("Error", str(e))
+
+    shape = (len(tdx), controller.get_n_datasets(sequence, weights))
+    dtype = controller.get_complex_dtype()
+    memory = shared_memory.SharedMemory(
+        create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1)
+    )
+    try:
+        # The readouts are written straight into the shared memory block
+        tdy = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        for cycle, readout in enumerate(readouts):
+            tdy[:, cycle] = readout
+        controller.apply_readout_scheme(tdy, weights)
+        del tdy
+    except BaseException:
+        memory.close()
+        memory.unlink()
+        raise
+    memory.close()
+    # The pool releases the block, the resource tracker of the worker must not remove it.
+    # The tracker knows the block by its POSIX name, which is the name with a leading slash
+    if os.name == "posix":
+        resource_tracker.unregister(f"/{memory.name}", "shared_memory")
+
+    sample, _ = controller.get_sample_setup()
+    return SharedResult(
+        memory.name,
+        shape,
+        dtype.str,
+        tdx,
+        controller.get_measurement_name(sequence),
+        sample.resonant_frequency,
+    )
+
+
+class SimulatorPool:
+    """A pool of worker processes that keep a simulator between jobs.
+
+    The workers import the simulator and create their simulator once when the pool starts, so a job does not pay for the imports and the setup of the settings.
+    The caches of the simulators of the workers are kept between jobs as well.
+    A job is a pulse sequence and the settings that differ from the base settings of the pool. The datasets of the results are returned through shared memory.
+
+    Args:
+        n_workers (int, optional): The number of worker processes, one per core by default.
+        simulator (Simulator, optional): The simulator whose settings and averages are the base of the jobs. If None, the default settings are used.
+
+    Attributes:
+        n_workers (int): The number of worker processes.
+        pids (set): The process ids of the workers.
+        averages (int): The number of averages of jobs that do not set them.
+    """
+
+    def __init__(self, n_workers: int = None, simulator=None) -> None:
+        """Initializes the SimulatorPool and starts the worker processes."""
+        self.n_workers = n_workers or os.cpu_count() or 1
+
+        if simulator is None:
+            from .simulator import Simulator
+
+            simulator = Simulator()
+        settings = settings_key(simulator.model)
+        self.averages = int(simulator.model.averages)
+
+        context = multiprocessing.get_context()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(settings, context.Barrier(self.n_workers)),
+        )
+        # Every worker is started and initialized before the first job is submitted
+        futures = [self._executor.submit(warm_up) for _ in range(self.n_workers)]
+        self.pids = {future.result() for future in futures}
+        logger.debug(f"Simulator pool with {self.n_workers} workers started")
+
+    def submit(
+        self, sequence: QuackSequence, settings: dict = None, averages: int = None
+    ) -> Future:
+        """Submits the simulation of a pulse sequence.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence.
+            settings (dict, optional): The values of the settings that differ from the base settings, keyed by the name of the setting.
+            averages (int, optional): The number of averages, the averages of the pool by default.
+
+        Returns:
+            Future: The future of the Measurement or of a MeasurementError if the pulse sequence can not be simulated.
+        """
+        if averages is None:
+            averages = self.averages
+
+        future = Future()
+        job = self._executor.submit(run_job, sequence, dict(settings or {}), averages)
+
+        # The shared memory block is released as soon as the job is done, even if nobody waits for the result
+        def done(job: Future) -> None:
+            try:
+                result = job.result()
+                if isinstance(result, SharedResult):
+                    result = result.to_measurement()
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            future.set_result(result)
+
+        job.add_done_callback(done)
+        return future
+
+    def run(
+        self, sequence: QuackSequence, settings: dict = None, averages: int = None
+    ) -> Measurement:
+        """Simulates a pulse sequence on a worker and waits for the result.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence.
+            settings (dict, optional): The values of the settings that differ from the base settings.
+            averages (int, optional): The number of averages.
+
+        Returns:
+            Measurement: The measurement or a MeasurementError if the pulse sequence can not be simulated.
+        """
+        return self.submit(sequence, settings, averages).result()
+
+    def map(self, sequences: list, settings: list = None) -> list:
+        """Simulates pulse sequences on the workers.
+
+        Args:
+            sequences (list): The pulse sequences.
+            settings (list, optional): The settings that differ from the base settings for every pulse sequence.
+
+        Returns:
+            list: The measurements in the order of the pulse sequences.
+        """
+        if settings is None:
+            settings = [None] * len(sequences)
+        futures = [
+            self.submit(sequence, job_settings)
+            for sequence, job_settings in zip(sequences, settings)
+        ]
+        return [future.result() for future in futures]
+
+    def close(self) -> None:
+        """Stops the worker processes after the submitted jobs are finished."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "SimulatorPool":
+        """Returns the pool for the with statement."""
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stops the worker processes at the end of the with statement."""
+        self.close()
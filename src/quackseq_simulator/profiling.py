@@ -0,0 +1,175 @@
+"""Timing and memory instrumentation of the stages of a simulation run."""
+
+import logging
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# tracemalloc traces the whole process, so it is shared by all profiled runs and stopped when the last one ends
+_tracing_lock = threading.Lock()
+_traced_runs = 0
+_started_tracing = False
+
+
+class StageStats:
+    """The statistics of one stage of a simulation run.
+
+    Args:
+        name (str): The name of the stage.
+        cycle (int, optional): The phase cycle of the stage, None for stages that are shared by all phase cycles.
+
+    Attributes:
+        wall_time (float): The wall time of the stage in seconds.
+        allocated_bytes (int): The peak of the memory allocated during the stage in bytes.
+        retained_bytes (int): The memory that was still allocated at the end of the stage in bytes.
+        arrays (dict): The shape and size in bytes of the arrays the stage created, keyed by name.
+    """
+
+    def __init__(self, name: str, cycle: int = None) -> None:
+        """Initializes the StageStats."""
+        self.name = name
+        self.cycle = cycle
+        self.wall_time = 0.0
+        self.allocated_bytes = 0
+        self.retained_bytes = 0
+        self.arrays = dict()
+
+    def add_array(self, name: str, array: np.ndarray) -> None:
+        """Records the shape and size of an array of the stage.
+
+        Args:
+            name (str): The name of the array.
+            array (np.ndarray): The array.
+        """
+        self.arrays[name] = {"shape": tuple(array.shape), "nbytes": int(array.nbytes)}
+
+    def as_dict(self) -> dict:
+        """Returns the statistics as a dictionary of plain Python types."""
+        return {
+            "name": self.name,
+            "cycle": self.cycle,
+            "wall_time": self.wall_time,
+            "allocated_bytes": self.allocated_bytes,
+            "retained_bytes": self.retained_bytes,
+            "arrays": self.arrays,
+        }
+
+
+class RunStats:
+    """Collects the statistics of the stages of a simulation run.
+
+    If the statistics are disabled, the stages are not timed and nothing is recorded, so the instrumentation can stay in the code of the controller.
+    Allocated memory is traced with tracemalloc. Memory that worker processes allocate is not part of the statistics.
+    The tracing is shared by all profiled runs of the process and stopped when the last of them ends.
+    The memory is traced for the whole process, so the allocations of a stage are only reliable if one profiled run is active at a time. The wall times of concurrent runs are not affected.
+
+    Args:
+        enabled (bool): True if the statistics are recorded.
+
+    Attributes:
+        stages (list): The StageStats in the order the stages were finished.
+        wall_time (float): The wall time of the whole run in seconds.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        """Initializes the RunStats."""
+        self.enabled = enabled
+        self.stages = list()
+        self.wall_time = 0.0
+        self._start = None
+
+    def start(self) -> None:
+        """Starts the run and the tracing of memory allocations, if no other run traces them."""
+        global _traced_runs, _started_tracing
+        if not self.enabled:
+            return
+
+        with _tracing_lock:
+            if _traced_runs == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _started_tracing = True
+            _traced_runs += 1
+        self._start = time.perf_counter()
+
+    def stop(self) -> None:
+        """Stops the run and the tracing of memory allocations, if it was started by the profiled runs and this is the last of them."""
+        global _traced_runs, _started_tracing
+        if not self.enabled or self._start is None:
+            return
+
+        self.wall_time = time.perf_counter() - self._start
+        self._start = None
+        with _tracing_lock:
+            _traced_runs -= 1
+            if _traced_runs == 0 and _started_tracing:
+                tracemalloc.stop()
+                _started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str, cycle: int = None):
+        """Records the statistics of a stage.
+
+        Stages must not be nested, the peak of the allocated memory is reset at the beginning of every stage.
+
+        Args:
+            name (str): The name of the stage.
+            cycle (int, optional): The phase cycle of the stage.
+
+        Yields:
+            StageStats: The statistics of the stage, arrays of the stage can be added to it.
+        """
+        stage_stats = StageStats(name, cycle)
+        if not self.enabled:
+            yield stage_stats
+            return
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            memory_before, _ = tracemalloc.get_traced_memory()
+
+        start = time.perf_counter()
+        try:
+            yield stage_stats
+        finally:
+            stage_stats.wall_time = time.perf_counter() - start
+            if tracing:
+                memory_after, peak = tracemalloc.get_traced_memory()
+                stage_stats.allocated_bytes = max(peak - memory_before, 0)
+                stage_stats.retained_bytes = memory_after - memory_before
+            self.stages.append(stage_stats)
+
+    def get_stages(self, name: str) -> list:
+        """Returns the statistics of all stages with the name.
+
+        Args:
+            name (str): The name of the stage.
+
+        Returns:
+            list: The StageStats of the stages, e.g. one per phase cycle.
+        """
+        return [stage for stage in self.stages if stage.name == name]
+
+    def summary(self) -> dict:
+        """Returns the wall time and the peak allocation of every stage summed over the phase cycles.
+
+        Returns:
+            dict: The total wall time in seconds and the largest allocation in bytes, keyed by the name of the stage.
+        """
+        summary = dict()
+        for stage in self.stages:
+            entry = summary.setdefault(stage.name, {"wall_time": 0.0, "allocated_bytes": 0})
+            entry["wall_time"] += stage.wall_time
+            entry["allocated_bytes"] = max(entry["allocated_bytes"], stage.allocated_bytes)
+        return summary
+
+    def as_dict(self) -> dict:
+        """Returns the statistics as a dictionary of plain Python types, e.g. to store them as JSON."""
+        return {
+            "wall_time": self.wall_time,
+            "stages": [stage.as_dict() for stage in self.stages],
+        }
@@ -0,0 +1,228 @@
+"""Translation of pulse sequences to the pulse arrays of the Bloch simulation."""
+
+import hashlib
+import logging
+import numpy as np
+
+from quackseq.event import Event
+from quackseq.pulseparameters import TXPulse, RXReadout
+from quackseq.pulsesequence import QuackSequence
+
+from nqr_blochsimulator import PulseArray
+
+logger = logging.getLogger(__name__)
+
+
+def is_free_evolution(sequence: QuackSequence, event: Event) -> bool:
+    """Returns True if the event is a blank that is not recorded.
+
+    Args:
+        sequence (QuackSequence): The pulse sequence the event belongs to.
+        event (Event): The event.
+
+    Returns:
+        bool: True if the event has no pulse and no readout.
+    """
+    tx_pulse = event.parameters.get(sequence.TX_PULSE)
+    if tx_pulse is not None and tx_pulse.get_option_by_name(TXPulse.RELATIVE_AMPLITUDE).value > 0:
+        return False
+
+    readout = event.parameters.get(sequence.RX_READOUT)
+    return readout is None or not readout.get_option_by_name(RXReadout.RX).value
+
+
+class PulsePlan:
+    """The phase independent layout of a pulse sequence on the time grid of the simulation.
+
+    Every event becomes one segment of the pulse array. The segment lengths are known before any array is filled, so the amplitudes of all segments are written into one preallocated buffer.
+    The phases of a phase cycle are filled into a second buffer with the same layout.
+    With adaptive time steps a blank that is not recorded is a single point that spans all of its dwell time steps.
+
+    Args:
+        amplitudes (list): The pulse amplitude of every segment, None for segments without a pulse.
+        lengths (list): The number of simulation points of every segment.
+        pulse_indices (list): The column in the phase table of every segment, -1 for segments without a pulse.
+        dwell_time (float): The dwell time in seconds.
+        steps (list, optional): The number of dwell time steps every point of a segment spans. If None, every point is one step.
+
+    Attributes:
+        offsets (np.ndarray): The index of the first point of every segment, followed by the total number of points.
+        amplitude_array (np.ndarray): The pulse amplitude of all points.
+        piecewise_constant (bool): True if the pulse amplitude is constant within every segment, e.g. for sequences of rectangular pulses and blanks.
+    """
+
+    def __init__(
+        self,
+        amplitudes: list,
+        lengths: list,
+        pulse_indices: list,
+        dwell_time: float,
+        steps: list = None,
+    ) -> None:
+        """Initializes the PulsePlan."""
+        self.lengths = np.asarray(lengths, dtype=int)
+        self.pulse_indices = np.asarray(pulse_indices, dtype=int)
+        self.dwell_time = dwell_time
+        if steps is None:
+            steps = np.ones(len(self.lengths))
+        self.steps = np.asarray(steps, dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+
+        self.amplitude_array = np.zeros(self.n_points)
+        self.piecewise_constant = True
+        for segment, amplitude in enumerate(amplitudes):
+            if amplitude is not None:
+                start, stop = self.offsets[segment], self.offsets[segment + 1]
+                self.amplitude_array[start:stop] = amplitude
+                if np.any(amplitude != amplitude[0]):
+                    self.piecewise_constant = False
+
+    @classmethod
+    def from_events(
+        cls,
+        sequence: QuackSequence,
+        events: list,
+        dwell_time: float,
+        adaptive: bool = False,
+    ) -> "PulsePlan":
+        """Creates the pulse plan of the events of a pulse sequence.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence the events belong to.
+            events (list): The events that are simulated.
+            dwell_time (float): The dwell time in seconds.
+            adaptive (bool): If True, blanks that are not recorded become a single point.
+
+        Returns:
+            PulsePlan: The pulse plan of the events.
+        """
+        amplitudes = list()
+        lengths = list()
+        pulse_indices = list()
+        steps = list()
+
+        # Count the number of TX pulses with relative amplitude > 0
+        n_tx_pulses = 0
+
+        for event in events:
+            tx_pulse = event.parameters.get(sequence.TX_PULSE)
+            if tx_pulse is None:
+                continue
+
+            relative_amplitude = tx_pulse.get_option_by_name(
+                TXPulse.RELATIVE_AMPLITUDE
+            ).value
+
+            if relative_amplitude > 0:
+                pulse_shape = tx_pulse.get_option_by_name(TXPulse.TX_PULSE_SHAPE).value
+                pulse_amplitude = abs(
+                    pulse_shape.get_pulse_amplitude(
+                        event.duration, resolution=dwell_time
+                    )
+                )
+                amplitudes.append(pulse_amplitude)
+                lengths.append(len(pulse_amplitude))
+                # Phase from the phase table - column is the number of the pulse
+                pulse_indices.append(n_tx_pulses)
+                steps.append(1)
+                n_tx_pulses += 1
+
+            elif relative_amplitude == 0:
+                # If we have a wait, the segment stays zero
+                amplitudes.append(None)
+                pulse_indices.append(-1)
+                n_steps = int(event.duration / dwell_time)
+                if adaptive and n_steps > 0 and is_free_evolution(sequence, event):
+                    lengths.append(1)
+                    steps.append(n_steps)
+                else:
+                    lengths.append(n_steps)
+                    steps.append(1)
+
+        logger.debug(f"Pulse plan with {len(lengths)} segments and {n_tx_pulses} pulses")
+
+        return cls(amplitudes, lengths, pulse_indices, dwell_time, steps)
+
+    def get_phase_array(self, phases: np.ndarray) -> np.ndarray:
+        """Returns the pulse phase of all points for one phase cycle.
+
+        Args:
+            phases (np.ndarray): The row of the phase table of the phase cycle in degrees.
+
+        Returns:
+            np.ndarray: The pulse phase of all points in radians.
+        """
+        radians = np.radians(phases)
+        phase_array = np.zeros(self.n_points)
+        for segment in np.flatnonzero(self.pulse_indices >= 0):
+            start, stop = self.offsets[segment], self.offsets[segment + 1]
+            phase_array[start:stop] = radians[self.pulse_indices[segment]]
+
+        return phase_array
+
+    def get_phase_tensor(self, phase_table: np.ndarray) -> np.ndarray:
+        """Returns the pulse phase of all points for all phase cycles at once.
+
+        Args:
+            phase_table (np.ndarray): The phase table in degrees with one row per phase cycle.
+
+        Returns:
+            np.ndarray: The pulse phase in radians with shape (n_cycles, n_points).
+        """
+        radians = np.radians(np.asarray(phase_table, dtype=float))
+        segment_phases = np.zeros((len(radians), self.n_segments))
+        pulses = self.pulse_indices >= 0
+        segment_phases[:, pulses] = radians[:, self.pulse_indices[pulses]]
+
+        return np.repeat(segment_phases, self.lengths, axis=1)
+
+    def get_pulse_array(self, phases: np.ndarray) -> PulseArray:
+        """Returns the pulse array of one phase cycle.
+
+        Args:
+            phases (np.ndarray): The row of the phase table of the phase cycle in degrees.
+
+        Returns:
+            PulseArray: The pulse array of the phase cycle.
+        """
+        return PulseArray(
+            pulseamplitude=self.amplitude_array,
+            pulsephase=self.get_phase_array(phases),
+            dwell_time=float(self.dwell_time),
+        )
+
+    def digest(self) -> str:
+        """Returns a digest of the pulse plan, plans with the same digest give the same pulse arrays.
+
+        Returns:
+            str: The hex digest of the amplitudes, the layout of the segments and the dwell time.
+        """
+        digest = hashlib.sha1(self.amplitude_array.tobytes())
+        for array in (self.lengths, self.pulse_indices, self.steps):
+            digest.update(array.tobytes())
+        digest.update(np.float64(self.dwell_time).tobytes())
+        return digest.hexdigest()
+
+    def get_time_axis(self) -> np.ndarray:
+        """Returns the time at the beginning of every point.
+
+        Returns:
+            np.ndarray: The time of every point in seconds.
+        """
+        point_durations = np.repeat(self.steps * self.dwell_time, self.lengths)
+        return np.cumsum(point_durations) - point_durations
+
+    @property
+    def adaptive(self) -> bool:
+        """True if some points span more than one dwell time step."""
+        return bool(np.any(self.steps > 1))
+
+    @property
+    def n_points(self) -> int:
+        """The total number of simulation points."""
+        return int(self.offsets[-1])
+
+    @property
+    def n_segments(self) -> int:
+        """The number of segments."""
+        return len(self.lengths)
@@ -0,0 +1,214 @@
+"""Storage of simulation results in memory mapped files on disk."""
+
+import json
+import logging
+from pathlib import Path
+import numpy as np
+
+from quackseq.measurement import Measurement
+
+logger = logging.getLogger(__name__)
+
+DATA_SUFFIX = ".npy"
+SIDECAR_SUFFIX = ".json"
+TDX_SUFFIX = ".tdx.npy"
+# Version 2 stores can keep the time axis in a memory mapped file instead of the sidecar
+FORMAT_VERSION = 2
+
+
+def get_paths(path) -> tuple:
+    """Returns the paths of the data file and of the sidecar of a result store.
+
+    Args:
+        path (str or Path): The path of the store, with or without the suffix of the data file or the sidecar.
+
+    Returns:
+        tuple: The path of the .npy data file and the path of the .json sidecar.
+    """
+    path = Path(path)
+    if path.suffix in (DATA_SUFFIX, SIDECAR_SUFFIX):
+        path = path.with_suffix("")
+    return (
+        path.with_name(path.name + DATA_SUFFIX),
+        path.with_name(path.name + SIDECAR_SUFFIX),
+    )
+
+
+def get_tdx_path(path) -> Path:
+    """Returns the path of the memory mapped time axis of a result store.
+
+    Args:
+        path (str or Path): The path of the store, with or without the suffix of the data file or the sidecar.
+
+    Returns:
+        Path: The path of the .tdx.npy file.
+    """
+    data_path, _ = get_paths(path)
+    return data_path.with_name(data_path.name[: -len(DATA_SUFFIX)] + TDX_SUFFIX)
+
+
+def to_json(value):
+    """Converts the values of numpy types that json can not serialize.
+
+    Args:
+        value: The value that json could not serialize.
+
+    Returns:
+        The value as a plain Python type.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class ResultStore:
+    """A simulation result that is stored on disk.
+
+    The time domain data is a memory mapped .npy file, which is written while the phase cycles are simulated and never has to fit in memory.
+    A JSON sidecar next to it holds the name of the sequence, the settings, the time axis and anything else of the metadata.
+    Time axes that are too large for the sidecar, e.g. the time axes of all points of a sweep, are kept in a second memory mapped .tdx.npy file.
+    The sidecar is marked complete when the store is flushed, so stores of interrupted runs can be recognized.
+
+    Args:
+        path (str or Path): The path of the store.
+        tdy (np.memmap): The memory mapped time domain data.
+        metadata (dict): The metadata of the result.
+        tdx (np.memmap, optional): The memory mapped time axis, None if the time axis is in the sidecar.
+
+    Attributes:
+        data_path (Path): The path of the .npy data file.
+        sidecar_path (Path): The path of the .json sidecar.
+        tdy (np.memmap): The memory mapped time domain data.
+        metadata (dict): The metadata of the result.
+    """
+
+    def __init__(
+        self, path, tdy: np.memmap, metadata: dict, tdx: np.memmap = None
+    ) -> None:
+        """Initializes the ResultStore."""
+        self.data_path, self.sidecar_path = get_paths(path)
+        self.tdy = tdy
+        self.metadata = metadata
+        self._tdx = tdx
+
+    @classmethod
+    def create(
+        cls,
+        path,
+        shape: tuple,
+        dtype: np.dtype,
+        metadata: dict,
+        tdx_shape: tuple = None,
+    ) -> "ResultStore":
+        """Creates a new store, existing files of the store are overwritten.
+
+        Args:
+            path (str or Path): The path of the store.
+            shape (tuple): The shape of the time domain data.
+            dtype (np.dtype): The type of the time domain data.
+            metadata (dict): The metadata of the result, it must be serializable as JSON.
+            tdx_shape (tuple, optional): The shape of a memory mapped time axis, by default the time axis is written to the sidecar.
+
+        Returns:
+            ResultStore: The store, writable until it is flushed.
+        """
+        data_path, _ = get_paths(path)
+        data_path.parent.mkdir(parents=True, exist_ok=True)
+        tdy = np.lib.format.open_memmap(data_path, mode="w+", dtype=dtype, shape=shape)
+
+        metadata = dict(metadata, version=FORMAT_VERSION, complete=False)
+        tdx = None
+        if tdx_shape is not None:
+            tdx_path = get_tdx_path(path)
+            tdx = np.lib.format.open_memmap(
+                tdx_path, mode="w+", dtype=float, shape=tdx_shape
+            )
+            metadata["tdx_file"] = tdx_path.name
+
+        store = cls(path, tdy, metadata, tdx)
+        store.write_sidecar()
+        logger.debug(f"Created result store {data_path} with shape {shape}")
+        return store
+
+    @classmethod
+    def open(cls, path, mode: str = "r") -> "ResultStore":
+        """Opens an existing store without reading the time domain data into memory.
+
+        Args:
+            path (str or Path): The path of the store.
+            mode (str, optional): The mode of the memory map, "r" for read only or "r+" to modify the data.
+
+        Returns:
+            ResultStore: The store.
+
+        Raises:
+            ValueError: If the store was written by a newer version of the simulator.
+        """
+        data_path, sidecar_path = get_paths(path)
+        with open(sidecar_path) as file:
+            metadata = json.load(file)
+
+        if metadata.get("version", FORMAT_VERSION) > FORMAT_VERSION:
+            raise ValueError(
+                f"Result store {data_path} has version {metadata['version']}, only version {FORMAT_VERSION} is supported"
+            )
+        if not metadata.get("complete", False):
+            logger.warning(f"Result store {data_path} is incomplete")
+
+        tdy = np.load(data_path, mmap_mode=mode)
+        tdx = None
+        if "tdx_file" in metadata:
+            tdx = np.load(data_path.with_name(metadata["tdx_file"]), mmap_mode=mode)
+        return cls(path, tdy, metadata, tdx)
+
+    @property
+    def tdx(self) -> np.ndarray:
+        """The time axis in µs, memory mapped if the store has a .tdx.npy file."""
+        if self._tdx is not None:
+            return self._tdx
+        return np.asarray(self.metadata["tdx"], dtype=float)
+
+    @property
+    def sequence_name(self) -> str:
+        """The name of the simulated pulse sequence."""
+        return self.metadata.get("sequence")
+
+    @property
+    def settings(self) -> dict:
+        """The values of the settings of the simulator, keyed by the name of the setting."""
+        return self.metadata.get("settings", dict())
+
+    @property
+    def complete(self) -> bool:
+        """True if the store was flushed after all data was written."""
+        return self.metadata.get("complete", False)
+
+    def write_sidecar(self) -> None:
+        """Writes the metadata to the sidecar."""
+        with open(self.sidecar_path, "w") as file:
+            json.dump(self.metadata, file, indent=2, default=to_json)
+
+    def flush(self) -> None:
+        """Writes the time domain data to disk and marks the store as complete."""
+        self.tdy.flush()
+        if self._tdx is not None:
+            self._tdx.flush()
+        self.metadata["complete"] = True
+        self.write_sidecar()
+
+    def to_measurement(self) -> Measurement:
+        """Loads the result into a measurement.
+
+        The measurement holds the time domain data and its spectrum in memory, so this is only meant for results that fit in memory.
+
+        Returns:
+            Measurement: The measurement of the stored result.
+        """
+        return Measurement(
+            self.metadata.get("name", self.sequence_name),
+            self.tdx,
+            np.array(self.tdy),
+            self.metadata["target_frequency"],
+        )
@@ -0,0 +1,377 @@
+"""A library of named and versioned sample definitions."""
+
+import functools
+import json
+import logging
+from dataclasses import dataclass, replace
+from functools import cached_property
+from math import pi
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# The samples that are shipped with the simulator
+SAMPLES_PATH = Path(__file__).with_name("samples.json")
+FORMAT_VERSION = 1
+DEFAULT_SAMPLE = "BiPh3"
+
+AVOGADRO = 6.022e23
+
+# The names of the sample settings of the SimulatorModel, besides the name of the sample
+SAMPLE_PARAMETERS = (
+    "n_atoms",
+    "density",
+    "molar_mass",
+    "resonant_frequency",
+    "gamma",
+    "nuclear_spin",
+    "spin_factor",
+    "powder_factor",
+    "filling_factor",
+    "T1",
+    "T2",
+    "T2_star",
+)
+
+
+@dataclass(frozen=True, eq=False, repr=False)
+class SampleDefinition:
+    """The physical parameters of a sample and the quantities derived from them.
+
+    The parameters are given in the units of the sample settings of the SimulatorModel.
+    The derived quantities are calculated on first use and kept, so a definition that is used again, e.g. from a SampleLibrary, does not calculate them again.
+    A definition is immutable, use dataclasses.replace for a changed copy.
+
+    Args:
+        name (str): The name of the sample.
+        n_atoms (float): The number of atoms per unit volume in 1/m^3, zero to calculate it from the density and the molar mass.
+        density (float): The density in g/m^3.
+        molar_mass (float): The molar mass in g/mol.
+        resonant_frequency (float): The resonant frequency in MHz.
+        gamma (float): The gyromagnetic ratio in MHz/T.
+        nuclear_spin (str): The nuclear spin quantum number, e.g. "9/2".
+        spin_factor (float): The spin transition factor.
+        powder_factor (float): The powder factor.
+        filling_factor (float): The filling factor of the coil.
+        T1 (float): The longitudinal relaxation time in µs.
+        T2 (float): The transverse relaxation time in µs.
+        T2_star (float): The effective transverse relaxation time in µs.
+        version (int, optional): The version of the definition, it is increased when the parameters of a sample are revised.
+        description (str, optional): A description of the sample.
+    """
+
+    name: str
+    n_atoms: float
+    density: float
+    molar_mass: float
+    resonant_frequency: float
+    gamma: float
+    nuclear_spin: str
+    spin_factor: float
+    powder_factor: float
+    filling_factor: float
+    T1: float
+    T2: float
+    T2_star: float
+    version: int = None
+    description: str = ""
+
+    @classmethod
+    def from_settings(cls, settings) -> "SampleDefinition":
+        """Creates the definition of the sample settings of a simulator.
+
+        Args:
+            settings (SimulatorSettings): The snapshot of the settings of the simulator.
+
+        Returns:
+            SampleDefinition: The definition of the sample, it has no version.
+        """
+        parameters = {name: getattr(settings, name) for name in SAMPLE_PARAMETERS}
+        return cls(settings.sample_name, **parameters)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SampleDefinition":
+        """Creates a definition from its entry in a sample file.
+
+        Args:
+            data (dict): The name, version, description and parameters of the sample.
+
+        Returns:
+            SampleDefinition: The definition of the sample.
+
+        Raises:
+            ValueError: If a parameter is missing or unknown.
+        """
+        keys = ("name", "version", "description") + SAMPLE_PARAMETERS
+        missing = [key for key in SAMPLE_PARAMETERS if key not in data]
+        unknown = [key for key in data if key not in keys]
+        if missing or unknown:
+            raise ValueError(
+                f"Sample {data.get('name')} has missing parameters {missing} and unknown parameters {unknown}"
+            )
+        return cls(**data)
+
+    def as_dict(self) -> dict:
+        """Returns the entry of the definition in a sample file."""
+        return dict(
+            name=self.name,
+            version=self.version,
+            description=self.description,
+            **self.parameters,
+        )
+
+    def as_settings(self) -> dict:
+        """Returns the values of the sample settings of the SimulatorModel, keyed by the name of the setting."""
+        return dict(sample_name=self.name, **self.parameters)
+
+    @property
+    def parameters(self) -> dict:
+        """The values of the SAMPLE_PARAMETERS, keyed by their name."""
+        return {key: getattr(self, key) for key in SAMPLE_PARAMETERS}
+
+    @property
+    def key(self) -> tuple:
+        """The name and the parameters of the sample, definitions with the same key describe the same sample."""
+        return (self.name,) + tuple(self.parameters.values())
+
+    def __repr__(self) -> str:
+        """Returns the name and the version of the sample."""
+        return f"SampleDefinition({self.name!r}, version={self.version!r})"
+
+    @cached_property
+    def spin(self) -> float:
+        """The nuclear spin quantum number."""
+        numerator, denominator = self.nuclear_spin.split("/")
+        return float(numerator) / float(denominator)
+
+    @cached_property
+    def atom_density(self) -> float:
+        """The number of atoms per unit volume in 1/m^3, from the density and the molar mass if the number of atoms is zero."""
+        if self.n_atoms:
+            return float(self.n_atoms)
+        return AVOGADRO * self.density / self.molar_mass
+
+    @cached_property
+    def linewidth(self) -> float:
+        """The full width at half maximum of the Lorentzian line in Hz, it follows from T2*."""
+        return 1 / pi / (self.T2_star * 1e-6)
+
+    @cached_property
+    def magnetization_factor(self) -> float:
+        """The magnetization of the sample times the temperature in the high temperature approximation.
+
+        This is the magnetization that the reference voltage of the simulation is calculated from, before it is divided by the temperature.
+        """
+        from scipy.constants import Boltzmann, h
+
+        gamma = self.gamma * 1e6
+        frequency = self.resonant_frequency * 1e6
+        return (
+            (gamma * 2 * self.atom_density)
+            / (2 * self.spin + 1)
+            * (h**2 * frequency)
+            / Boltzmann
+            * self.spin_factor
+        )
+
+    @cached_property
+    def amplitude_weight(self) -> float:
+        """The factor of the signal amplitude for the powder averaging and the filling of the coil."""
+        return self.powder_factor * self.filling_factor
+
+    def magnetization(self, temperature: float) -> float:
+        """Returns the magnetization of the sample.
+
+        Args:
+            temperature (float): The temperature of the sample in K.
+
+        Returns:
+            float: The magnetization in the high temperature approximation.
+        """
+        return self.magnetization_factor / temperature
+
+    @cached_property
+    def sample(self):
+        """The Sample of the Bloch simulator, the simulations of the simulator do not modify it, so it is shared by them."""
+        from nqr_blochsimulator import Sample
+
+        return Sample(
+            name=self.name,
+            atoms=self.n_atoms,
+            density=self.density,
+            molar_mass=self.molar_mass,
+            resonant_frequency=self.resonant_frequency,
+            gamma=self.gamma,
+            nuclear_spin=self.nuclear_spin,
+            spin_factor=self.spin_factor,
+            powder_factor=self.powder_factor,
+            filling_factor=self.filling_factor,
+            T1=self.T1,
+            T2=self.T2,
+            T2_star=self.T2_star,
+        )
+
+
+class SampleLibrary:
+    """A collection of sample definitions, every sample can have several versions.
+
+    The definitions are kept by the library, so the quantities that are derived from them are calculated once per definition.
+
+    Args:
+        definitions (list, optional): The sample definitions of the library.
+    """
+
+    def __init__(self, definitions: list = None) -> None:
+        """Initializes the SampleLibrary."""
+        self._samples = dict()
+        self._by_key = dict()
+        for definition in definitions or list():
+            self.add(definition)
+
+    @classmethod
+    def load(cls, path=None) -> "SampleLibrary":
+        """Loads a library from a sample file.
+
+        Args:
+            path (str or Path, optional): The path of the JSON sample file, the samples that are shipped with the simulator by default.
+
+        Returns:
+            SampleLibrary: The library of the samples in the file.
+
+        Raises:
+            ValueError: If the file was written by a newer version of the simulator.
+        """
+        path = Path(path) if path is not None else SAMPLES_PATH
+        with open(path) as file:
+            data = json.load(file)
+
+        if data.get("version", FORMAT_VERSION) > FORMAT_VERSION:
+            raise ValueError(
+                f"Sample file {path} has version {data['version']}, only version {FORMAT_VERSION} is supported"
+            )
+
+        library = cls([SampleDefinition.from_dict(entry) for entry in data["samples"]])
+        logger.debug(f"Loaded {len(library)} samples from {path}")
+        return library
+
+    def save(self, path) -> None:
+        """Writes all versions of all samples to a sample file.
+
+        Args:
+            path (str or Path): The path of the JSON sample file.
+        """
+        data = {
+            "version": FORMAT_VERSION,
+            "samples": [
+                definition.as_dict()
+                for versions in self._samples.values()
+                for definition in versions.values()
+            ],
+        }
+        with open(path, "w") as file:
+            json.dump(data, file, indent=2)
+
+    def add(self, definition: SampleDefinition) -> SampleDefinition:
+        """Adds a definition to the library.
+
+        Args:
+            definition (SampleDefinition): The definition, a definition without a version is added as a copy with the next version of the sample.
+
+        Returns:
+            SampleDefinition: The definition in the library.
+
+        Raises:
+            ValueError: If the library already has this version of the sample.
+        """
+        versions = self._samples.setdefault(definition.name, dict())
+        if definition.version is None:
+            definition = replace(definition, version=max(versions, default=0) + 1)
+        if definition.version in versions:
+            raise ValueError(
+                f"Sample {definition.name} version {definition.version} is already in the library"
+            )
+
+        versions[definition.version] = definition
+        self._by_key.setdefault(definition.key, definition)
+        return definition
+
+    def copy(self) -> "SampleLibrary":
+        """Returns a library with the same definitions, samples that are added to the copy are not added to this library.
+
+        The definitions are immutable, so they and their derived quantities are shared by the copy.
+        """
+        return SampleLibrary(
+            [
+                definition
+                for versions in self._samples.values()
+                for definition in versions.values()
+            ]
+        )
+
+    def get(self, name: str, version: int = None) -> SampleDefinition:
+        """Returns a definition of the library.
+
+        Args:
+            name (str): The name of the sample.
+            version (int, optional): The version of the definition, the latest version by default.
+
+        Returns:
+            SampleDefinition: The definition of the sample.
+
+        Raises:
+            KeyError: If the library has no such sample or version.
+        """
+        if name not in self._samples:
+            raise KeyError(f"Sample {name} is not in the library")
+
+        versions = self._samples[name]
+        if version is None:
+            version = max(versions)
+        if version not in versions:
+            raise KeyError(f"Sample {name} has no version {version}")
+        return versions[version]
+
+    def match(self, definition: SampleDefinition) -> SampleDefinition:
+        """Returns the definition of the library that describes the same sample, so its derived quantities are reused.
+
+        Args:
+            definition (SampleDefinition): The definition, e.g. of the sample settings of a simulator.
+
+        Returns:
+            SampleDefinition: The definition of the library with the same key or the given definition if there is none.
+        """
+        return self._by_key.get(definition.key, definition)
+
+    def versions(self, name: str) -> list:
+        """Returns the versions of a sample in ascending order."""
+        return sorted(self._samples.get(name, dict()))
+
+    @property
+    def names(self) -> list:
+        """The names of the samples of the library."""
+        return list(self._samples)
+
+    def __getitem__(self, name: str) -> SampleDefinition:
+        """Returns the latest version of a sample."""
+        return self.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        """Returns True if the library has a sample of this name."""
+        return name in self._samples
+
+    def __iter__(self):
+        """Iterates over the names of the samples."""
+        return iter(self._samples)
+
+    def __len__(self) -> int:
+        """Returns the number of samples of the library."""
+        return len(self._samples)
+
+
+@functools.cache
+def default_library() -> SampleLibrary:
+    """Returns the library of the samples that are shipped with the simulator, it is loaded once.
+
+    The library is shared, it must not be changed. Every Simulator uses its own copy of it.
+    """
+    return SampleLibrary.load()
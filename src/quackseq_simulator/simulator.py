@@ -1,20 +1,219 @@
+import os
+from typing import TYPE_CHECKING
+
 from quackseq.spectrometer.spectrometer import Spectrometer
 
-from .simulator_model import SimulatorModel
-from .simulator_controller import SimulatorController
+# The controller pulls in NumPy, SciPy, the pulse sequences of quackseq and the Bloch simulator, asyncio is only needed for asynchronous runs.
+# They are imported on first use, so importing and creating the simulator stays fast.
+if TYPE_CHECKING:
+    import asyncio
+    from .batch import BatchResult
+    from concurrent.futures import ThreadPoolExecutor
+    from .simulator_model import SimulatorModel
+    from .simulator_controller import SimulatorController
+    from .sweep import SweepResult
+    from .result_store import ResultStore
+    from .samples import SampleDefinition, SampleLibrary
 
 
 class Simulator(Spectrometer):
-    def __init__(self):
-        self.model = SimulatorModel()
-        self.controller = SimulatorController(self)
+    def __init__(self, profile: bool = False, max_concurrent_runs: int = None):
+        self._model = None
+        self._controller = None
+        self._samples = None
+        # If profile is True, the stages of every run are timed and stored in last_run_stats.
+        # Of concurrent runs, last_run_stats holds the run that started last
+        self.profile = profile
+        self.last_run_stats = None
+        # The number of runs of run_sequence_async that are simulated at the same time, one per core by default
+        self.max_concurrent_runs = max_concurrent_runs or os.cpu_count() or 1
+        self._executor = None
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    @property
+    def model(self) -> "SimulatorModel":
+        """The model with the settings of the simulator, it is created on first use."""
+        if self._model is None:
+            from .simulator_model import SimulatorModel
+
+            self._model = SimulatorModel()
+        return self._model
+
+    @model.setter
+    def model(self, model: "SimulatorModel") -> None:
+        self._model = model
+
+    @property
+    def controller(self) -> "SimulatorController":
+        """The controller that runs the simulations, the simulation modules are imported on first use."""
+        if self._controller is None:
+            from .simulator_controller import SimulatorController
+
+            self._controller = SimulatorController(self)
+        return self._controller
+
+    @controller.setter
+    def controller(self, controller: "SimulatorController") -> None:
+        self._controller = controller
+
+    def warm_up(self) -> None:
+        """Imports the simulation modules, so the first run does not wait for the imports."""
+        _ = self.controller
+
+    @property
+    def samples(self) -> "SampleLibrary":
+        """The library of the samples, the samples that are shipped with the simulator by default."""
+        if self._samples is None:
+            from .samples import default_library
+
+            self._samples = default_library().copy()
+        return self._samples
+
+    @samples.setter
+    def samples(self, samples: "SampleLibrary") -> None:
+        self._samples = samples
+
+    def set_sample(self, sample, version: int = None) -> "SampleDefinition":
+        """Sets the sample settings to a sample definition.
+
+        The derived quantities of the definitions of the library are calculated once, so switching between samples, e.g. in a batch of several samples, only sets the settings.
+
+        Args:
+            sample (str or SampleDefinition): The name of a sample of the library or a definition.
+            version (int, optional): The version of a sample of the library, the latest version by default.
+
+        Returns:
+            SampleDefinition: The definition of the sample.
+        """
+        if isinstance(sample, str):
+            sample = self.samples.get(sample, version)
+
+        for name, value in sample.as_settings().items():
+            self.settings[name].value = value
+        return sample
 
     def run_sequence(self, sequence):
         result = self.controller.run_sequence(sequence)
         return result
 
+    def run_batch(self, sequences: list, workers: int = None) -> "BatchResult":
+        """Simulates several pulse sequences with the same settings, e.g. a suite of sequences for a validation report.
+
+        The pulse sequences are translated up front and share the sample and the isochromats. The phase cycles of all pulse sequences are simulated in one pool of worker processes.
+
+        Args:
+            sequences (list): The pulse sequences to simulate.
+            workers (int, optional): The number of worker processes, the workers setting by default.
+
+        Returns:
+            BatchResult: The measurements in the order of the pulse sequences and the error message of every pulse sequence that could not be simulated.
+        """
+        from .batch import run_batch
+
+        return run_batch(self, sequences, workers)
+
+    async def run_sequence_async(self, sequence):
+        """Simulates the sequence in a thread pool of the simulator without blocking the event loop.
+
+        At most max_concurrent_runs runs are simulated at the same time, further runs wait in the order they were started.
+        The phase cycles of the simulated runs take turns on the threads, so the runs share the cores.
+        Cancelling the task of a run stops it after the phase cycle that is being simulated.
+        If the simulator profiles its runs, the memory statistics are only reliable for one run at a time, see RunStats.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence to simulate.
+
+        Returns:
+            Measurement: The measurement or a MeasurementError if the pulse sequence can not be simulated.
+        """
+        async with self.get_semaphore():
+            return await self.controller.run_sequence_async(sequence, self.get_executor())
+
+    def get_executor(self) -> "ThreadPoolExecutor":
+        """Returns the thread pool of the asynchronous runs, it is created on first use.
+
+        Returns:
+            ThreadPoolExecutor: The thread pool with one thread per concurrent run.
+        """
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrent_runs,
+                thread_name_prefix="quackseq-simulator",
+            )
+        return self._executor
+
+    def get_semaphore(self) -> "asyncio.Semaphore":
+        """Returns the semaphore that limits the concurrent asynchronous runs of the running event loop.
+
+        Returns:
+            asyncio.Semaphore: The semaphore with max_concurrent_runs slots.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_runs)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def close(self):
+        """Shuts down the thread pool of the asynchronous runs after the running jobs are finished."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def iter_sequence(self, sequence):
+        """Simulates the sequence and yields every phase cycle as soon as it is finished.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence to simulate.
+
+        Yields:
+            CycleResult: The readout of the phase cycle and the running receiver weighted sum of the readouts.
+        """
+        yield from self.controller.iter_cycles(sequence)
+
+    def store_sequence(self, sequence, path) -> "ResultStore":
+        """Simulates the sequence and streams every phase cycle into a memory mapped result store on disk.
+
+        The store can be reopened later with ResultStore.open without reading the data into memory.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence to simulate.
+            path (str or Path): The path of the store, the data is written to <path>.npy and the metadata to <path>.json.
+
+        Returns:
+            ResultStore: The result store with the memory mapped datasets.
+        """
+        return self.controller.store_sequence(sequence, path)
+
+    def sweep(self, sequence, parameters: dict, path=None) -> "SweepResult":
+        """Simulates the sequence for every combination of the parameter values.
+
+        Settings are swept with "settings.<setting>", e.g. "settings.T2". Events are swept with "event:<event>.<attribute>", where the attribute is duration, amplitude or phase, e.g. "event:tx.duration".
+
+        Args:
+            sequence (QuackSequence): The pulse sequence to sweep.
+            parameters (dict): The values of every swept parameter.
+            path (str or Path, optional): If given, the stacked results are stored in a memory mapped result store on disk, which can be reopened with SweepResult.open.
+
+        Returns:
+            SweepResult: The stacked results with one axis per swept parameter.
+        """
+        from .sweep import run_sweep
+
+        return run_sweep(self, sequence, parameters, path)
+
     def set_averages(self, value: int):
-        self.model.average = value
+        """Sets the number of averages of the simulated measurements.
+
+        Args:
+            value (int): The number of averages.
+        """
+        self.model.averages = value
 
     @property
     def settings(self):
@@ -1,19 +1,113 @@
 """The controller module for the simulator spectrometer."""
 
+import asyncio
+import hashlib
 import logging
+import warnings
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import datetime
 import numpy as np
 
 from quackseq.spectrometer.spectrometer_controller import SpectrometerController
 from quackseq.measurement import Measurement, MeasurementError
-from quackseq.pulseparameters import TXPulse
+from quackseq.pulseparameters import RXReadout
 from quackseq.pulsesequence import QuackSequence
 
 from nqr_blochsimulator import Sample, Simulation, PulseArray
 
+from .pulse_plan import PulsePlan, is_free_evolution
+from .cache import SetupCache, settings_key
+from .bloch import (
+    BlochSimulation,
+    add_noise,
+    calculate_xdis,
+    child_seed,
+    random_state,
+    PRECISION_DTYPES,
+    NOISE_STREAM,
+    ISOCHROMAT_STREAM,
+)
+from .profiling import RunStats
+from .result_store import ResultStore
+from .samples import SampleDefinition
+
 logger = logging.getLogger(__name__)
 
 
+# Settings that are applied after the propagation, they are not part of the key of the noiseless signal
+POST_PROPAGATION_SETTINGS = ("noise", "seed", "gain", "conversion_factor")
+
+# The steps of every decade the dwell time is rounded down to, so edits of later events that keep the step keep the time grid of the earlier events
+DWELL_TIME_STEPS = (1, 1.2, 1.5, 2, 2.5, 3, 4, 5, 6, 8)
+
+
+def simulate_cycle(simulation: BlochSimulation) -> np.ndarray:
+    """Runs the Bloch simulation of a single phase cycle.
+
+    Args:
+        simulation (BlochSimulation): The simulation object of the phase cycle.
+
+    Returns:
+        np.ndarray: The noiseless time domain signal of a single average.
+    """
+    return simulation.simulate_noiseless(simulation.pulse.pulsephase[np.newaxis, :])[0]
+
+
+async def run_job(executor: Executor, function, *args, cleanup=None):
+    """Runs a function in an executor and waits for it without blocking the event loop.
+
+    Args:
+        executor (Executor): The executor the function is submitted to.
+        function (callable): The function.
+        *args: The arguments of the function.
+        cleanup (callable, optional): Called if the waiting is cancelled, as soon as the function is not running anymore.
+
+    Returns:
+        The return value of the function.
+    """
+    future = executor.submit(function, *args)
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        if cleanup is not None:
+            # A job that already started can not be interrupted, it is cleaned up when it is done
+            if future.cancel():
+                cleanup()
+            else:
+                future.add_done_callback(lambda _: cleanup())
+        raise
+
+
+class CycleResult:
+    """The result of a single phase cycle.
+
+    Args:
+        cycle (int): The index of the phase cycle.
+        n_cycles (int): The number of phase cycles of the pulse sequence.
+        tdx (np.ndarray): The time axis of the readout in µs.
+        tdy (np.ndarray): The readout of the phase cycle with the receiver phase applied.
+        running_sum (np.ndarray): The sum of the readouts of all phase cycles up to this one.
+        weighted (bool): True if the receiver phases of the readout scheme were applied.
+    """
+
+    def __init__(
+        self,
+        cycle: int,
+        n_cycles: int,
+        tdx: np.ndarray,
+        tdy: np.ndarray,
+        running_sum: np.ndarray,
+        weighted: bool,
+    ) -> None:
+        """Initializes the CycleResult."""
+        self.cycle = cycle
+        self.n_cycles = n_cycles
+        self.tdx = tdx
+        self.tdy = tdy
+        self.running_sum = running_sum
+        self.weighted = weighted
+
+
 class SimulatorController(SpectrometerController):
     """The controller class for the nqrduck simulator module."""
 
@@ -21,6 +115,14 @@ class SimulatorController(SpectrometerController):
         """Initializes the SimulatorController."""
         super().__init__()
         self.simulator = simulator
+        self.setup_cache = SetupCache()
+        # The propagators of the pulse segments are large, their memory is limited to the memory budget
+        self.propagator_cache = SetupCache(max_entries=32)
+        # The noiseless signal of every simulated phase cycle
+        self.signal_cache = SetupCache(max_entries=64)
+        # The state of the isochromats at the end of the events, runs that only change later events resume from there.
+        # A pulse sequence has a checkpoint per event, so only their memory is limited, to the memory budget
+        self.checkpoint_cache = SetupCache(max_entries=None)
 
     def run_sequence(self, sequence: QuackSequence) -> Measurement:
         """This method  is called when the start_measurement signal is received from the core.
@@ -30,130 +132,786 @@ class SimulatorController(SpectrometerController):
         """
         logger.debug("Starting simulation")
 
-        # This needs to be called to update the phase array
-        sequence.phase_table.generate_phase_array()
+        stats = self.start_run_stats()
+        try:
+            return self.assemble_measurement(sequence, stats)
+        finally:
+            stats.stop()
+
+    def assemble_measurement(self, sequence: QuackSequence, stats: RunStats) -> Measurement:
+        """This method simulates all phase cycles and assembles the measurement.
 
-        # Get the number of phasecycles
-        number_phasecycles = sequence.phase_table.n_phase_cycles
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            stats (RunStats): The statistics of the run.
 
-        if number_phasecycles == 0:
-            error = MeasurementError("Error", "Pulse sequence is not valid. Did you set an TX event?")
+        Returns:
+            Measurement: The measurement or a MeasurementError if the pulse sequence can not be simulated.
+        """
+        try:
+            tdx, weights, readouts = self.get_readouts(sequence, stats)
+        except ValueError as e:
+            logger.warning(str(e))
+            error = MeasurementError("Error", str(e))
             return error
 
-        # Empty measurement object
-        measurement_data = None
+        # The number of datasets is known up front, so the readouts are written into one buffer
+        tdy = self.allocate_datasets(sequence, tdx, weights)
+        for cycle, readout in enumerate(readouts):
+            tdy[:, cycle] = readout
+
+        return self.create_measurement(sequence, tdx, tdy, weights, stats)
+
+    async def run_sequence_async(
+        self, sequence: QuackSequence, executor: Executor
+    ) -> Measurement:
+        """This method simulates the pulse sequence in an executor without blocking the event loop.
+
+        Every phase cycle is a separate job of the executor, so concurrent runs take turns phase cycle by phase cycle.
+        If the run is cancelled, the phase cycle that is being simulated is finished in the background and the remaining phase cycles are not simulated.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            executor (Executor): The executor the jobs of the run are submitted to.
+
+        Returns:
+            Measurement: The measurement or a MeasurementError if the pulse sequence can not be simulated.
+        """
+        logger.debug("Starting asynchronous simulation")
+
+        stats = self.start_run_stats()
+        try:
+            try:
+                tdx, weights, readouts = await run_job(
+                    executor, self.get_readouts, sequence, stats
+                )
+            except ValueError as e:
+                logger.warning(str(e))
+                error = MeasurementError("Error", str(e))
+                return error
+
+            tdy = self.allocate_datasets(sequence, tdx, weights)
+            for cycle in range(sequence.phase_table.n_phase_cycles):
+                tdy[:, cycle] = await run_job(
+                    executor, next, readouts, cleanup=readouts.close
+                )
+
+            return await run_job(
+                executor, self.create_measurement, sequence, tdx, tdy, weights, stats
+            )
+        finally:
+            stats.stop()
+
+    def allocate_datasets(
+        self, sequence: QuackSequence, tdx: np.ndarray, weights: np.ndarray
+    ) -> np.ndarray:
+        """This method allocates the buffer the readouts of the phase cycles are written into.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            tdx (np.ndarray): The time axis of the readout in µs.
+            weights (np.ndarray): The receiver weight of every phase cycle or None without a readout scheme.
+
+        Returns:
+            np.ndarray: The uninitialized datasets with shape (n_points, n_datasets).
+        """
+        return np.empty(
+            (len(tdx), self.get_n_datasets(sequence, weights)),
+            dtype=self.get_complex_dtype(),
+        )
+
+    def create_measurement(
+        self,
+        sequence: QuackSequence,
+        tdx: np.ndarray,
+        tdy: np.ndarray,
+        weights: np.ndarray,
+        stats: RunStats,
+    ) -> Measurement:
+        """This method applies the readout scheme to the datasets and creates the measurement.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            tdx (np.ndarray): The time axis of the readout in µs.
+            tdy (np.ndarray): The datasets with the readouts of all phase cycles.
+            weights (np.ndarray): The receiver weight of every phase cycle or None without a readout scheme.
+            stats (RunStats): The statistics of the run.
+
+        Returns:
+            Measurement: The measurement.
+        """
+        with stats.stage("assembly") as stage:
+            self.apply_readout_scheme(tdy, weights)
+
+            sample, _ = self.get_sample_setup()
+
+            measurement_data = Measurement(
+                self.get_measurement_name(sequence),
+                tdx,
+                tdy,
+                sample.resonant_frequency,
+            )
+            stage.add_array("tdy", measurement_data.tdy)
+            stage.add_array("fdy", measurement_data.fdy)
+
+        logger.debug(f"Measurement data shape: {measurement_data.tdy.shape}")
+
+        return measurement_data
+
+    def store_sequence(self, sequence: QuackSequence, path) -> ResultStore:
+        """This method simulates the pulse sequence and writes every phase cycle into a result store on disk as soon as it is finished.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            path (str or Path): The path of the result store.
+
+        Returns:
+            ResultStore: The flushed result store.
+
+        Raises:
+            ValueError: If the pulse sequence can not be simulated.
+        """
+        stats = self.start_run_stats()
+        try:
+            tdx, weights, readouts = self.get_readouts(sequence, stats)
+            sample, _ = self.get_sample_setup()
+
+            metadata = {
+                "name": self.get_measurement_name(sequence),
+                "sequence": sequence.name,
+                "settings": dict(settings_key(self.simulator.model)),
+                "averages": int(self.simulator.model.averages),
+                "target_frequency": sample.resonant_frequency,
+                "tdx": tdx,
+            }
+            store = ResultStore.create(
+                path,
+                (len(tdx), self.get_n_datasets(sequence, weights)),
+                self.get_complex_dtype(),
+                metadata,
+            )
+            for cycle, readout in enumerate(readouts):
+                store.tdy[:, cycle] = readout
+
+            with stats.stage("assembly"):
+                self.apply_readout_scheme(store.tdy, weights)
+                store.flush()
+        finally:
+            stats.stop()
+
+        logger.debug(f"Stored measurement data with shape {store.tdy.shape} in {store.data_path}")
+
+        return store
 
-        for cycle in range(number_phasecycles):
+    def get_n_datasets(self, sequence: QuackSequence, weights: np.ndarray) -> int:
+        """This method returns the number of datasets of a measurement.
 
-            sample = self.get_sample_from_settings()
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            weights (np.ndarray): The receiver weight of every phase cycle or None without a readout scheme.
+
+        Returns:
+            int: One dataset per phase cycle and one for the receiver weighted sum if there is more than one phase cycle.
+        """
+        n_cycles = sequence.phase_table.n_phase_cycles
+        if weights is not None and n_cycles > 1:
+            return n_cycles + 1
+        return n_cycles
+
+    def apply_readout_scheme(self, tdy: np.ndarray, weights: np.ndarray) -> None:
+        """This method weights the datasets of the phase cycles in place and writes their sum into the last dataset.
+
+        Args:
+            tdy (np.ndarray): The datasets with one column per phase cycle and one for the sum if there is more than one phase cycle.
+            weights (np.ndarray): The receiver weight of every phase cycle or None without a readout scheme.
+        """
+        if weights is None:
+            return
+
+        n_cycles = len(weights)
+        tdy[:, :n_cycles] *= weights
+        if n_cycles > 1:
+            np.sum(tdy[:, :n_cycles], axis=1, out=tdy[:, n_cycles])
+
+    def get_measurement_name(self, sequence: QuackSequence) -> str:
+        """This method returns the name of a measurement of the pulse sequence.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+
+        Returns:
+            str: The date, the module, the target frequency, the averages and the name of the sequence.
+        """
+        name = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Simulator - {self.simulator.model.target_frequency / 1e6} MHz - {self.simulator.model.averages} averages - {sequence.name}"
+        logger.debug(f"Measurement name: {name}")
+        return name
+
+    def iter_cycles(self, sequence: QuackSequence):
+        """This method simulates the phase cycles of the pulse sequence and yields every phase cycle as soon as it is finished.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+
+        Yields:
+            CycleResult: The readout of the phase cycle and the running sum of the readouts.
+
+        Raises:
+            ValueError: If the pulse sequence can not be simulated.
+        """
+        stats = self.start_run_stats()
+        try:
+            tdx, weights, readouts = self.get_readouts(sequence, stats)
+            n_cycles = sequence.phase_table.n_phase_cycles
+            weighted = weights is not None
+
+            running_sum = np.zeros(len(tdx), dtype=self.get_complex_dtype())
+            for cycle, tdy in enumerate(readouts):
+                if weighted:
+                    tdy = tdy * weights[cycle]
+                running_sum = running_sum + tdy
+
+                yield CycleResult(cycle, n_cycles, tdx, tdy, running_sum, weighted)
+        finally:
+            stats.stop()
+
+    def get_complex_dtype(self) -> np.dtype:
+        """This method returns the complex type of the simulated data for the precision setting.
+
+        Returns:
+            np.dtype: complex128 for double and complex64 for single precision.
+        """
+        real_dtype = PRECISION_DTYPES[self.simulator.model.snapshot.precision]
+        return np.result_type(real_dtype, np.complex64)
+
+    def start_run_stats(self) -> RunStats:
+        """This method starts the statistics of a simulation run.
+
+        If the simulator profiles its runs, the statistics are stored as the last_run_stats of the simulator.
+
+        Returns:
+            RunStats: The statistics of the run, disabled if the simulator does not profile its runs.
+        """
+        stats = RunStats(enabled=self.simulator.profile)
+        if stats.enabled:
+            self.simulator.last_run_stats = stats
+        stats.start()
+        return stats
+
+    def get_readouts(
+        self,
+        sequence: QuackSequence,
+        stats: RunStats = None,
+        prepared: tuple = None,
+        signals: dict = None,
+    ) -> tuple:
+        """This method prepares the simulation of the pulse sequence and returns the readouts of the phase cycles.
+
+        The phase cycles are simulated while the readouts are iterated.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            stats (RunStats, optional): The statistics of the run.
+            prepared (tuple, optional): The result of prepare_simulation if the pulse sequence was already prepared.
+            signals (dict, optional): Noiseless signals that were already simulated, keyed like the signal cache.
+
+        Returns:
+            tuple: The time axis of the readout in µs, the receiver weight of every phase cycle or None without a readout scheme and an iterator over the readouts of the phase cycles.
+
+        Raises:
+            ValueError: If the pulse sequence can not be simulated.
+        """
+        if stats is None:
+            stats = RunStats(enabled=False)
+
+        if prepared is None:
+            prepared = self.prepare_simulation(sequence, stats)
+        sample, xdis, pulse_plan = prepared
+        phase_table = sequence.phase_table.phase_array
+
+        tdx, readout, phase = self.get_readout_window(sequence, pulse_plan)
+        weights = None
+        if phase:
+            logger.debug(f"Phase: {phase}")
+            weights = np.exp(1j * np.deg2rad(phase)).astype(self.get_complex_dtype())
+
+        # The settings of the noise are read up front, so they do not change while the readouts are iterated
+        settings = self.simulator.model.snapshot
+        averages = int(self.simulator.model.averages)
+        noise = settings.noise
+        gain = settings.gain
+        conversion_factor = settings.conversion_factor
+
+        # One seed sequence per phase cycle, so parallel and batched runs reproduce the serial result
+        seed_sequence = self.get_seed_sequence()
+        seeds = [
+            child_seed(seed_sequence, NOISE_STREAM, cycle)
+            for cycle in range(len(phase_table))
+        ]
+
+        signals = self.get_noiseless_signals(
+            sample, xdis, pulse_plan, phase_table, stats, signals
+        )
+
+        def slice_readouts():
+            for cycle, signal in enumerate(signals):
+                with stats.stage("rx_slicing", cycle) as stage:
+                    # The noise is only drawn for the points of the readout
+                    result = add_noise(
+                        signal[np.newaxis, readout],
+                        noise,
+                        averages,
+                        gain,
+                        conversion_factor,
+                        [seeds[cycle]],
+                    )
+                    tdy = result[0] / averages
+                    stage.add_array("readout", tdy)
+                yield tdy
+
+        return tdx, weights, slice_readouts()
+
+    def prepare_simulation(
+        self, sequence: QuackSequence, stats: RunStats = None
+    ) -> tuple:
+        """This method prepares the parts of the simulation that are the same for all phase cycles.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            stats (RunStats, optional): The statistics of the run.
+
+        Returns:
+            tuple: The sample, the x distribution of the isochromats and the pulse plan.
+
+        Raises:
+            ValueError: If the pulse sequence can not be simulated.
+        """
+        if stats is None:
+            stats = RunStats(enabled=False)
+
+        with stats.stage("setup") as stage:
+            # This needs to be called to update the phase array
+            sequence.phase_table.generate_phase_array()
+
+            if sequence.phase_table.n_phase_cycles == 0:
+                raise ValueError("Pulse sequence is not valid. Did you set an TX event?")
+
+            # The sample, the isochromats and the dwell time are the same for all phase cycles
+            sample, xdis = self.get_sample_setup()
             logger.debug("Sample: %s", sample.name)
 
-            dwell_time = self.calculate_dwelltime(sequence)
+            dwell_time = self.get_dwell_time(sequence)
             logger.debug("Dwell time: %s", dwell_time)
+            stage.add_array("xdis", xdis)
 
+        with stats.stage("translation") as stage:
             try:
-                pulse_array = self.translate_pulse_sequence(sequence, dwell_time, cycle)
+                pulse_plan = self.get_pulse_plan(sequence, dwell_time)
             except AttributeError:
-                logger.warning("Could not translate pulse sequence")
-                error = MeasurementError("Error", "Could not translate pulse sequence")
-                return error
+                raise ValueError("Could not translate pulse sequence")
+            stage.add_array("amplitude_array", pulse_plan.amplitude_array)
 
-            simulation = self.get_simulation(sample, pulse_array)
+        return sample, xdis, pulse_plan
 
-            result = simulation.simulate()
+    def get_readout_window(self, sequence: QuackSequence, pulse_plan: PulsePlan) -> tuple:
+        """This method returns the simulation points that are recorded by the RX event.
 
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            pulse_plan (PulsePlan): The pulse plan of the pulse sequence.
+
+        Returns:
+            tuple: The time axis of the readout in µs, the indices of the readout points and the receiver phase of every phase cycle. Without a RX event all points are recorded and the phase is None.
+        """
+        if pulse_plan.adaptive:
+            tdx = pulse_plan.get_time_axis() * 1e6
+        else:
             tdx = (
                 np.linspace(
-                    0, float(self.calculate_simulation_length(sequence)), len(result)
+                    0,
+                    float(self.calculate_simulation_length(sequence)),
+                    pulse_plan.n_points,
                 )
                 * 1e6
             )
 
-            rx_begin, rx_stop, phase = self.translate_rx_event(sequence)
-            # If we have a RX event, we need to cut the result to the RX event
-            if rx_begin and rx_stop:
-                evidx = np.where((tdx > rx_begin) & (tdx < rx_stop))[0]
-                tdx = tdx[evidx]
-                result = result[evidx]
-
-            # Add empty second dimension to result so it has shape (n_points, 1)
-            result = np.expand_dims(result, axis=1)
-
-            # Measurement name date + module + target frequency + averages + sequence name
-            name = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Simulator - {self.simulator.model.target_frequency / 1e6} MHz - {self.simulator.model.averages} averages - {sequence.name}"
-            logger.debug(f"Measurement name: {name}")
-
-            if not measurement_data:
-                measurement_data = Measurement(
-                    name,
-                    tdx,
-                    result / simulation.averages,
-                    sample.resonant_frequency,
-                )
+        rx_begin, rx_stop, phase = self.translate_rx_event(sequence)
+        # If we have a RX event, we need to cut the result to the RX event
+        if rx_stop is None:
+            return tdx, slice(None), None
+
+        readout = np.where((tdx > rx_begin) & (tdx < rx_stop))[0]
+        return tdx[readout], readout, phase
+
+    def get_result_shape(self, sequence: QuackSequence) -> tuple:
+        """This method returns the shape of the datasets of the pulse sequence without simulating it.
+
+        The pulse sequence is only translated, the sample and the isochromats are not set up.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+
+        Returns:
+            tuple: The number of readout points and the number of datasets.
+
+        Raises:
+            ValueError: If the pulse sequence can not be simulated.
+        """
+        sequence.phase_table.generate_phase_array()
+        if sequence.phase_table.n_phase_cycles == 0:
+            raise ValueError("Pulse sequence is not valid. Did you set an TX event?")
+
+        try:
+            pulse_plan = self.get_pulse_plan(sequence, self.get_dwell_time(sequence))
+        except AttributeError:
+            raise ValueError("Could not translate pulse sequence")
+
+        tdx, _, phase = self.get_readout_window(sequence, pulse_plan)
+        weights = np.asarray(phase) if phase else None
+        return len(tdx), self.get_n_datasets(sequence, weights)
+
+    def get_noiseless_signals(
+        self,
+        sample: Sample,
+        xdis: np.ndarray,
+        pulse_plan: PulsePlan,
+        phase_table: np.ndarray,
+        stats: RunStats = None,
+        simulated: dict = None,
+    ):
+        """Returns the noiseless signals of the phase cycles and only simulates the ones that are not cached.
+
+        The noise, the averages and the gain are applied after the propagation, so the signal of a phase cycle is cached with the pulse plan, the phases of the phase cycle, the isochromats and all other settings as key.
+        Runs that only change the noise, the seed, the averages or the gain reuse the cached signals.
+
+        Args:
+            sample (Sample): The sample of the simulation.
+            xdis (np.ndarray): The x distribution of the isochromats.
+            pulse_plan (PulsePlan): The pulse plan of the pulse sequence.
+            phase_table (np.ndarray): The phase table with one row per phase cycle.
+            stats (RunStats, optional): The statistics of the run.
+            simulated (dict, optional): Noiseless signals that were already simulated, they are used before the cache.
+
+        Yields:
+            np.ndarray: The noiseless signal of a single average in the order of the phase cycles.
+        """
+        phase_table = np.asarray(phase_table, dtype=float)
+        keys = self.get_signal_keys(xdis, pulse_plan, phase_table)
+        if simulated is None:
+            simulated = dict()
+
+        # The cached signals are kept for the whole run, even if they are evicted from the cache in the meantime
+        signals = dict()
+        missing = list()
+        for cycle, key in enumerate(keys):
+            # Phase cycles with the same phases are only simulated once
+            if keys.index(key) != cycle:
+                continue
+            signal = simulated.get(key)
+            if signal is None:
+                signal = self.signal_cache.lookup(key)
+            if signal is None:
+                missing.append(cycle)
             else:
-                measurement_data.add_dataset(result / simulation.averages)
+                signals[key] = signal
 
-            if (rx_begin and rx_stop) and phase:
-                logger.debug(f"Phase: {phase}")
-                measurement_data.phase_shift(phase[cycle], cycle)
+        logger.debug(
+            f"{len(keys) - len(missing)} of {len(keys)} noiseless phase cycle signals are cached"
+        )
+        simulated = self.simulate_cycles(
+            sample, xdis, pulse_plan, phase_table[missing], stats
+        )
 
+        for key in keys:
+            if key not in signals:
+                signals[key] = next(simulated)
+                self.signal_cache.put(key, signals[key])
+            yield signals[key]
 
-        if phase and number_phasecycles > 1:
-            # Apply the readout scheme
-            tdy_sum = np.sum(measurement_data.tdy, axis=1, keepdims=True)
+    def get_propagator_cache(self) -> SetupCache:
+        """Returns the cache of the segment propagators with the memory budget as its memory limit.
 
-            measurement_data.add_dataset(tdy_sum)
+        Returns:
+            SetupCache: The cache of the segment propagators.
+        """
+        self.propagator_cache.max_bytes = self.simulator.model.snapshot.memory_budget * 1e6
+        return self.propagator_cache
 
-        logger.debug(f"Measurement data shape: {measurement_data.tdy.shape}")
-    
-        return measurement_data
+    def get_checkpoint_cache(self) -> SetupCache:
+        """Returns the cache of the checkpoints of the isochromats with the memory budget as its memory limit.
+
+        The checkpoints are keyed on the pulses on the simulation time grid, so a run only resumes if the dwell time is the same.
+        The dwell time follows from the sampled length of the pulse sequence rounded down to a fixed step, so changes of later events, e.g. of the readout or a trailing blank, resume from the events before them as long as the dwell time stays on the same step.
+        A change that moves the dwell time to another step propagates all events again.
+
+        Returns:
+            SetupCache: The cache of the checkpoints.
+        """
+        self.checkpoint_cache.max_bytes = self.simulator.model.snapshot.memory_budget * 1e6
+        return self.checkpoint_cache
+
+    def get_signal_keys(
+        self, xdis: np.ndarray, pulse_plan: PulsePlan, phase_table: np.ndarray
+    ) -> list:
+        """Returns the keys of the noiseless signals of the phase cycles in the signal cache.
+
+        Args:
+            xdis (np.ndarray): The x distribution of the isochromats.
+            pulse_plan (PulsePlan): The pulse plan of the pulse sequence.
+            phase_table (np.ndarray): The phase table with one row per phase cycle.
+
+        Returns:
+            list: The key of every phase cycle.
+        """
+        settings = tuple(
+            (name, value)
+            for name, value in settings_key(self.simulator.model)
+            if name not in POST_PROPAGATION_SETTINGS
+        )
+        base_key = (
+            "signal",
+            pulse_plan.digest(),
+            hashlib.sha1(xdis.tobytes()).hexdigest(),
+            settings,
+        )
+        return [
+            base_key + (tuple(phases),)
+            for phases in np.asarray(phase_table, dtype=float)
+        ]
+
+    def get_cycle_simulation(
+        self,
+        sample: Sample,
+        xdis: np.ndarray,
+        pulse_plan: PulsePlan,
+        phases: np.ndarray,
+    ) -> BlochSimulation:
+        """Creates the simulation of a single phase cycle.
+
+        Args:
+            sample (Sample): The sample of the simulation.
+            xdis (np.ndarray): The x distribution of the isochromats.
+            pulse_plan (PulsePlan): The pulse plan of the pulse sequence.
+            phases (np.ndarray): The phases of the pulses of the phase cycle.
+
+        Returns:
+            BlochSimulation: The simulation, without the propagator cache of the controller.
+        """
+        segment_offsets, segment_steps = self.get_segments(pulse_plan)
+        return self.get_simulation(
+            sample,
+            pulse_plan.get_pulse_array(phases),
+            xdis,
+            segment_offsets,
+            segment_steps,
+        )
+
+    def get_segments(self, pulse_plan: PulsePlan) -> tuple:
+        """Returns the segments a pulse plan is propagated in.
+
+        Sequences of rectangular pulses and blanks and adaptive time steps are propagated segment by segment.
+
+        Args:
+            pulse_plan (PulsePlan): The pulse plan of the pulse sequence.
+
+        Returns:
+            tuple: The offsets and the number of dwell time steps of the segments, None and None if the pulse plan is propagated step by step.
+        """
+        if pulse_plan.piecewise_constant or pulse_plan.adaptive:
+            return pulse_plan.offsets, pulse_plan.steps
+        return None, None
+
+    def simulate_cycles(
+        self,
+        sample: Sample,
+        xdis: np.ndarray,
+        pulse_plan: PulsePlan,
+        phase_table: np.ndarray,
+        stats: RunStats = None,
+    ):
+        """Runs the simulations of the phase cycles.
+
+        The phase cycles are either propagated together in one batch, simulated in parallel if more than one worker is configured or simulated one after another.
+
+        Args:
+            sample (Sample): The sample of the simulation.
+            xdis (np.ndarray): The x distribution of the isochromats.
+            pulse_plan (PulsePlan): The pulse plan of the pulse sequence.
+            phase_table (np.ndarray): The phase table with one row per phase cycle.
+            stats (RunStats, optional): The statistics of the run. In parallel runs the propagation stage is the time spent waiting for the worker.
+
+        Yields:
+            np.ndarray: The noiseless signals of a single average in the order of the phase cycles.
+        """
+        settings = self.simulator.model.snapshot
+        if stats is None:
+            stats = RunStats(enabled=False)
+
+        segment_offsets, segment_steps = self.get_segments(pulse_plan)
+        if segment_offsets is not None:
+            logger.debug("Propagating the pulse plan segment by segment")
+
+        if settings.batch_cycles and len(phase_table) > 1:
+            logger.debug(f"Simulating {len(phase_table)} phase cycles in one batch")
+            with stats.stage("construction") as stage:
+                simulation = self.get_simulation(
+                    sample,
+                    pulse_plan.get_pulse_array(phase_table[0]),
+                    xdis,
+                    segment_offsets,
+                    segment_steps,
+                )
+                simulation.propagator_cache = self.get_propagator_cache()
+                simulation.checkpoint_cache = self.get_checkpoint_cache()
+                phase_tensor = pulse_plan.get_phase_tensor(phase_table)
+                stage.add_array("phase_tensor", phase_tensor)
+
+            with stats.stage("propagation") as stage:
+                results = simulation.simulate_noiseless(phase_tensor)
+                stage.add_array("signal", results)
+
+            yield from results
+            return
+
+        workers = min(settings.workers, len(phase_table))
+
+        def construct(cycle: int) -> Simulation:
+            with stats.stage("construction", cycle) as stage:
+                pulse_array = pulse_plan.get_pulse_array(phase_table[cycle])
+                stage.add_array("pulsephase", pulse_array.pulsephase)
+                simulation = self.get_simulation(
+                    sample, pulse_array, xdis, segment_offsets, segment_steps
+                )
+                # Worker processes can not share the caches of the controller
+                if workers <= 1:
+                    simulation.propagator_cache = self.get_propagator_cache()
+                    simulation.checkpoint_cache = self.get_checkpoint_cache()
+                return simulation
+
+        if workers <= 1:
+            for cycle in range(len(phase_table)):
+                simulation = construct(cycle)
+                with stats.stage("propagation", cycle) as stage:
+                    result = simulate_cycle(simulation)
+                    stage.add_array("signal", result)
+                yield result
+            return
+
+        logger.debug(f"Simulating {len(phase_table)} phase cycles on {workers} workers")
+        simulations = (construct(cycle) for cycle in range(len(phase_table)))
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            # map keeps the order of the phase cycles
+            results = executor.map(simulate_cycle, simulations)
+            for cycle in range(len(phase_table)):
+                with stats.stage("propagation", cycle) as stage:
+                    result = next(results)
+                    stage.add_array("signal", result)
+                yield result
+        finally:
+            # Phase cycles that did not start yet are dropped if the caller stops early
+            executor.shutdown(cancel_futures=True)
+
+    def get_sample_setup(self) -> tuple:
+        """This method returns the sample and the isochromat distribution for the current settings.
+
+        Both are cached and only calculated again when one of the settings they depend on changes.
+
+        Returns:
+            tuple: The sample and the x distribution of the isochromats.
+        """
+        model = self.simulator.model
+        sample_key = settings_key(model, model.SAMPLE)
+        sample = self.get_cached_sample_definition().sample
+
+        settings = model.snapshot
+        number_isochromats = settings.number_isochromats
+        gradient = settings.gradient
+
+        # With a seed the isochromats are drawn from their own stream, otherwise from the NumPy random state
+        seed = settings.seed
+        isochromat_seed = None
+        if seed >= 0:
+            isochromat_seed = child_seed(
+                np.random.SeedSequence(seed), ISOCHROMAT_STREAM
+            ).generate_state(1)[0]
+
+        def draw_xdis() -> np.ndarray:
+            with random_state(isochromat_seed):
+                return calculate_xdis(sample, number_isochromats, gradient)
+
+        xdis = self.setup_cache.get(
+            ("xdis", sample_key, number_isochromats, gradient, isochromat_seed),
+            draw_xdis,
+        )
+
+        return sample, xdis
+
+    def get_seed_sequence(self) -> np.random.SeedSequence:
+        """This method returns the seed sequence of a run, the noise of every phase cycle and average is drawn from its children.
+
+        Returns:
+            np.random.SeedSequence: The seed sequence of the seed setting. Without a seed, a new seed is drawn from the NumPy random state for every run.
+        """
+        seed = self.simulator.model.snapshot.seed
+        if seed < 0:
+            seed = np.random.randint(0, 2**31 - 1)
+        return np.random.SeedSequence(seed)
+
+    def get_dwell_time(self, sequence: QuackSequence) -> float:
+        """This method returns the cached dwell time for the timing of the pulse sequence.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+
+        Returns:
+            float: The dwell time in seconds.
+        """
+        settings = self.simulator.model.snapshot
+        timing = tuple(
+            (event.duration, is_free_evolution(sequence, event))
+            for event in self.get_simulated_events(sequence)
+        )
+        return self.setup_cache.get(
+            ("dwell_time", settings.number_points, settings.adaptive_steps, timing),
+            lambda: self.calculate_dwelltime(sequence),
+        )
+
+    def get_sample_definition(self) -> SampleDefinition:
+        """This method returns the definition of the sample settings.
+
+        If the sample library of the simulator has a definition of the same sample, that one is returned, so its derived quantities and its Sample are reused.
+
+        Returns:
+            SampleDefinition: The definition of the sample.
+        """
+        definition = SampleDefinition.from_settings(self.simulator.model.snapshot)
+        return self.simulator.samples.match(definition)
+
+    def get_cached_sample_definition(self) -> SampleDefinition:
+        """This method returns the definition of the sample settings, it is cached until one of the sample settings changes.
+
+        Returns:
+            SampleDefinition: The definition of the sample.
+        """
+        model = self.simulator.model
+        return self.setup_cache.get(
+            ("sample", settings_key(model, model.SAMPLE)), self.get_sample_definition
+        )
 
     def get_sample_from_settings(self) -> Sample:
         """This method creates a sample object based on the settings in the model.
 
+        Deprecated, use get_sample_definition, whose sample and derived quantities are calculated once.
+
         Returns:
-            Sample: The sample object created from the settings.
+            Sample: A new sample object created from the settings.
         """
-        model = self.simulator.model
-        atom_density = None
-        sample_volume = None
-        sample_length = None
-        sample_diameter = None
-
-        name = model.settings.sample_name
-        n_atoms = model.settings.n_atoms
-        density = model.settings.density
-        molar_mass = model.settings.molar_mass
-        resonant_frequency = model.settings.resonant_frequency
-        gamma = model.settings.gamma
-        nuclear_spin = model.settings.nuclear_spin
-        spin_factor = model.settings.spin_factor
-        powder_factor = model.settings.powder_factor
-        filling_factor = model.settings.filling_factor
-        T1 = model.settings.T1
-        T2 = model.settings.T2
-        T2_star = model.settings.T2_star
-
-        sample = Sample(
-            name=name,
-            atoms=n_atoms,
-            density=density,
-            molar_mass=molar_mass,
-            resonant_frequency=resonant_frequency,
-            gamma=gamma,
-            nuclear_spin=nuclear_spin,
-            spin_factor=spin_factor,
-            powder_factor=powder_factor,
-            filling_factor=filling_factor,
-            T1=T1,
-            T2=T2,
-            T2_star=T2_star,
-            atom_density=atom_density,
-            sample_volume=sample_volume,
-            sample_length=sample_length,
-            sample_diameter=sample_diameter,
+        warnings.warn(
+            "get_sample_from_settings is deprecated, use get_sample_definition().sample",
+            DeprecationWarning,
+            stacklevel=2,
         )
-        return sample
+        return SampleDefinition.from_settings(self.simulator.model.snapshot).sample
 
     def translate_pulse_sequence(
         self, sequence: QuackSequence, dwell_time: float, cycle: int
@@ -168,116 +926,158 @@ class SimulatorController(SpectrometerController):
         Returns:
             PulseArray: The pulse sequence translated to a PulseArray object.
         """
-        events = sequence.events
-
-        amplitude_array = list()
-        phase_array = list()
-
-        # Get the phase_table
-        phase_table = sequence.phase_table.phase_array[cycle]
-
-        # Count the number of TX pulses with relative amplitude > 0
-        n_tx_pulses = 0
-
-        for event in events:
-            logger.debug("Event %s has parameters: %s", event.name, event.parameters)
-            for parameter in event.parameters.values():
-                logger.debug(
-                    "Parameter %s has options: %s", parameter.name, parameter.options
-                )
+        pulse_plan = self.get_pulse_plan(sequence, dwell_time)
+        return pulse_plan.get_pulse_array(sequence.phase_table.phase_array[cycle])
 
-                if (
-                    parameter.name == sequence.TX_PULSE
-                    and parameter.get_option_by_name(TXPulse.RELATIVE_AMPLITUDE).value
-                    > 0
-                ):
-                    logger.debug(f"Adding pulse: {event.duration} s")
-
-                    # If we have a pulse, we need to add it to the pulse array
-                    pulse_shape = parameter.get_option_by_name(
-                        TXPulse.TX_PULSE_SHAPE
-                    ).value
-                    pulse_amplitude = abs(
-                        pulse_shape.get_pulse_amplitude(
-                            event.duration, resolution=dwell_time
-                        )
-                    )
+    def get_pulse_plan(self, sequence: QuackSequence, dwell_time: float) -> PulsePlan:
+        """This method creates the phase independent layout of the pulse sequence on the simulation time grid.
 
-                    amplitude_array.append(pulse_amplitude)
-
-                    # Phase from the phase table - column is the number of the pulse
-                    phase = phase_table[n_tx_pulses]
-                    # Degrees to radians
-                    phase = np.radians(phase)
-                    phase_array.append([phase for _ in range(len(pulse_amplitude))])
-                    n_tx_pulses += 1
-
-                elif (
-                    parameter.name == sequence.TX_PULSE
-                    and parameter.get_option_by_name(TXPulse.RELATIVE_AMPLITUDE).value
-                    == 0
-                ):
-                    # If we have a wait, we need to add it to the pulse array
-                    amplitude_array.append(np.zeros(int(event.duration / dwell_time)))
-                    phase_array.append(np.zeros(int(event.duration / dwell_time)))
-
-        amplitude_array = np.concatenate(amplitude_array)
-        phase_array = np.concatenate(phase_array)
-
-        pulse_array = PulseArray(
-            pulseamplitude=amplitude_array,
-            pulsephase=phase_array,
-            dwell_time=float(dwell_time),
-        )
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+            dwell_time (float): The dwell time in seconds.
 
-        return pulse_array
+        Returns:
+            PulsePlan: The pulse plan of the simulated events.
+        """
+        events = self.get_simulated_events(sequence)
+        adaptive = self.simulator.model.snapshot.adaptive_steps
+        return PulsePlan.from_events(sequence, events, dwell_time, adaptive)
 
-    def get_simulation(self, sample: Sample, pulse_array: PulseArray) -> Simulation:
+    def get_simulation(
+        self,
+        sample: Sample,
+        pulse_array: PulseArray,
+        xdis: np.ndarray = None,
+        segment_offsets: np.ndarray = None,
+        segment_steps: np.ndarray = None,
+    ) -> Simulation:
         """This method creates a simulation object based on the settings and the pulse sequence.
 
         Args:
             sample (Sample): The sample object created from the settings.
             pulse_array (PulseArray): The pulse sequence translated to a PulseArray object.
+            xdis (np.ndarray, optional): The x distribution of the isochromats. If None, the simulation draws a new one.
+            segment_offsets (np.ndarray, optional): The offsets of the segments the pulse array is constant in. If given, the simulation propagates the segments in closed form.
+            segment_steps (np.ndarray, optional): The number of dwell time steps every point of a segment spans.
 
         Returns:
             Simulation: The simulation object created from the settings and the pulse sequence.
         """
         model = self.simulator.model
+        settings = model.snapshot
+
+        # The derived quantities of the definition are only used for its own sample
+        definition = self.get_cached_sample_definition()
+        if definition.sample is not sample:
+            definition = None
 
-        # noise = float(model.get_setting_by_name(model.NOISE).value)
-        simulation = Simulation(
+        simulation = BlochSimulation(
+            xdis=xdis,
+            segment_offsets=segment_offsets,
+            segment_steps=segment_steps,
             sample=sample,
             pulse=pulse_array,
-            number_isochromats=int(model.settings.number_isochromats),
-            initial_magnetization=float(model.settings.initial_magnetization),
-            gradient=float(model.settings.gradient),
-            noise=float(model.settings.noise),
-            length_coil=float(model.settings.length_coil),
-            diameter_coil=float(model.settings.diameter_coil),
-            number_turns=float(model.settings.number_turns),
-            q_factor_transmit=float(model.settings.q_factor_transmit),
-            q_factor_receive=float(model.settings.q_factor_receive),
-            power_amplifier_power=float(model.settings.power_amplifier_power),
-            gain=float(model.settings.gain),
-            temperature=float(model.settings.temperature),
+            number_isochromats=settings.number_isochromats,
+            initial_magnetization=settings.initial_magnetization,
+            gradient=settings.gradient,
+            noise=settings.noise,
+            length_coil=settings.length_coil,
+            diameter_coil=settings.diameter_coil,
+            number_turns=settings.number_turns,
+            q_factor_transmit=settings.q_factor_transmit,
+            q_factor_receive=settings.q_factor_receive,
+            power_amplifier_power=settings.power_amplifier_power,
+            gain=settings.gain,
+            temperature=settings.temperature,
             averages=int(model.averages),
-            loss_TX=float(model.settings.loss_tx),
-            loss_RX=float(model.settings.loss_rx),
-            conversion_factor=float(model.settings.conversion_factor),
+            loss_TX=settings.loss_tx,
+            loss_RX=settings.loss_rx,
+            conversion_factor=settings.conversion_factor,
+            dtype=PRECISION_DTYPES[settings.precision],
+            memory_budget=settings.memory_budget * 1e6,
+            sample_definition=definition,
         )
         return simulation
 
     def calculate_dwelltime(self, sequence: QuackSequence) -> float:
         """This method calculates the dwell time based on the settings and the pulse sequence.
 
+        The sampled length divided by the number of points is rounded down to the DWELL_TIME_STEPS of its decade.
+        The simulation then uses at most a third more points than the setting, and the time grid of the events only changes if an edit of the pulse sequence moves the dwell time to another step.
+
         Returns:
             float: The dwell time in seconds.
         """
-        n_points = int(
-            self.simulator.model.get_setting_by_display_name(
-                self.simulator.model.NUMBER_POINTS
-            ).value
-        )
-        simulation_length = self.calculate_simulation_length(sequence)
+        n_points = self.simulator.model.snapshot.number_points
+        simulation_length = self.calculate_sampled_length(sequence)
         dwell_time = simulation_length / n_points
-        return dwell_time
+        if dwell_time <= 0:
+            return dwell_time
+
+        # The tolerance keeps dwell times that are already on a step from being rounded down to the one below
+        tolerance = 1 + 1e-9
+        decade = 10.0 ** np.floor(np.log10(dwell_time * tolerance))
+        step = max(
+            step for step in DWELL_TIME_STEPS if step <= dwell_time / decade * tolerance
+        )
+        return step * decade
+
+    def calculate_simulation_length(self, sequence: QuackSequence) -> float:
+        """This method calculates the length of the simulated part of the pulse sequence.
+
+        Returns:
+            float: The simulation length in seconds.
+        """
+        events = self.get_simulated_events(sequence)
+        simulation_length = 0
+        for event in events:
+            simulation_length += event.duration
+        return simulation_length
+
+    def calculate_sampled_length(self, sequence: QuackSequence) -> float:
+        """This method calculates the length of the part of the pulse sequence the simulation points are spent on.
+
+        With adaptive time steps, blanks that are not recorded are propagated in one step and do not need simulation points.
+
+        Returns:
+            float: The sampled length in seconds.
+        """
+        if not self.simulator.model.snapshot.adaptive_steps:
+            return self.calculate_simulation_length(sequence)
+
+        sampled_length = 0
+        for event in self.get_simulated_events(sequence):
+            if not is_free_evolution(sequence, event):
+                sampled_length += event.duration
+
+        # A sequence of blanks is sampled as a whole
+        if not sampled_length:
+            return self.calculate_simulation_length(sequence)
+
+        return sampled_length
+
+    def get_simulated_events(self, sequence: QuackSequence) -> list:
+        """This method returns the events of the pulse sequence that are simulated.
+
+        If the simulation is truncated after the readout, the events after the last RX event are left out.
+
+        Args:
+            sequence (QuackSequence): The pulse sequence from the core.
+
+        Returns:
+            list: The events that are simulated.
+        """
+        events = sequence.events
+        if not self.simulator.model.snapshot.truncate_after_readout:
+            return events
+
+        last_rx_event = None
+        for index, event in enumerate(events):
+            readout = event.parameters[sequence.RX_READOUT]
+            if readout.get_option_by_name(RXReadout.RX).value:
+                last_rx_event = index
+
+        if last_rx_event is None:
+            return events
+
+        return events[: last_rx_event + 1]
@@ -1,17 +1,193 @@
 """The model module for the simulator spectrometer."""
 
 import logging
-from quackseq.spectrometer.spectrometer_model import SpectrometerModel
+import weakref
+from dataclasses import dataclass, fields
+from quackseq.spectrometer.spectrometer_model import SpectrometerModel, QuackSettings
 from quackseq.spectrometer.spectrometer_settings import (
+    Setting,
     IntSetting,
     FloatSetting,
     StringSetting,
     SelectionSetting,
+    BooleanSetting,
 )
 
+from .samples import default_library, DEFAULT_SAMPLE
+
 logger = logging.getLogger(__name__)
 
 
+class TrackedSetting:
+    """A mixin for settings that tell their model when their value changes, so the model knows when its snapshot is outdated."""
+
+    _model = None
+
+    @property
+    def value(self):
+        """The value of the setting."""
+        base = getattr(super(TrackedSetting, type(self)), "value", None)
+        if isinstance(base, property):
+            return base.fget(self)
+        # Settings without a value property keep the value in the instance
+        return self.__dict__["value"]
+
+    @value.setter
+    def value(self, value):
+        base = getattr(super(TrackedSetting, type(self)), "value", None)
+        if isinstance(base, property):
+            base.fset(self, value)
+        else:
+            self.__dict__["value"] = value
+        model = self._model() if self._model is not None else None
+        if model is not None:
+            model._snapshot = None
+
+    def __getstate__(self) -> dict:
+        """Returns the state of the setting without the reference to the model, the model attaches its settings again when it is unpickled."""
+        state = self.__dict__.copy()
+        state.pop("_model", None)
+        return state
+
+
+class TrackedIntSetting(TrackedSetting, IntSetting):
+    """An IntSetting that tells its model when its value changes."""
+
+
+class TrackedFloatSetting(TrackedSetting, FloatSetting):
+    """A FloatSetting that tells its model when its value changes."""
+
+
+class TrackedStringSetting(TrackedSetting, StringSetting):
+    """A StringSetting that tells its model when its value changes."""
+
+
+class TrackedSelectionSetting(TrackedSetting, SelectionSetting):
+    """A SelectionSetting that tells its model when its value changes."""
+
+
+class TrackedBooleanSetting(TrackedSetting, BooleanSetting):
+    """A BooleanSetting that tells its model when its value changes."""
+
+
+TRACKED_SETTINGS = {
+    IntSetting: TrackedIntSetting,
+    FloatSetting: TrackedFloatSetting,
+    StringSetting: TrackedStringSetting,
+    SelectionSetting: TrackedSelectionSetting,
+    BooleanSetting: TrackedBooleanSetting,
+}
+
+
+def tracked_setting_class(setting_class: type) -> type:
+    """Returns the subclass of a setting class that tells its model when its value changes.
+
+    The tracked subclasses of other setting classes, e.g. of subclasses of FloatSetting, are created on first use.
+
+    Args:
+        setting_class (type): A subclass of Setting.
+
+    Returns:
+        type: The tracked subclass of the setting class.
+
+    Raises:
+        TypeError: If the class is not a setting class.
+    """
+    if issubclass(setting_class, TrackedSetting):
+        return setting_class
+    if not issubclass(setting_class, Setting):
+        raise TypeError(f"{setting_class.__name__} is not a setting class")
+
+    if setting_class not in TRACKED_SETTINGS:
+        TRACKED_SETTINGS[setting_class] = type(
+            f"Tracked{setting_class.__name__}",
+            (TrackedSetting, setting_class),
+            {"__doc__": f"A {setting_class.__name__} that tells its model when its value changes."},
+        )
+    return TRACKED_SETTINGS[setting_class]
+
+
+def track_setting(setting: Setting) -> TrackedSetting:
+    """Returns a setting that tells its model when its value changes.
+
+    Args:
+        setting (Setting): The setting.
+
+    Returns:
+        TrackedSetting: The setting itself if it is tracked, otherwise a tracked copy of it with the same attributes.
+    """
+    if isinstance(setting, TrackedSetting):
+        return setting
+
+    tracked = object.__new__(tracked_setting_class(type(setting)))
+    tracked.__dict__.update(setting.__dict__)
+    return tracked
+
+
+@dataclass(frozen=True, slots=True)
+class SimulatorSettings:
+    """A typed snapshot of the values of the settings of the simulator.
+
+    The attributes have the names of the settings in SimulatorModel.settings, so the controller reads all parameters of a run without looking up the settings one by one.
+    """
+
+    # Simulation settings
+    number_points: int
+    number_isochromats: int
+    initial_magnetization: float
+    gradient: float
+    noise: float
+    workers: int
+    truncate_after_readout: bool
+    batch_cycles: bool
+    adaptive_steps: bool
+    precision: str
+    memory_budget: float
+    seed: int
+
+    # Hardware settings
+    length_coil: float
+    diameter_coil: float
+    number_turns: float
+    q_factor_transmit: float
+    q_factor_receive: float
+    power_amplifier_power: float
+    gain: float
+    temperature: float
+    loss_tx: float
+    loss_rx: float
+    conversion_factor: float
+
+    # Sample settings
+    sample_name: str
+    n_atoms: int
+    density: float
+    molar_mass: float
+    resonant_frequency: float
+    gamma: float
+    nuclear_spin: str
+    spin_factor: float
+    powder_factor: float
+    filling_factor: float
+    T1: float
+    T2: float
+    T2_star: float
+
+    @classmethod
+    def from_settings(cls, settings: QuackSettings) -> "SimulatorSettings":
+        """Creates the snapshot of the current values of the settings.
+
+        Args:
+            settings (QuackSettings): The settings of the simulator model.
+
+        Returns:
+            SimulatorSettings: The snapshot.
+        """
+        return cls(
+            **{field.name: field.type(settings[field.name].value) for field in fields(cls)}
+        )
+
+
 class SimulatorModel(SpectrometerModel):
     """Model class for the simulator spectrometer."""
 
@@ -21,6 +197,13 @@ class SimulatorModel(SpectrometerModel):
     INITIAL_MAGNETIZATION = "Initial magnetization"
     GRADIENT = "Gradient (mT/m))"
     NOISE = "Noise (uV)"
+    WORKERS = "N. of workers"
+    TRUNCATE_AFTER_READOUT = "Truncate after readout"
+    BATCH_CYCLES = "Batch phase cycles"
+    ADAPTIVE_STEPS = "Adaptive time steps"
+    PRECISION = "Precision"
+    MEMORY_BUDGET = "Memory budget (MB)"
+    SEED = "Random seed"
 
     # Hardware settings
     LENGTH_COIL = "Length coil (mm)"
@@ -36,7 +219,7 @@ class SimulatorModel(SpectrometerModel):
     LOSS_RX = "Loss RX (dB)"
     CONVERSION_FACTOR = "Conversion factor"
 
-    # Sample settings, this will  be done in a separate module later on
+    # Sample settings, their defaults come from the sample library
     SAMPLE_NAME = "Name"
     NUMBER_ATOMS = "N. atoms (1/m^3)"
     DENSITY = "Density (g/cm^3)"
@@ -64,13 +247,14 @@ class SimulatorModel(SpectrometerModel):
     def __init__(self):
         """Initializes the SimulatorModel."""
         super().__init__()
+        self._snapshot = None
 
         # Simulation settings
-        number_of_points_setting = IntSetting(
+        number_of_points_setting = TrackedIntSetting(
             self.NUMBER_POINTS,
             self.SIMULATION,
             8192,
-            "Number of points used for the simulation. This influences the dwell time in combination with the total event simulation given by the pulse sequence.",
+            "Number of points used for the simulation. This influences the dwell time in combination with the total event simulation given by the pulse sequence. The dwell time is rounded down to a fixed step, so the simulation can use up to a third more points.",
             min_value=0,
         )
         self.add_setting(
@@ -78,17 +262,17 @@ class SimulatorModel(SpectrometerModel):
             number_of_points_setting,
         )
 
-        number_of_isochromats_setting = IntSetting(
+        number_of_isochromats_setting = TrackedIntSetting(
             self.NUMBER_ISOCHROMATS,
             self.SIMULATION,
             1000,
-            "Number of isochromats used for the simulation. This influences the computation time.",
+            "Number of isochromats used for the simulation. This influences the computation time. Large ensembles are simulated in chunks that fit into the memory budget.",
             min_value=0,
-            max_value=10000,
+            max_value=1000000,
         )
         self.add_setting("number_isochromats", number_of_isochromats_setting)
 
-        initial_magnetization_setting = FloatSetting(
+        initial_magnetization_setting = TrackedFloatSetting(
             self.INITIAL_MAGNETIZATION,
             self.SIMULATION,
             1,
@@ -97,7 +281,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("initial_magnetization", initial_magnetization_setting)
 
-        gradient_setting = FloatSetting(
+        gradient_setting = TrackedFloatSetting(
             self.GRADIENT,
             self.SIMULATION,
             1,
@@ -105,7 +289,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("gradient", gradient_setting)
 
-        noise_setting = FloatSetting(
+        noise_setting = TrackedFloatSetting(
             self.NOISE,
             self.SIMULATION,
             2,
@@ -116,8 +300,69 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("noise", noise_setting)
 
+        workers_setting = TrackedIntSetting(
+            self.WORKERS,
+            self.SIMULATION,
+            1,
+            "Number of worker processes used to simulate the phase cycles in parallel. With one worker the phase cycles are simulated one after another.",
+            min_value=1,
+        )
+        self.add_setting("workers", workers_setting)
+
+        truncate_after_readout_setting = TrackedBooleanSetting(
+            self.TRUNCATE_AFTER_READOUT,
+            self.SIMULATION,
+            False,
+            "Stops the simulation at the end of the readout. The simulation points are then spent on the events up to the end of the readout instead of the events that follow it.",
+        )
+        self.add_setting("truncate_after_readout", truncate_after_readout_setting)
+
+        batch_cycles_setting = TrackedBooleanSetting(
+            self.BATCH_CYCLES,
+            self.SIMULATION,
+            False,
+            "Propagates all phase cycles together in one vectorized simulation instead of one simulation per phase cycle. This takes precedence over the number of workers.",
+        )
+        self.add_setting("batch_cycles", batch_cycles_setting)
+
+        adaptive_steps_setting = TrackedBooleanSetting(
+            self.ADAPTIVE_STEPS,
+            self.SIMULATION,
+            False,
+            "Propagates blanks outside of the readout in one exact step. The simulation points are then only spent on the pulses and the readout.",
+        )
+        self.add_setting("adaptive_steps", adaptive_steps_setting)
+
+        precision_setting = TrackedSelectionSetting(
+            self.PRECISION,
+            self.SIMULATION,
+            ["double", "single"],
+            default="double",
+            description="The floating point precision of the propagation and the measurement data. Single precision halves the memory of the isochromats and the data. Its rounding error grows with the number of simulation points and stays below 1e-3 of the signal maximum for 32768 points, which is well below the noise of typical settings.",
+        )
+        self.add_setting("precision", precision_setting)
+
+        memory_budget_setting = TrackedFloatSetting(
+            self.MEMORY_BUDGET,
+            self.SIMULATION,
+            1024,
+            "The memory a simulation may use for the isochromats. If the isochromats need more, they are propagated in chunks and the signals of the chunks are summed. The cached propagators of the pulse segments and the cached checkpoints of the isochromats are each limited to the same memory.",
+            min_value=1,
+            suffix="MB",
+        )
+        self.add_setting("memory_budget", memory_budget_setting)
+
+        seed_setting = TrackedIntSetting(
+            self.SEED,
+            self.SIMULATION,
+            -1,
+            "The seed of the noise and of the isochromat distribution. Every phase cycle draws its noise from an independent stream that is derived from the seed, the noise of the averages is drawn once and scaled by the square root of the number of averages, so runs with the same seed give the same result, also in parallel and batched runs. With -1 a new seed is drawn for every run.",
+            min_value=-1,
+        )
+        self.add_setting("seed", seed_setting)
+
         # Hardware settings
-        coil_length_setting = FloatSetting(
+        coil_length_setting = TrackedFloatSetting(
             self.LENGTH_COIL,
             self.HARDWARE,
             30,
@@ -127,7 +372,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("length_coil", coil_length_setting)
 
-        coil_diameter_setting = FloatSetting(
+        coil_diameter_setting = TrackedFloatSetting(
             self.DIAMETER_COIL,
             self.HARDWARE,
             8,
@@ -137,7 +382,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("diameter_coil", coil_diameter_setting)
 
-        number_turns_setting = FloatSetting(
+        number_turns_setting = TrackedFloatSetting(
             self.NUMBER_TURNS,
             self.HARDWARE,
             8,
@@ -146,7 +391,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("number_turns", number_turns_setting)
 
-        q_factor_transmit_setting = FloatSetting(
+        q_factor_transmit_setting = TrackedFloatSetting(
             self.Q_FACTOR_TRANSMIT,
             self.HARDWARE,
             80,
@@ -155,7 +400,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("q_factor_transmit", q_factor_transmit_setting)
 
-        q_factor_receive_setting = FloatSetting(
+        q_factor_receive_setting = TrackedFloatSetting(
             self.Q_FACTOR_RECEIVE,
             self.HARDWARE,
             80,
@@ -164,7 +409,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("q_factor_receive", q_factor_receive_setting)
 
-        power_amplifier_power_setting = FloatSetting(
+        power_amplifier_power_setting = TrackedFloatSetting(
             self.POWER_AMPLIFIER_POWER,
             self.HARDWARE,
             110,
@@ -173,7 +418,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("power_amplifier_power", power_amplifier_power_setting)
 
-        gain_setting = FloatSetting(
+        gain_setting = TrackedFloatSetting(
             self.GAIN,
             self.HARDWARE,
             6000,
@@ -182,7 +427,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("gain", gain_setting)
 
-        temperature_setting = FloatSetting(
+        temperature_setting = TrackedFloatSetting(
             self.TEMPERATURE,
             self.EXPERIMENTAL_Setup,
             300,
@@ -193,7 +438,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("temperature", temperature_setting)
 
-        loss_tx_setting = FloatSetting(
+        loss_tx_setting = TrackedFloatSetting(
             self.LOSS_TX,
             self.EXPERIMENTAL_Setup,
             25,
@@ -204,7 +449,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("loss_tx", loss_tx_setting)
 
-        loss_rx_setting = FloatSetting(
+        loss_rx_setting = TrackedFloatSetting(
             self.LOSS_RX,
             self.EXPERIMENTAL_Setup,
             25,
@@ -215,7 +460,7 @@ class SimulatorModel(SpectrometerModel):
         )
         self.add_setting("loss_rx", loss_rx_setting)
 
-        conversion_factor_setting = FloatSetting(
+        conversion_factor_setting = TrackedFloatSetting(
             self.CONVERSION_FACTOR,
             self.EXPERIMENTAL_Setup,
             2884,
@@ -225,57 +470,58 @@ class SimulatorModel(SpectrometerModel):
             "conversion_factor", conversion_factor_setting
         )  # Conversion factor for the LimeSDR based spectrometer
 
-        # Sample settings
-        sample_name_setting = StringSetting(
+        # Sample settings, the defaults are the default sample of the sample library
+        sample = default_library()[DEFAULT_SAMPLE]
+        sample_name_setting = TrackedStringSetting(
             self.SAMPLE_NAME,
             self.SAMPLE,
-            "BiPh3",
+            sample.name,
             "The name of the sample.",
         )
         self.add_setting("sample_name", sample_name_setting)
 
-        sample_n_atoms_setting = IntSetting(
+        sample_n_atoms_setting = TrackedIntSetting(
             self.NUMBER_ATOMS,
             self.SAMPLE,
-            0,
+            sample.n_atoms,
             "The number of atoms per unit volume of the sample (1/m^3). If this value is zero the molar mass and density will be used for calculation of the atoms per unit volume. If this value is not zero the molar mass and density",
             min_value=0,
             scientific_notation=True,
         )
         self.add_setting("n_atoms", sample_n_atoms_setting)
 
-        density_setting = FloatSetting(
+        density_setting = TrackedFloatSetting(
             self.DENSITY,
             self.SAMPLE,
-            1.585e6,
+            sample.density,
             "The density of the sample. This is used to calculate the number of spins in the sample volume.",
             min_value=0.1,
         )
         self.add_setting("density", density_setting)
 
-        molar_mass_setting = FloatSetting(
+        molar_mass_setting = TrackedFloatSetting(
             self.MOLAR_MASS,
             self.SAMPLE,
-            440.3,
+            sample.molar_mass,
             "The molar mass of the sample. This is used to calculate the number of spins in the sample volume.",
             min_value=0.1,
         )
         self.add_setting("molar_mass", molar_mass_setting)
 
-        resonant_frequency_setting = FloatSetting(
+        resonant_frequency_setting = TrackedFloatSetting(
             self.RESONANT_FREQUENCY,
             self.SAMPLE,
-            83.56,
+            sample.resonant_frequency,
             "The resonant frequency of the observed transition.",
             min_value=1,
             suffix="MHz",
         )
         self.add_setting("resonant_frequency", resonant_frequency_setting)
 
-        gamma_setting = FloatSetting(
+        gamma_setting = TrackedFloatSetting(
             self.GAMMA,
             self.SAMPLE,
-            43.42,
+            sample.gamma,
             "The gyromagnetic ratio of the sample’s nuclei.",
             min_value=0.001,
             suffix="MHz/T",
@@ -283,68 +529,68 @@ class SimulatorModel(SpectrometerModel):
         self.add_setting("gamma", gamma_setting)
 
         spin_options = ["3/2", "5/2", "7/2", "9/2"]
-        nuclear_spin_setting = SelectionSetting(
+        nuclear_spin_setting = TrackedSelectionSetting(
             self.NUCLEAR_SPIN,
             self.SAMPLE,
             spin_options,
-            default="9/2",
+            default=sample.nuclear_spin,
             description="The nuclear spin of the sample’s nuclei.",
         )
         self.add_setting("nuclear_spin", nuclear_spin_setting)
 
-        spin_factor_setting = FloatSetting(
+        spin_factor_setting = TrackedFloatSetting(
             self.SPIN_FACTOR,
             self.SAMPLE,
-            2,
+            sample.spin_factor,
             "The spin factor represents the scaling coefficient for observable nuclear spin transitions along the x-axis, derived from the Pauli I x 0 -matrix elements.",
             min_value=0,
         )
         self.add_setting("spin_factor", spin_factor_setting)
 
-        powder_factor_setting = FloatSetting(
+        powder_factor_setting = TrackedFloatSetting(
             self.POWDER_FACTOR,
             self.SAMPLE,
-            0.75,
+            sample.powder_factor,
             "A factor representing the crystallinity of the solid sample. A value of 0.75 corresponds to a powder sample.",
             min_value=0,
             max_value=1,
         )
         self.add_setting("powder_factor", powder_factor_setting)
 
-        filling_factor_setting = FloatSetting(
+        filling_factor_setting = TrackedFloatSetting(
             self.FILLING_FACTOR,
             self.SAMPLE,
-            0.7,
+            sample.filling_factor,
             "The ratio of the sample volume that occupies the coil’s sensitive volume.",
             min_value=0,
             max_value=1,
         )
         self.add_setting("filling_factor", filling_factor_setting)
 
-        t1_setting = FloatSetting(
+        t1_setting = TrackedFloatSetting(
             self.T1,
             self.SAMPLE,
-            83,
+            sample.T1,
             "The longitudinal or spin-lattice relaxation time of the sample, influencing signal recovery between pulses.",
             min_value=1,
             suffix="µs",
         )
         self.add_setting("T1", t1_setting)
 
-        t2_setting = FloatSetting(
+        t2_setting = TrackedFloatSetting(
             self.T2,
             self.SAMPLE,
-            396,
+            sample.T2,
             "The transverse or spin-spin relaxation time, determining the rate at which spins dephase and the signal decays in the xy plane",
             min_value=1,
             suffix="µs",
         )
         self.add_setting("T2", t2_setting)
 
-        t2_star_setting = FloatSetting(
+        t2_star_setting = TrackedFloatSetting(
             self.T2_STAR,
             self.SAMPLE,
-            50,
+            sample.T2_star,
             "The effective transverse relaxation time, incorporating effects of EFG inhomogeneities and other dephasing factors.",
             min_value=1,
             suffix="µs",
@@ -354,6 +600,40 @@ class SimulatorModel(SpectrometerModel):
         self.averages = 1
         self.target_frequency = 100e6
 
+    def add_setting(self, name: str, setting: Setting) -> None:
+        """Adds a setting that tells the model when its value changes.
+
+        Args:
+            name (str): The name of the setting as it is used in the code.
+            setting (Setting): The setting. A setting that is not tracked is replaced by a tracked copy, so its value has to be changed through the settings of the model afterwards.
+        """
+        setting = track_setting(setting)
+        setting._model = weakref.ref(self)
+        self._snapshot = None
+        super().add_setting(name, setting)
+
+    def __getstate__(self) -> dict:
+        """Returns the state of the model without the snapshot."""
+        state = self.__dict__.copy()
+        state["_snapshot"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """Restores the state of the model and attaches the settings to it."""
+        self.__dict__.update(state)
+        for setting in self.settings.values():
+            setting._model = weakref.ref(self)
+
+    @property
+    def snapshot(self) -> SimulatorSettings:
+        """A typed and frozen snapshot of the values of all settings.
+
+        The snapshot is only created again after the value of a setting changed, so reading it is cheap.
+        """
+        if self._snapshot is None:
+            self._snapshot = SimulatorSettings.from_settings(self.settings)
+        return self._snapshot
+
     @property
     def averages(self):
         """The number of averages used for the simulation.
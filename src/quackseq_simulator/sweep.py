@@ -0,0 +1,416 @@
+"""Parameter sweeps over the settings of the simulator and the events of a pulse sequence."""
+
+import copy
+import json
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from quackseq.helpers import UnitConverter
+from quackseq.pulsesequence import QuackSequence
+
+from .bloch import random_state
+from .cache import settings_key
+from .result_store import ResultStore
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_PREFIX = "settings."
+EVENT_PREFIX = "event:"
+EVENT_ATTRIBUTES = ("duration", "amplitude", "phase")
+
+# The simulator of a worker process is kept between tasks, so its setup cache is reused
+_worker_simulator = None
+
+
+class SweepResult:
+    """The result of a parameter sweep.
+
+    The first axes of tdx and tdy are the swept parameters in the order of the axes.
+    Points with fewer readout points or datasets than the largest point are padded with NaN.
+
+    Args:
+        axes (OrderedDict): The swept parameters and their values.
+        tdx (np.ndarray): The time axis of every point in µs with shape (*shape, n_points).
+        tdy (np.ndarray): The time domain data of every point with shape (*shape, n_points, n_datasets).
+        errors (dict): The error message of every point that could not be simulated, keyed by the index of the point.
+
+    Attributes:
+        axes (OrderedDict): The swept parameters and their values.
+        tdx (np.ndarray): The time axis of every point in µs.
+        tdy (np.ndarray): The time domain data of every point.
+        errors (dict): The error message of every point that could not be simulated.
+    """
+
+    def __init__(
+        self, axes: OrderedDict, tdx: np.ndarray, tdy: np.ndarray, errors: dict
+    ) -> None:
+        """Initializes the SweepResult."""
+        self.axes = axes
+        self.tdx = tdx
+        self.tdy = tdy
+        self.errors = errors
+
+    @property
+    def shape(self) -> tuple:
+        """The number of values of every swept parameter."""
+        return tuple(len(values) for values in self.axes.values())
+
+    @classmethod
+    def open(cls, path, mode: str = "r") -> "SweepResult":
+        """Opens a sweep that was stored on disk, the time domain data stays memory mapped.
+
+        Args:
+            path (str or Path): The path of the result store of the sweep.
+            mode (str, optional): The mode of the memory map, "r" for read only or "r+" to modify the data.
+
+        Returns:
+            SweepResult: The stored results of all points.
+        """
+        store = ResultStore.open(path, mode)
+        axes = OrderedDict(store.metadata["axes"])
+        errors = {
+            tuple(json.loads(index)): message
+            for index, message in store.metadata["errors"].items()
+        }
+        return cls(axes, store.tdx, store.tdy, errors)
+
+
+def parse_parameter(parameter: str, sequence: QuackSequence) -> tuple:
+    """Parses the name of a swept parameter.
+
+    Args:
+        parameter (str): Either "settings.<setting>" or "event:<event>.<attribute>" with the attribute duration, amplitude or phase.
+        sequence (QuackSequence): The swept pulse sequence.
+
+    Returns:
+        tuple: ("settings", setting) or ("event", event, attribute).
+
+    Raises:
+        ValueError: If the parameter can not be swept.
+    """
+    if parameter.startswith(SETTINGS_PREFIX):
+        return ("settings", parameter[len(SETTINGS_PREFIX) :])
+
+    if parameter.startswith(EVENT_PREFIX):
+        event_name, _, attribute = parameter[len(EVENT_PREFIX) :].rpartition(".")
+        if attribute not in EVENT_ATTRIBUTES:
+            raise ValueError(
+                f"Event attribute {attribute} can not be swept, use one of {EVENT_ATTRIBUTES}"
+            )
+        if sequence.get_event_by_name(event_name) is None:
+            raise ValueError(f"No event with name {event_name} found")
+        return ("event", event_name, attribute)
+
+    raise ValueError(
+        f"Parameter {parameter} can not be swept, use '{SETTINGS_PREFIX}<setting>' or '{EVENT_PREFIX}<event>.<attribute>'"
+    )
+
+
+def normalize_value(simulator, target: tuple, value):
+    """Converts a parameter value the way the setting or the event would store it.
+
+    This makes e.g. the durations "10u" and 1e-5 the same configuration.
+
+    Args:
+        simulator (Simulator): The simulator with the settings.
+        target (tuple): The parsed parameter.
+        value: The value of the parameter.
+
+    Returns:
+        The normalized value.
+    """
+    if target[0] == "settings":
+        setting = copy.copy(simulator.model.get_setting_by_name(target[1]))
+        setting.value = value
+        return setting.value
+
+    if target[2] == "duration" and isinstance(value, str):
+        return UnitConverter.to_float(value)
+
+    return float(value)
+
+
+def apply_event_overrides(sequence: QuackSequence, event_overrides: tuple) -> QuackSequence:
+    """Returns a copy of the pulse sequence with the swept event attributes.
+
+    Args:
+        sequence (QuackSequence): The swept pulse sequence.
+        event_overrides (tuple): The event name, attribute and value of every swept event attribute.
+
+    Returns:
+        QuackSequence: The pulse sequence of the point.
+    """
+    if not event_overrides:
+        return sequence
+
+    sequence = copy.deepcopy(sequence)
+    for event_name, attribute, value in event_overrides:
+        event = sequence.get_event_by_name(event_name)
+        if attribute == "duration":
+            event.duration = value
+        elif attribute == "amplitude":
+            sequence.set_tx_amplitude(event, value)
+        else:
+            sequence.set_tx_phase(event, value)
+
+    return sequence
+
+
+def run_sweep_task(task: tuple) -> list:
+    """Runs a task of a sweep in a worker process.
+
+    Args:
+        task (tuple): The arguments of simulate_points.
+
+    Returns:
+        list: The results of the points of the task.
+    """
+    global _worker_simulator
+    if _worker_simulator is None:
+        from .simulator import Simulator
+
+        _worker_simulator = Simulator()
+
+    return simulate_points(_worker_simulator, *task)
+
+
+def get_point_shapes(
+    simulator, settings: tuple, sequence: QuackSequence, points: list
+) -> list:
+    """Returns the shape of the datasets of points of a sweep without simulating them.
+
+    Args:
+        simulator (Simulator): The simulator that translates the points.
+        settings (tuple): The names and values of all settings of the points.
+        sequence (QuackSequence): The swept pulse sequence.
+        points (list): The event overrides of every point.
+
+    Returns:
+        list: The number of readout points and datasets of every point, (0, 0) for points that can not be translated. Their error is reported when they are simulated.
+    """
+    for name, value in settings:
+        simulator.settings[name].value = value
+
+    shapes = list()
+    for event_overrides in points:
+        try:
+            point_sequence = apply_event_overrides(sequence, event_overrides)
+            shapes.append(simulator.controller.get_result_shape(point_sequence))
+        except ValueError:
+            shapes.append((0, 0))
+
+    return shapes
+
+
+def simulate_points(
+    simulator,
+    settings: tuple,
+    averages: int,
+    sequence: QuackSequence,
+    points: list,
+    setup_seed: int,
+    samples=None,
+) -> list:
+    """Simulates points of a sweep that share the same settings.
+
+    Only the datasets of the points are assembled, so no measurements or spectra are created.
+
+    Args:
+        simulator (Simulator): The simulator that runs the points.
+        settings (tuple): The names and values of all settings of the point.
+        averages (int): The number of averages.
+        sequence (QuackSequence): The swept pulse sequence.
+        points (list): The event overrides and the random seed of every point.
+        setup_seed (int): The seed the isochromats are drawn with.
+        samples (SampleLibrary, optional): The sample library of the swept simulator.
+
+    Returns:
+        list: The tdx and tdy of every point or an error message if the point could not be simulated.
+    """
+    if samples is not None:
+        simulator.samples = samples
+    for name, value in settings:
+        simulator.settings[name].value = value
+    # The sweep is already distributed over the workers
+    simulator.settings.workers = 1
+    simulator.model.averages = averages
+
+    # Every worker draws the same isochromats for the same settings
+    with random_state(setup_seed):
+        simulator.controller.get_sample_setup()
+
+    controller = simulator.controller
+    results = list()
+    for event_overrides, seed in points:
+        try:
+            point_sequence = apply_event_overrides(sequence, event_overrides)
+            with random_state(seed):
+                tdx, weights, readouts = controller.get_readouts(point_sequence)
+                tdy = controller.allocate_datasets(point_sequence, tdx, weights)
+                for cycle, readout in enumerate(readouts):
+                    tdy[:, cycle] = readout
+        except ValueError as e:
+            logger.warning(f"Could not simulate sweep point {event_overrides}: {e}")
+            results.append(str(e))
+            continue
+
+        controller.apply_readout_scheme(tdy, weights)
+        results.append((tdx, tdy))
+
+    return results
+
+
+def run_sweep(
+    simulator, sequence: QuackSequence, parameters: dict, path=None
+) -> SweepResult:
+    """Simulates a pulse sequence for every combination of the parameter values.
+
+    Identical configurations are only simulated once. Points that share their settings are simulated together, so they share the setup of the simulation.
+    If more than one worker is configured, the points are simulated in parallel.
+    If a path is given, the results are stacked in a memory mapped result store on disk instead of in memory.
+    The store is sized by translating every point before the simulation, the points of a task are written into it as soon as the task is finished, so only the error messages are kept in memory.
+
+    Args:
+        simulator (Simulator): The simulator with the settings of the sweep.
+        sequence (QuackSequence): The swept pulse sequence.
+        parameters (dict): The values of every swept parameter.
+        path (str or Path, optional): The path of the result store of the sweep.
+
+    Returns:
+        SweepResult: The results of all points.
+    """
+    axes = OrderedDict((name, list(values)) for name, values in parameters.items())
+    targets = [parse_parameter(name, sequence) for name in axes]
+    shape = tuple(len(values) for values in axes.values())
+
+    base_settings = tuple(
+        (name, setting.value) for name, setting in simulator.settings.items()
+    )
+
+    # Expand the grid and find the unique configurations
+    configurations = OrderedDict()
+    point_configuration = dict()
+    for index in np.ndindex(*shape):
+        settings_overrides = list()
+        event_overrides = list()
+        for target, values, value_index in zip(targets, axes.values(), index):
+            value = normalize_value(simulator, target, values[value_index])
+            if target[0] == "settings":
+                settings_overrides.append((target[1], value))
+            else:
+                event_overrides.append((target[1], target[2], value))
+
+        key = (tuple(sorted(settings_overrides)), tuple(event_overrides))
+        point_configuration[index] = configurations.setdefault(key, len(configurations))
+
+    logger.debug(
+        f"Sweep with {len(point_configuration)} points and {len(configurations)} unique configurations"
+    )
+
+    # Group the configurations by their settings, they share the setup of the simulation
+    groups = OrderedDict()
+    seeds = np.random.randint(0, 2**31 - 1, size=len(configurations))
+    for (settings_overrides, event_overrides), configuration in configurations.items():
+        groups.setdefault(settings_overrides, list()).append(
+            (configuration, (event_overrides, seeds[configuration]))
+        )
+
+    workers = int(simulator.settings.workers)
+    chunk_size = max(1, int(np.ceil(len(configurations) / workers)))
+    setup_seed = np.random.randint(0, 2**31 - 1)
+
+    tasks = list()
+    task_configurations = list()
+    for settings_overrides, group in groups.items():
+        settings = base_settings + settings_overrides
+        for start in range(0, len(group), chunk_size):
+            chunk = group[start : start + chunk_size]
+            task_configurations.append([configuration for configuration, _ in chunk])
+            tasks.append(
+                (
+                    settings,
+                    simulator.model.averages,
+                    sequence,
+                    [point for _, point in chunk],
+                    setup_seed,
+                    simulator.samples,
+                )
+            )
+
+    from .simulator import Simulator
+
+    sweep_simulator = Simulator()
+    sweep_simulator.samples = simulator.samples
+
+    # The points are translated up front, so the results can be written as soon as a task is finished
+    n_points = n_datasets = 0
+    dtype = np.dtype(np.complex64)
+    for settings_overrides, group in groups.items():
+        shapes = get_point_shapes(
+            sweep_simulator,
+            base_settings + settings_overrides,
+            sequence,
+            [event_overrides for _, (event_overrides, _) in group],
+        )
+        # The data of a sweep over the precision is stored with the larger type
+        dtype = np.result_type(dtype, sweep_simulator.controller.get_complex_dtype())
+        for point_points, point_datasets in shapes:
+            n_points = max(n_points, point_points)
+            n_datasets = max(n_datasets, point_datasets)
+
+    if path is None:
+        tdx = np.empty(shape + (n_points,))
+        tdy = np.empty(shape + (n_points, n_datasets), dtype=dtype)
+    else:
+        store = ResultStore.create(
+            path,
+            shape + (n_points, n_datasets),
+            dtype,
+            {"sequence": sequence.name},
+            tdx_shape=shape + (n_points,),
+        )
+        tdx, tdy = store.tdx, store.tdy
+    tdx[...] = np.nan
+    tdy[...] = np.nan
+
+    configuration_points = dict()
+    for index, configuration in point_configuration.items():
+        configuration_points.setdefault(configuration, list()).append(index)
+
+    errors = dict()
+
+    def write_results(task_results) -> None:
+        # Only the error messages are kept, the data of a task is dropped once it is written
+        for configuration_indices, task_result in zip(task_configurations, task_results):
+            for configuration, result in zip(configuration_indices, task_result):
+                for index in configuration_points[configuration]:
+                    if isinstance(result, str):
+                        errors[index] = result
+                        continue
+
+                    point_tdx, point_tdy = result
+                    tdx[index][: len(point_tdx)] = point_tdx
+                    tdy[index][: point_tdy.shape[0], : point_tdy.shape[1]] = point_tdy
+
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        write_results(simulate_points(sweep_simulator, *task) for task in tasks)
+    else:
+        logger.debug(f"Running {len(tasks)} sweep tasks on {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            write_results(executor.map(run_sweep_task, tasks))
+
+    errors = dict(sorted(errors.items()))
+
+    if path is not None:
+        store.metadata.update(
+            settings=dict(settings_key(simulator.model)),
+            averages=int(simulator.model.averages),
+            axes=list(axes.items()),
+            errors={json.dumps(index): message for index, message in errors.items()},
+        )
+        store.flush()
+
+    return SweepResult(axes, tdx, tdy, errors)
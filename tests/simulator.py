@@ -1,11 +1,32 @@
 import unittest
+from unittest import mock
+import asyncio
+import dataclasses
 import logging
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+import numpy as np
 import matplotlib.pyplot as plt
 from quackseq.phase_table import PhaseTable
 from quackseq.pulsesequence import QuackSequence
 from quackseq.event import Event
-from quackseq.functions import RectFunction
+from quackseq.functions import RectFunction, GaussianFunction
+from quackseq.spectrometer.spectrometer_settings import FloatSetting, Setting
+from nqr_blochsimulator import Simulation
 from quackseq_simulator.simulator import Simulator
+from quackseq_simulator import bloch
+from quackseq_simulator.bloch import calculate_xdis
+from quackseq_simulator.cache import SetupCache
+from quackseq_simulator.pulse_plan import PulsePlan
+from quackseq_simulator.pool import SimulatorPool
+from quackseq_simulator.profiling import RunStats
+from quackseq_simulator.result_store import ResultStore
+from quackseq_simulator.samples import SampleDefinition, SampleLibrary
+from quackseq_simulator.simulator_model import tracked_setting_class
+from quackseq_simulator.sweep import SweepResult
 
 logging.basicConfig(level=logging.INFO)
 
@@ -191,6 +212,1042 @@ class TestQuackSequence(unittest.TestCase):
         plt.show()
         # seq.add_event(rx)
 
+    def test_parallel_phase_cycles(self):
+        seq = QuackSequence("test - parallel phase cycles")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("pi-half", 4)
+        seq.add_blank_event("te-half", "20u")
+        seq.add_pulse_event("pi", "6u", 100, 180, RectFunction())
+        seq.add_blank_event("blank", "10u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 90, 180, 270])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 2048
+        sim.settings.number_isochromats = 200
+
+        np.random.seed(42)
+        serial = sim.run_sequence(seq)
+
+        sim.settings.workers = 4
+        np.random.seed(42)
+        parallel = sim.run_sequence(seq)
+
+        self.assertEqual(serial.tdy.shape, (len(serial.tdx), 5))
+        np.testing.assert_array_equal(serial.tdx, parallel.tdx)
+        np.testing.assert_array_equal(serial.tdy, parallel.tdy)
+
+
+    def test_truncate_after_readout(self):
+        seq = QuackSequence("test - truncate after readout")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "100u")
+        seq.add_blank_event("TR", "1m")
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 2048
+        sim.settings.number_isochromats = 200
+
+        full = sim.run_sequence(seq)
+
+        sim.settings.truncate_after_readout = True
+        truncated = sim.run_sequence(seq)
+
+        # The same point budget now only covers the events up to the end of the readout
+        self.assertGreater(len(truncated.tdx), 5 * len(full.tdx))
+        self.assertGreaterEqual(truncated.tdx[0], 8)
+        self.assertLessEqual(truncated.tdx[-1], 108)
+
+    def test_setup_cache(self):
+        seq = QuackSequence("test - setup cache")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+
+        first = sim.run_sequence(seq)
+        sample, xdis = sim.controller.get_sample_setup()
+
+        # Without a setting change the setup is reused and so is the result
+        second = sim.run_sequence(seq)
+        self.assertIs(sim.controller.get_sample_setup()[0], sample)
+        np.testing.assert_array_equal(first.tdy, second.tdy)
+
+        sim.settings.T2_star = 40
+        new_sample, new_xdis = sim.controller.get_sample_setup()
+        self.assertIsNot(new_sample, sample)
+        self.assertAlmostEqual(new_sample.T2_star, 40e-6)
+        self.assertFalse(np.array_equal(new_xdis, xdis))
+
+    def test_pulse_plan(self):
+        seq = QuackSequence("test - pulse plan")
+        seq.add_pulse_event("tx", "10u", 100, 90, RectFunction())
+        seq.set_tx_n_phase_cycles("tx", 2)
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "25u")
+        seq.phase_table.generate_phase_array()
+
+        sim = Simulator()
+        pulse_array = sim.controller.translate_pulse_sequence(seq, 1e-6, 1)
+
+        self.assertEqual(len(pulse_array.pulseamplitude), 40)
+        np.testing.assert_array_equal(pulse_array.pulseamplitude[:10], 1)
+        np.testing.assert_array_equal(pulse_array.pulseamplitude[10:], 0)
+        np.testing.assert_allclose(pulse_array.pulsephase[:10], np.radians(270))
+        np.testing.assert_array_equal(pulse_array.pulsephase[10:], 0)
+
+    def test_bloch_simulation_matches_upstream(self):
+        seq = QuackSequence("test - bloch simulation")
+        seq.add_pulse_event("pi-half", "3u", 100, 30, RectFunction())
+        seq.add_blank_event("te-half", "20u")
+        seq.add_pulse_event("pi", "6u", 100, 120, RectFunction())
+        seq.add_readout_event("rx", "40u")
+        seq.phase_table.generate_phase_array()
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+
+        controller = sim.controller
+        dwell_time = controller.calculate_dwelltime(seq)
+        pulse_array = controller.translate_pulse_sequence(seq, dwell_time, 0)
+        sample, _ = controller.get_sample_setup()
+        xdis = calculate_xdis(sample, 100, 1)
+
+        simulation = controller.get_simulation(sample, pulse_array, xdis)
+        self.assertIsNotNone(simulation.sample_definition)
+        result = simulation.simulate()
+
+        upstream = controller.get_simulation(
+            SampleDefinition.from_settings(sim.model.snapshot).sample, pulse_array
+        )
+        self.assertIsNone(upstream.sample_definition)
+        upstream.__class__ = Simulation
+        upstream.calc_xdis = lambda: xdis
+
+        np.testing.assert_allclose(result, upstream.simulate(), rtol=1e-10, atol=0)
+
+    def test_reference_voltage(self):
+        seq = QuackSequence("test - reference voltage")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.add_readout_event("rx", "40u")
+        seq.phase_table.generate_phase_array()
+
+        sim = Simulator()
+        controller = sim.controller
+        pulse_array = controller.translate_pulse_sequence(
+            seq, controller.calculate_dwelltime(seq), 0
+        )
+
+        # The reference voltage of the sample definition matches the one of the upstream simulation
+        for n_atoms, temperature in ((0, 77), (0, 300), (1e27, 4.2)):
+            sim.settings.n_atoms = n_atoms
+            sim.settings.temperature = temperature
+            sample, _ = controller.get_sample_setup()
+            simulation = controller.get_simulation(sample, pulse_array)
+            self.assertIs(simulation.sample_definition.sample, sample)
+            self.assertAlmostEqual(
+                simulation.calculate_reference_voltage()
+                / Simulation.calculate_reference_voltage(simulation),
+                1,
+                places=12,
+            )
+
+        with self.assertWarns(DeprecationWarning):
+            sample = controller.get_sample_from_settings()
+        self.assertEqual(sample.atoms, 1e27)
+
+    def test_batch_phase_cycles(self):
+        seq = QuackSequence("test - batch phase cycles")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("pi-half", 4)
+        seq.add_blank_event("te-half", "20u")
+        seq.add_pulse_event("pi", "6u", 100, 180, RectFunction())
+        seq.add_blank_event("blank", "10u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 90, 180, 270])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 2048
+        sim.settings.number_isochromats = 200
+
+        serial = sim.run_sequence(seq)
+
+        sim.settings.batch_cycles = True
+        batched = sim.run_sequence(seq)
+
+        np.testing.assert_array_equal(serial.tdx, batched.tdx)
+        np.testing.assert_allclose(batched.tdy, serial.tdy, rtol=1e-12)
+
+    def test_sweep(self):
+        seq = QuackSequence("test - sweep")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+
+        parameters = {"settings.T2": [100, 400], "event:tx.duration": ["2u", "3u", 3e-6]}
+
+        np.random.seed(42)
+        serial = sim.sweep(seq, parameters)
+
+        sim.settings.workers = 2
+        np.random.seed(42)
+        parallel = sim.sweep(seq, parameters)
+
+        self.assertEqual(list(serial.axes), list(parameters))
+        self.assertEqual(serial.shape, (2, 3))
+        self.assertEqual(serial.tdy.shape[:2], (2, 3))
+        self.assertEqual(serial.errors, {})
+        # "3u" and 3e-6 are the same configuration
+        np.testing.assert_array_equal(serial.tdy[:, 1], serial.tdy[:, 2])
+        np.testing.assert_array_equal(serial.tdy, parallel.tdy)
+
+        with self.assertRaises(ValueError):
+            sim.sweep(seq, {"event:tx.shape": [1]})
+
+    def test_sweep_averages(self):
+        seq = QuackSequence("test - sweep averages")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+
+        sim = Simulator()
+        sim.settings.noise = 2
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+        sim.settings.seed = 5
+        sim.settings.T2 = 200
+        sim.model.averages = 16
+
+        # The points of the sweep are simulated with the averages of the simulator
+        sweep = sim.sweep(seq, {"settings.T2": [200]})
+        expected = sim.run_sequence(seq)
+        np.testing.assert_array_equal(sweep.tdy[0], expected.tdy)
+
+    def test_sweep_precision_and_samples(self):
+        seq = QuackSequence("test - sweep precision")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+        sim.settings.precision = "single"
+        definition = SampleDefinition.from_settings(sim.model.snapshot)
+        sim.samples = SampleLibrary([definition])
+        definition = sim.samples[definition.name]
+
+        # The data is stored with the precision of the simulation
+        sweep = sim.sweep(seq, {"settings.T1": [83, 100]})
+        self.assertEqual(sweep.tdy.dtype, np.complex64)
+        self.assertFalse(np.isnan(sweep.tdy).any())
+
+        # The sweep simulates with the sample library of the simulator
+        self.assertIn("sample", vars(definition))
+
+        sim.settings.precision = "double"
+        sweep = sim.sweep(seq, {"settings.precision": ["single", "double"]})
+        self.assertEqual(sweep.tdy.dtype, np.complex128)
+
+    def test_iter_sequence(self):
+        seq = QuackSequence("test - iter sequence")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("tx", 2)
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 180])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+
+        cycle_results = list(sim.iter_sequence(seq))
+        self.assertEqual([result.cycle for result in cycle_results], [0, 1])
+        self.assertTrue(all(result.n_cycles == 2 for result in cycle_results))
+
+        measurement = sim.run_sequence(seq)
+        np.testing.assert_array_equal(measurement.tdx, cycle_results[-1].tdx)
+        np.testing.assert_allclose(
+            measurement.tdy[:, -1], cycle_results[-1].running_sum, rtol=1e-12
+        )
+
+        # Stopping early does not simulate the remaining phase cycles
+        for result in sim.iter_sequence(seq):
+            break
+        self.assertEqual(result.cycle, 0)
+        np.testing.assert_array_equal(result.running_sum, result.tdy)
+
+    def test_profile(self):
+        seq = QuackSequence("test - profile")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("tx", 2)
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 180])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+
+        sim.run_sequence(seq)
+        self.assertIsNone(sim.last_run_stats)
+
+        sim = Simulator(profile=True)
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+
+        result = sim.run_sequence(seq)
+        stats = sim.last_run_stats
+
+        self.assertEqual(
+            list(stats.summary()),
+            ["setup", "translation", "construction", "propagation", "rx_slicing", "assembly"],
+        )
+        propagation = stats.get_stages("propagation")
+        self.assertEqual([stage.cycle for stage in propagation], [0, 1])
+        self.assertEqual(
+            propagation[0].arrays["signal"]["shape"],
+            stats.get_stages("translation")[0].arrays["amplitude_array"]["shape"],
+        )
+        self.assertGreater(propagation[0].allocated_bytes, 0)
+        self.assertEqual(
+            stats.get_stages("assembly")[0].arrays["tdy"]["shape"], result.tdy.shape
+        )
+        self.assertGreaterEqual(
+            stats.wall_time, sum(stage.wall_time for stage in stats.stages)
+        )
+
+        # Overlapping profiled runs share the tracing, it stops when the last one ends
+        first, second = RunStats(), RunStats()
+        first.start()
+        second.start()
+        first.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+        with second.stage("propagation") as stage:
+            data = np.ones(10000)
+        self.assertGreaterEqual(stage.allocated_bytes, data.nbytes)
+        second.stop()
+        second.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_rectangular_fast_path(self):
+        seq = QuackSequence("test - rectangular fast path")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("pi-half", 2)
+        seq.add_blank_event("te-half", "150u")
+        seq.add_pulse_event("pi", "6u", 100, 90, RectFunction())
+        seq.add_blank_event("blank", "50u")
+        seq.add_readout_event("rx", "200u")
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 2048
+        sim.settings.number_isochromats = 200
+
+        controller = sim.controller
+        seq.phase_table.generate_phase_array()
+        sample, xdis = controller.get_sample_setup()
+        pulse_plan = controller.get_pulse_plan(seq, controller.get_dwell_time(seq))
+        self.assertTrue(pulse_plan.piecewise_constant)
+
+        for phases in seq.phase_table.phase_array:
+            pulse_array = pulse_plan.get_pulse_array(phases)
+            general = controller.get_simulation(sample, pulse_array, xdis).simulate()
+            fast = controller.get_simulation(
+                sample, pulse_array, xdis, pulse_plan.offsets
+            ).simulate()
+            np.testing.assert_allclose(
+                fast, general, rtol=0, atol=1e-9 * np.max(np.abs(general))
+            )
+
+        # Shaped pulses use the general path
+        seq.add_pulse_event("shaped", "10u", 100, 0, GaussianFunction())
+        pulse_plan = controller.get_pulse_plan(seq, controller.get_dwell_time(seq))
+        self.assertFalse(pulse_plan.piecewise_constant)
+
+    def test_propagator_cache(self):
+        seq = QuackSequence("test - propagator cache")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("pi-half", 4)
+        seq.add_blank_event("te-half", "20u")
+        seq.add_pulse_event("pi", "6u", 100, 180, RectFunction())
+        seq.add_blank_event("blank", "10u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 90, 180, 270])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 2048
+        sim.settings.number_isochromats = 200
+
+        first = sim.run_sequence(seq)
+        # One propagator per pulse, shared by all phase cycles
+        self.assertEqual(len(sim.controller.propagator_cache), 2)
+
+        second = sim.run_sequence(seq)
+        self.assertEqual(len(sim.controller.propagator_cache), 2)
+        np.testing.assert_array_equal(first.tdy, second.tdy)
+
+        sim.controller.propagator_cache.clear()
+        sim.settings.workers = 2
+        parallel = sim.run_sequence(seq)
+        self.assertEqual(len(sim.controller.propagator_cache), 0)
+        np.testing.assert_allclose(parallel.tdy, first.tdy, rtol=1e-12)
+
+        # The memory of the propagators is limited to the memory budget
+        cache = sim.controller.get_propagator_cache()
+        self.assertEqual(cache.max_bytes, float(sim.settings.memory_budget) * 1e6)
+
+        cache = SetupCache(max_bytes=2000)
+        cache.put(("a",), np.zeros(100))
+        cache.put(("b",), np.zeros(100))
+        self.assertEqual(cache.nbytes, 1600)
+        # The least recently used entry is removed to make room
+        cache.lookup(("a",))
+        cache.put(("c",), (np.zeros(50), np.zeros(50)))
+        self.assertEqual(cache.nbytes, 1600)
+        self.assertIsNone(cache.lookup(("b",)))
+        # Entries larger than the limit are not kept
+        cache.put(("d",), np.zeros(1000))
+        self.assertIsNone(cache.lookup(("d",)))
+        self.assertEqual(len(cache), 2)
+
+    def test_adaptive_steps(self):
+        seq = QuackSequence("test - adaptive steps")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, GaussianFunction())
+        seq.add_blank_event("te-half", "150u")
+        seq.add_pulse_event("pi", "6u", 100, 90, RectFunction())
+        seq.add_blank_event("blank", "50u")
+        seq.add_readout_event("rx", "100u")
+        seq.add_blank_event("TR", "1m")
+        seq.phase_table.generate_phase_array()
+        phases = seq.phase_table.phase_array[0]
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_isochromats = 200
+
+        controller = sim.controller
+        sample, xdis = controller.get_sample_setup()
+
+        fine = PulsePlan.from_events(seq, seq.events, 1e-7)
+        coarse = PulsePlan.from_events(seq, seq.events, 1e-7, adaptive=True)
+        self.assertFalse(fine.adaptive)
+        self.assertTrue(coarse.adaptive)
+        # Blanks that are not recorded are a single point
+        self.assertEqual(list(coarse.lengths), [30, 1, 60, 1, 1000, 1])
+        np.testing.assert_allclose(
+            coarse.get_time_axis()[-1], fine.get_time_axis()[-10000]
+        )
+
+        general = controller.get_simulation(
+            sample, fine.get_pulse_array(phases), xdis
+        ).simulate()
+        adaptive = controller.get_simulation(
+            sample, coarse.get_pulse_array(phases), xdis, coarse.offsets, coarse.steps
+        ).simulate()
+
+        # Every coarse point is the fine point at the same time
+        fine_points = np.searchsorted(fine.get_time_axis(), coarse.get_time_axis() - 1e-12)
+        np.testing.assert_allclose(
+            adaptive,
+            general[fine_points],
+            rtol=0,
+            atol=1e-9 * np.max(np.abs(general)),
+        )
+
+        # The simulation points are only spent on the pulses and the readout
+        sim.settings.number_points = 1090
+        sim.settings.adaptive_steps = True
+        result = sim.run_sequence(seq)
+        np.testing.assert_allclose(np.diff(result.tdx), 0.1, rtol=1e-6)
+
+    def test_single_precision(self):
+        seq = QuackSequence("test - single precision")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("pi-half", 2)
+        seq.add_blank_event("te-half", "20u")
+        seq.add_pulse_event("pi", "6u", 100, 0, GaussianFunction())
+        seq.add_blank_event("blank", "10u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 180])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 2048
+        sim.settings.number_isochromats = 200
+
+        np.random.seed(0)
+        double = sim.run_sequence(seq)
+
+        sim.settings.precision = "single"
+        np.random.seed(0)
+        single = sim.run_sequence(seq)
+
+        self.assertEqual(double.tdy.dtype, np.complex128)
+        self.assertEqual(single.tdy.dtype, np.complex64)
+        np.testing.assert_allclose(
+            single.tdy, double.tdy, rtol=0, atol=1e-3 * np.max(np.abs(double.tdy))
+        )
+
+    def test_memory_budget(self):
+        seq = QuackSequence("test - memory budget")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("pi-half", 2)
+        seq.add_blank_event("te-half", "20u")
+        seq.add_pulse_event("pi", "6u", 100, 0, GaussianFunction())
+        seq.add_blank_event("blank", "10u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 180])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 2000
+
+        np.random.seed(0)
+        whole = sim.run_sequence(seq)
+
+        # The budget only fits a few hundred isochromats at once
+        sim.settings.memory_budget = 1
+        np.random.seed(0)
+        chunked = sim.run_sequence(seq)
+
+        np.testing.assert_allclose(
+            chunked.tdy, whole.tdy, rtol=0, atol=1e-12 * np.max(np.abs(whole.tdy))
+        )
+
+    def test_result_store(self):
+        seq = QuackSequence("test - result store")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("tx", 2)
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 180])
+
+        sim = Simulator()
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "result")
+
+            np.random.seed(0)
+            measurement = sim.run_sequence(seq)
+            np.random.seed(0)
+            sim.store_sequence(seq, path)
+
+            store = ResultStore.open(path)
+            self.assertIsInstance(store.tdy, np.memmap)
+            self.assertTrue(store.complete)
+            self.assertEqual(store.sequence_name, seq.name)
+            self.assertEqual(store.settings["number_points"], 1024)
+            np.testing.assert_array_equal(store.tdx, measurement.tdx)
+            np.testing.assert_array_equal(store.tdy, measurement.tdy)
+            del store
+
+            parameters = {"settings.T2": [100, 400]}
+            np.random.seed(42)
+            swept = sim.sweep(seq, parameters)
+            np.random.seed(42)
+            sim.sweep(seq, parameters, path=os.path.join(directory, "sweep"))
+
+            stored = SweepResult.open(os.path.join(directory, "sweep.npy"))
+            self.assertIsInstance(stored.tdy, np.memmap)
+            self.assertIsInstance(stored.tdx, np.memmap)
+            self.assertEqual(stored.axes, swept.axes)
+            self.assertEqual(stored.errors, swept.errors)
+            np.testing.assert_array_equal(stored.tdx, swept.tdx)
+            np.testing.assert_array_equal(stored.tdy, swept.tdy)
+            del stored
+
+            # Points with different readout lengths are padded in the store that was sized up front
+            parameters = {"event:rx.duration": ["30u", "50u"]}
+            np.random.seed(42)
+            swept = sim.sweep(seq, parameters)
+            np.random.seed(42)
+            sim.sweep(seq, parameters, path=os.path.join(directory, "readout"))
+
+            stored = SweepResult.open(os.path.join(directory, "readout"))
+            self.assertFalse(swept.errors)
+            self.assertTrue(np.isnan(stored.tdx[0, -1]))
+            self.assertFalse(np.isnan(stored.tdx[1, -1]))
+            np.testing.assert_array_equal(stored.tdx, swept.tdx)
+            np.testing.assert_array_equal(stored.tdy, swept.tdy)
+            del stored
+
+    def test_seed(self):
+        seq = QuackSequence("test - seed")
+        seq.add_pulse_event("pi-half", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("pi-half", 4)
+        seq.add_blank_event("te-half", "20u")
+        seq.add_pulse_event("pi", "6u", 100, 180, RectFunction())
+        seq.add_blank_event("blank", "10u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 90, 180, 270])
+
+        sim = Simulator()
+        sim.settings.noise = 5
+        sim.model.averages = 3
+        sim.settings.number_points = 2048
+        sim.settings.number_isochromats = 200
+        sim.settings.seed = 1234
+
+        serial = sim.run_sequence(seq)
+        # The global random state does not change a seeded run
+        np.random.seed(0)
+        repeated = sim.run_sequence(seq)
+
+        sim.settings.workers = 2
+        parallel = sim.run_sequence(seq)
+
+        sim.settings.workers = 1
+        sim.settings.batch_cycles = True
+        batched = sim.run_sequence(seq)
+
+        np.testing.assert_array_equal(serial.tdy, repeated.tdy)
+        np.testing.assert_array_equal(serial.tdy, parallel.tdy)
+        np.testing.assert_array_equal(serial.tdy, batched.tdy)
+        # The phase cycles draw independent noise
+        sim.settings.noise = 0
+        noise = serial.tdy - sim.run_sequence(seq).tdy
+        self.assertFalse(np.allclose(noise[:, 0], noise[:, 1]))
+        sim.settings.noise = 5
+
+        sim.settings.seed = 4321
+        other = sim.run_sequence(seq)
+        self.assertFalse(np.allclose(serial.tdy, other.tdy))
+
+    def test_noiseless_signal_cache(self):
+        seq = QuackSequence("test - noiseless signal cache")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("tx", 2)
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 180])
+
+        sim = Simulator(profile=True)
+        sim.settings.noise = 0
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+        sim.settings.seed = 7
+
+        clean = sim.run_sequence(seq)
+        self.assertEqual(len(sim.last_run_stats.get_stages("propagation")), 2)
+
+        # Only the noise and the averages change, the spin dynamics are not simulated again
+        sim.settings.noise = 2
+        sim.set_averages(400)
+        self.assertEqual(sim.model.averages, 400)
+        noisy = sim.run_sequence(seq)
+        self.assertEqual(sim.last_run_stats.get_stages("propagation"), [])
+
+        noise = noisy.tdy[:, 0] - clean.tdy[:, 0]
+        # The noise of the averages adds up to sqrt(averages) times the noise of one average
+        expected = 2e-6 * np.sqrt(400) / 400 * float(sim.settings.gain)
+        expected *= float(sim.settings.conversion_factor)
+        self.assertAlmostEqual(np.std(noise.real) / expected, 1, delta=0.15)
+        self.assertAlmostEqual(np.std(noise.imag) / expected, 1, delta=0.15)
+
+        # Settings of the spin dynamics are simulated again
+        sim.settings.T2 = float(sim.settings.T2) / 2
+        sim.run_sequence(seq)
+        self.assertEqual(len(sim.last_run_stats.get_stages("propagation")), 2)
+
+    def test_run_sequence_async(self):
+        seq = QuackSequence("test - run sequence async")
+        seq.add_pulse_event("tx", "3u", 100, 0, GaussianFunction())
+        seq.set_tx_n_phase_cycles("tx", 8)
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", list(np.arange(8) * 45))
+
+        sim = Simulator(max_concurrent_runs=2)
+        sim.settings.noise = 1
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 200
+        sim.settings.seed = 3
+        expected = sim.run_sequence(seq)
+        sim.controller.signal_cache.clear()
+
+        async def run_concurrently():
+            return await asyncio.gather(
+                *(sim.run_sequence_async(seq) for _ in range(3))
+            )
+
+        for measurement in asyncio.run(run_concurrently()):
+            np.testing.assert_array_equal(measurement.tdy, expected.tdy)
+
+        # A cancelled run does not simulate the remaining phase cycles
+        sim.controller.signal_cache.clear()
+        sim.settings.number_isochromats = 2000
+
+        async def cancel_after_first_cycle():
+            task = asyncio.create_task(sim.run_sequence_async(seq))
+            while len(sim.controller.signal_cache) == 0:
+                await asyncio.sleep(0.001)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_after_first_cycle())
+        sim.close()
+        self.assertLess(len(sim.controller.signal_cache), 8)
+
+    def test_simulator_pool(self):
+        seq = QuackSequence("test - simulator pool")
+        seq.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+        seq.set_tx_n_phase_cycles("tx", 2)
+        seq.add_blank_event("blank", "5u")
+        seq.add_readout_event("rx", "50u")
+        seq.set_rx_phase("rx", [0, 180])
+
+        sim = Simulator()
+        sim.settings.noise = 1
+        sim.settings.number_points = 1024
+        sim.settings.number_isochromats = 100
+        sim.settings.seed = 11
+
+        with SimulatorPool(2, sim) as pool:
+            # Every worker was started before the first job
+            self.assertEqual(len(pool.pids), 2)
+            deltas = [{"T2": 100}, None, {"T2": 100}, {"noise": 0}]
+            results = pool.map([seq] * len(deltas), deltas)
+
+            expected = sim.run_sequence(seq)
+            np.testing.assert_array_equal(results[1].tdx, expected.tdx)
+            np.testing.assert_array_equal(results[1].tdy, expected.tdy)
+            # The settings of a job do not leak into the next one
+            np.testing.assert_array_equal(results[0].tdy, results[2].tdy)
+            self.assertFalse(np.allclose(results[0].tdy, expected.tdy))
+
+            sim.settings.noise = 0
+            np.testing.assert_array_equal(results[3].tdy, sim.run_sequence(seq).tdy)
+
+    def test_settings_snapshot(self):
+        sim = Simulator()
+        snapshot = sim.model.snapshot
+
+        self.assertIs(sim.model.snapshot, snapshot)
+        self.assertEqual(snapshot.number_points, sim.settings.number_points)
+        self.assertIsInstance(snapshot.number_points, int)
+        self.assertIsInstance(snapshot.gain, float)
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            snapshot.T2 = 1
+
+        # The snapshot is created again when a setting changes, also through the setting itself
+        sim.settings.T2 = 100
+        self.assertEqual(sim.model.snapshot.T2, 100)
+        sim.settings["number_points"].value = 2048
+        self.assertEqual(sim.model.snapshot.number_points, 2048)
+        self.assertEqual(snapshot.number_points, 8192)
+
+        # Subclasses of the setting classes get a tracked subclass, untracked settings are rejected
+        class FieldSetting(FloatSetting):
+            pass
+
+        field_class = tracked_setting_class(FieldSetting)
+        self.assertIs(tracked_setting_class(FieldSetting), field_class)
+        self.assertIs(tracked_setting_class(field_class), field_class)
+        field = field_class("Field", "Simulation", 1.0, "A field.")
+        self.assertIsInstance(field, FieldSetting)
+        sim.model.add_setting("field", field)
+        snapshot = sim.model.snapshot
+        field.value = 2.0
+        self.assertEqual(sim.settings.field, 2.0)
+        self.assertIsNot(sim.model.snapshot, snapshot)
+
+        # Settings that are not tracked are replaced by a tracked copy
+        for name, setting in (
+            ("other", FloatSetting("Other", "Simulation", 1.0, "Other.")),
+            ("plain", Setting("Plain", "Simulation", "A plain setting.", "a")),
+        ):
+            sim.model.add_setting(name, setting)
+            tracked = sim.settings[name]
+            self.assertIsInstance(tracked, type(setting))
+            self.assertEqual(tracked.value, setting.value)
+            snapshot = sim.model.snapshot
+            tracked.value = setting.value * 2
+            self.assertIsNot(sim.model.snapshot, snapshot)
+        self.assertEqual(sim.settings.plain, "aa")
+
+    def test_import_time(self):
+        # The import is timed in a fresh interpreter, as with python -X importtime
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "from quackseq_simulator.simulator import Simulator; Simulator().settings",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        # Lines are "import time: <self us> | <cumulative us> | <indented module>"
+        imports = dict()
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, module = line.split("|")
+            imports[module.strip()] = int(cumulative)
+
+        # The heavy modules are only imported on the first simulation
+        for module in ("numpy", "scipy", "sympy", "nqr_blochsimulator", "quackseq.measurement"):
+            self.assertNotIn(module, imports)
+
+        # Cold start budget in µs, the eager imports took about half a second
+        cold_start = imports["quackseq_simulator.simulator"] + imports["quackseq_simulator.simulator_model"]
+        logger.info(f"Cold start imports took {cold_start / 1e3:.1f} ms")
+        self.assertLess(cold_start, 150_000)
+
+        # The first run imports the simulation modules
+        sim = Simulator()
+        self.assertIsNone(sim._controller)
+        self.assertIs(sim.controller, sim.controller)
+
+    def test_sample_library(self):
+        sim = Simulator()
+        biph3 = sim.samples["BiPh3"]
+
+        # The defaults of the sample settings are the default sample
+        self.assertEqual(sim.settings.T2_star, biph3.T2_star)
+        self.assertIs(sim.controller.get_sample_definition(), biph3)
+
+        # A revised version and a second sample in a library file
+        revised = SampleDefinition(**dict(biph3.as_dict(), version=None, T2_star=80))
+        other = SampleDefinition(
+            **dict(biph3.as_dict(), name="Other", version=3, resonant_frequency=90)
+        )
+        library = SampleLibrary([biph3, revised, other])
+        self.assertIsNone(revised.version)
+        self.assertEqual(library.get("BiPh3", 2).T2_star, 80)
+        with self.assertRaises(ValueError):
+            SampleDefinition.from_dict(dict(biph3.as_dict(), T3=1))
+
+        # Every simulator has its own library, the shipped definitions are shared
+        second = Simulator()
+        sim.samples.add(revised)
+        self.assertEqual(sim.samples.versions("BiPh3"), [1, 2])
+        self.assertEqual(second.samples.versions("BiPh3"), [1])
+        self.assertIs(second.samples["BiPh3"], biph3)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "samples.json")
+            library.save(path)
+            library = SampleLibrary.load(path)
+
+        self.assertEqual(library.names, ["BiPh3", "Other"])
+        self.assertEqual(library.versions("BiPh3"), [1, 2])
+        self.assertEqual(library["BiPh3"].T2_star, 80)
+        self.assertEqual(library.get("BiPh3", 1).T2_star, biph3.T2_star)
+        with self.assertRaises(KeyError):
+            library.get("Other", 1)
+
+        # Switching samples reuses the definitions of the library and their Sample
+        sim.samples = library
+        other = sim.set_sample("Other")
+        self.assertEqual(sim.settings.resonant_frequency, 90)
+        sample, _ = sim.controller.get_sample_setup()
+        self.assertIs(sample, other.sample)
+        self.assertEqual(sample.resonant_frequency, 90e6)
+
+        sim.set_sample("BiPh3", version=1)
+        sample, _ = sim.controller.get_sample_setup()
+        self.assertIs(sample, library.get("BiPh3", 1).sample)
+
+        # The derived quantities are those of the Bloch simulator
+        self.assertAlmostEqual(other.atom_density, other.sample.atoms)
+        self.assertAlmostEqual(other.linewidth, 1 / np.pi / other.sample.T2_star)
+        self.assertAlmostEqual(other.amplitude_weight, 0.75 * 0.7)
+
+    def test_run_batch(self):
+        def create_simulator():
+            sim = Simulator()
+            sim.settings.seed = 7
+            sim.settings.number_isochromats = 200
+            return sim
+
+        def create_sequences():
+            fid = QuackSequence("test - batch FID")
+            fid.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+            fid.add_blank_event("blank", "5u")
+            fid.add_readout_event("rx", "100u")
+
+            invalid = QuackSequence("test - batch without TX event")
+            invalid.add_blank_event("blank", "5u")
+
+            cycled = QuackSequence("test - batch phase cycled FID")
+            cycled.add_pulse_event("tx", "3u", 100, 0, RectFunction())
+            cycled.set_tx_n_phase_cycles("tx", 4)
+            cycled.add_blank_event("blank", "5u")
+            cycled.add_readout_event("rx", "100u")
+            cycled.set_rx_phase("rx", [0, 90, 180, 270])
+            return [fid, invalid, cycled]
+
+        sequences = create_sequences()
+        expected = [
+            create_simulator().run_sequence(sequence)
+            for sequence in (sequences[0], sequences[2])
+        ]
+
+        for workers in (1, 2):
+            result = create_simulator().run_batch(create_sequences(), workers=workers)
+
+            # The invalid sequence is reported without stopping the others
+            self.assertEqual(len(result), 3)
+            self.assertFalse(result.ok)
+            self.assertEqual(list(result.errors), [1])
+            self.assertIsNone(result[1])
+
+            # The results are in the order of the sequences and the same as single runs
+            for measurement, reference in zip((result[0], result[2]), expected):
+                self.assertTrue(np.array_equal(measurement.tdy, reference.tdy))
+
+        # Without workers the batch uses the workers setting, a failed assembly is reported too
+        sim = create_simulator()
+        sim.settings.workers = 1
+        create_measurement = sim.controller.create_measurement
+
+        def fail_fid(sequence, *args):
+            if sequence.name == "test - batch FID":
+                raise RuntimeError("no memory")
+            return create_measurement(sequence, *args)
+
+        with mock.patch("quackseq_simulator.batch.ProcessPoolExecutor") as executor:
+            with mock.patch.object(sim.controller, "create_measurement", fail_fid):
+                result = sim.run_batch(create_sequences())
+        executor.assert_not_called()
+        self.assertEqual(list(result.errors), [0, 1])
+        self.assertIn("no memory", result.errors[0])
+        self.assertIsNone(result[0])
+        self.assertTrue(np.array_equal(result[2].tdy, expected[1].tdy))
+
+        # A phase cycle that can not be set up for the workers only fails its sequence
+        sim = create_simulator()
+        get_cycle_simulation = sim.controller.get_cycle_simulation
+
+        def fail_cycled(sample, xdis, pulse_plan, phases):
+            if np.any(phases):
+                raise ValueError("no isochromats")
+            return get_cycle_simulation(sample, xdis, pulse_plan, phases)
+
+        with mock.patch.object(sim.controller, "get_cycle_simulation", fail_cycled):
+            result = sim.run_batch(create_sequences(), workers=2)
+        self.assertEqual(list(result.errors), [1, 2])
+        self.assertIn("no isochromats", result.errors[2])
+        self.assertIsNone(result[2])
+        self.assertTrue(np.array_equal(result[0].tdy, expected[0].tdy))
+
+    def test_checkpoints(self):
+        def create_sequence(echo_delay):
+            seq = QuackSequence("test - checkpoints")
+            seq.add_pulse_event("tx1", "3u", 100, 0, RectFunction())
+            seq.add_blank_event("blank1", "200u")
+            seq.add_pulse_event("tx2", "6u", 100, 0, RectFunction())
+            seq.add_blank_event("blank2", echo_delay)
+            seq.add_readout_event("rx", "100u")
+            return seq
+
+        def create_simulator():
+            sim = Simulator()
+            sim.settings.seed = 1
+            # The blanks are not sampled, so changing them keeps the dwell time
+            sim.settings.adaptive_steps = True
+            sim.settings.number_isochromats = 500
+            return sim
+
+        sim = create_simulator()
+        sim.run_sequence(create_sequence("50u"))
+        self.assertEqual(len(sim.controller.checkpoint_cache), 5)
+
+        # Only the changed blank and the readout are propagated again
+        with mock.patch.object(
+            bloch, "propagate_segment", wraps=bloch.propagate_segment
+        ) as propagate_segment:
+            resumed = sim.run_sequence(create_sequence("80u"))
+        self.assertEqual(propagate_segment.call_count, 2)
+
+        fresh = create_simulator().run_sequence(create_sequence("80u"))
+        self.assertTrue(np.array_equal(resumed.tdy, fresh.tdy))
+
+        # A longer readout that moves the dwell time to the next step propagates all events again
+        seq = create_sequence("80u")
+        seq.get_event_by_name("rx").duration = "120u"
+        with mock.patch.object(
+            bloch, "propagate_segment", wraps=bloch.propagate_segment
+        ) as propagate_segment:
+            sim.run_sequence(seq)
+        self.assertEqual(propagate_segment.call_count, 5)
+
+        # With the default settings edits of the readout and the trailing blank keep the dwell time
+        def create_echo(readout, trailing_blank):
+            seq = create_sequence("50u")
+            seq.get_event_by_name("rx").duration = readout
+            seq.add_blank_event("trailing", trailing_blank)
+            return seq
+
+        def create_default_simulator():
+            sim = Simulator()
+            sim.settings.seed = 1
+            sim.settings.number_isochromats = 200
+            return sim
+
+        sim = create_default_simulator()
+        self.assertFalse(sim.settings.adaptive_steps)
+        sim.run_sequence(create_echo("100u", "20u"))
+        for readout, trailing_blank, call_count in (
+            ("120u", "20u", 2),
+            ("120u", "30u", 1),
+        ):
+            seq = create_echo(readout, trailing_blank)
+            with mock.patch.object(
+                bloch, "propagate_segment", wraps=bloch.propagate_segment
+            ) as propagate_segment:
+                resumed = sim.run_sequence(seq)
+            self.assertEqual(propagate_segment.call_count, call_count)
+            fresh = create_default_simulator().run_sequence(seq)
+            self.assertTrue(np.array_equal(resumed.tdy, fresh.tdy))
+
+        # The checkpoints are only limited by the memory budget, a long sequence keeps all of them
+        seq = QuackSequence("test - many checkpoints")
+        for index in range(20):
+            seq.add_pulse_event(f"tx{index}", "1u", 100, 0, RectFunction())
+            seq.add_blank_event(f"blank{index}", "5u")
+        seq.add_readout_event("rx", "20u")
+        sim = create_simulator()
+        sim.run_sequence(seq)
+        checkpoint_cache = sim.controller.checkpoint_cache
+        self.assertEqual(len(checkpoint_cache), 41)
+        self.assertEqual(checkpoint_cache.max_bytes, sim.settings.memory_budget * 1e6)
+
+        sim.settings.memory_budget = checkpoint_cache.nbytes / 2e6
+        sim.run_sequence(seq)
+        self.assertLessEqual(checkpoint_cache.nbytes, checkpoint_cache.max_bytes)
+        self.assertLess(len(checkpoint_cache), 41)
+
 
 if __name__ == "__main__":
     unittest.main()